@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""benchmarks
+Benchmarks of the parse → compile → write pipeline of the Arduino Due
+pulsebox. Run `python -m benchmarks --help` (from the repository root)
+for usage.
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""__main__.py
+The command line interface of the benchmarks.
+
+    python -m benchmarks run -o baseline.json
+    python -m benchmarks run --sizes 100,1000 --stages parse_events -o new.json
+    python -m benchmarks run --sizes 100000 --stages code --profile
+    python -m benchmarks compare baseline.json new.json --threshold 0.2
+
+`compare` exits with status 1 if there are any regressions.
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+import argparse
+import sys
+
+from benchmarks import suite
+from benchmarks.generators import GENERATORS
+
+
+def _names(text):
+    return [name for name in text.split(",") if name]
+
+def _sizes(text):
+    return [int(float(size)) for size in _names(text)]
+
+def _format_bytes(peak_bytes):
+    if peak_bytes is None:
+        return "-"
+    return f"{peak_bytes / 2**20:.1f} MiB"
+
+def print_result(result):
+    print(f"{result['generator']:>13} {result['stage']:>19} "
+          f"{result['flips']:>8} {result['seconds']:12.6f} s "
+          f"{_format_bytes(result['peak_bytes']):>12}", flush=True)
+
+def run(args):
+    results = suite.run(sizes=args.sizes, generators=args.generators,
+                        stages=args.stages, repeat=args.repeat,
+                        memory=not args.no_memory, progress=print_result)
+    print("\nScaling (seconds ~ flips**k):")
+    for (generator, stage), k in suite.scaling(results).items():
+        print(f"{generator:>13} {stage:>19}   k = {k:.2f}")
+    if args.profile:
+        for generator in args.generators or GENERATORS:
+            for size in args.sizes or suite.SIZES:
+                profiler = suite.profile(generator, size,
+                                         memory=not args.no_memory)
+                print(f"\nProfile of {generator}, {size} flips:")
+                print(profiler.format())
+    if args.output:
+        suite.save(results, args.output)
+        print(f"\nResults saved to {args.output}.")
+    return 0
+
+def compare(args):
+    rows = suite.compare(suite.load(args.baseline), suite.load(args.current),
+                         threshold=args.threshold)
+    regressions = 0
+    for generator, stage, flips, old_s, new_s, old_b, new_b, regressed \
+            in rows:
+        regressions += regressed
+        print(f"{generator:>13} {stage:>19} {flips:>8} "
+              f"{old_s:10.6f} s -> {new_s:10.6f} s ({new_s / old_s:5.2f}x) "
+              f"{_format_bytes(old_b):>10} -> {_format_bytes(new_b):>10}"
+              + ("  REGRESSION" if regressed else ""))
+    print(f"\n{len(rows)} results compared, {regressions} regression(s).")
+    return 1 if regressions else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmarks of the pulsebox compile pipeline.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--sizes", type=_sizes,
+                            help="comma-separated numbers of flips "
+                                 "(default: 1e2,1e3,1e4,1e5,1e6)")
+    run_parser.add_argument("--generators", type=_names,
+                            help="comma-separated generators "
+                                 f"({', '.join(GENERATORS)})")
+    run_parser.add_argument("--stages", type=_names,
+                            help="comma-separated stages "
+                                 f"({', '.join(suite.STAGES)})")
+    run_parser.add_argument("--repeat", type=int, default=3,
+                            help="timed runs per result, the best one "
+                                 "counts (default: 3)")
+    run_parser.add_argument("--no-memory", action="store_true",
+                            help="do not measure the peak memory use")
+    run_parser.add_argument("--profile", action="store_true",
+                            help="also show the time spent in the stages "
+                                 "of the whole pipeline")
+    run_parser.add_argument("-o", "--output",
+                            help="save the results (JSON) into this file")
+    run_parser.set_defaults(function=run)
+
+    compare_parser = commands.add_parser(
+        "compare", help="compare results with a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="the relative slowdown (or memory "
+                                     "growth) to flag (default: 0.1)")
+    compare_parser.set_defaults(function=compare)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.function(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
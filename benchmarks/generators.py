@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""generators.py
+Synthetic pulse sequences for the benchmarks.
+
+Every generator takes the (approximate) number of flips and returns
+a list of (channel, event string) pairs, just like the GUI entries.
+The sequences are random, but reproducible (seeded).
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+import random
+
+from pulsebox import config
+
+
+def _pulses(starts, widths, unit):
+    return " ".join(f"p{start}{unit}{width}{unit}"
+                    for start, width in zip(starts, widths))
+
+def dense(flips, channels=4):
+    """Short pulses as close to each other as the delay loop allows
+    (a few iterations apart), interleaved over a few channels.
+    """
+    texts = []
+    pulses = max(flips // (2 * channels), 1)
+    for channel in range(channels):
+        starts = [1000 + 400 * n + 100 * channel for n in range(pulses)]
+        texts.append((channel, _pulses(starts, [200] * pulses, "n")))
+    return texts
+
+def sparse(flips, channels=2, seed=0):
+    """Pulses of random widths with long random gaps between them,
+    with fractional times in microseconds.
+    """
+    rng = random.Random(seed)
+    texts = []
+    pulses = max(flips // (2 * channels), 1)
+    for channel in range(channels):
+        starts, widths, time = [], [], 0
+        for _ in range(pulses):
+            time += rng.randint(1000, 10**7)  # 1 us ... 10 ms, in ns
+            width = rng.randint(1000, 10**5)
+            starts.append(f"{time / 1000:.3f}")
+            widths.append(f"{width / 1000:.3f}")
+            time += width
+        texts.append((channel, _pulses(starts, widths, "u")))
+    return texts
+
+def periodic(flips, channels=2):
+    """Strictly periodic pulses (written out one by one), the kind
+    of sequence that compresses well.
+    """
+    texts = []
+    pulses = max(flips // (2 * channels), 1)
+    for channel in range(channels):
+        period = 5 * (channel + 1)  # in microseconds
+        starts = [1 + period * n for n in range(pulses)]
+        texts.append((channel, _pulses(starts, [2] * pulses, "u")))
+    return texts
+
+def many_channel(flips, seed=0):
+    """Random pulses on all the pulsebox channels.
+    """
+    rng = random.Random(seed)
+    channels = config.pulsebox_pincount
+    texts = []
+    pulses = max(flips // (2 * channels), 1)
+    for channel in range(channels):
+        starts, widths, time = [], [], 0
+        for _ in range(pulses):
+            time += rng.randint(100, 5000)  # in ns
+            width = rng.randint(100, 5000)
+            starts.append(time)
+            widths.append(width)
+            time += width
+        texts.append((channel, _pulses(starts, widths, "n")))
+    return texts
+
+GENERATORS = {
+    "dense": dense,
+    "sparse": sparse,
+    "periodic": periodic,
+    "many_channel": many_channel,
+}
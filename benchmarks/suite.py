@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""suite.py
+The benchmarked stages of the pipeline, running them, and comparing
+the results with a baseline.
+
+Every stage is timed (the best of a few runs) and then run once more
+under `tracemalloc` to find its peak memory use. The preparation of the
+input of a stage (e.g. compiling the sequence before generating its code)
+is not measured.
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+import gc
+import json
+import math
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime, timezone
+
+import pulsebox.events as pev
+import pulsebox.profiling as pprof
+import pulsebox.sequences as pseq
+
+from benchmarks.generators import GENERATORS
+
+SIZES = [10**2, 10**3, 10**4, 10**5, 10**6]
+
+
+def _time_strings(texts):
+    strings = []
+    for _, text in texts:
+        strings.extend(re.findall(r"\d+\.?\d*[nusmci]", text))
+    return strings
+
+def _flips(texts):
+    flips = pev.FlipTable()
+    for channel, text in texts:
+        flips.extend(pev.parse_events(text, channel))
+    return pseq.FlipSequence(flips)
+
+def _write(seq):
+    with tempfile.TemporaryFile("w") as f:
+        seq.write_code(f)
+
+# name: (the input it needs, the measured function)
+STAGES = {
+    "read_time": ("time_strings",
+                  lambda strings: [pev.read_time(s) for s in strings]),
+    "parse_events": ("texts", _flips),
+    "from_flip_sequence": ("flip_sequence",
+                           pseq.Sequence.from_flip_sequence),
+    "code": ("sequence", lambda seq: seq.code()),
+    "write": ("sequence", _write),
+}
+
+
+class _Inputs(dict):
+    """The inputs of the stages for a single generated sequence,
+    each one prepared when first needed.
+    """
+    def __init__(self, texts):
+        super().__init__(texts=texts)
+
+    def __missing__(self, name):
+        if name == "time_strings":
+            value = _time_strings(self["texts"])
+        elif name == "flip_sequence":
+            value = _flips(self["texts"])
+        else:
+            value = pseq.Sequence.from_flip_sequence(self["flip_sequence"])
+        self[name] = value
+        return value
+
+
+def measure(function, argument, repeat=3, memory=True, max_seconds=1.0):
+    """Measure a single call of `function(argument)`.
+
+    Kwargs:
+        * repeat (int): The number of timed runs, the best one counts.
+            Calls taking longer than `max_seconds` are not repeated.
+        * memory (bool): Whether to measure the peak memory use.
+
+    Returns:
+        * float seconds: The wall time.
+        * int peak_bytes: The peak memory use (`None` if not measured).
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function(argument)
+        best = min(best, time.perf_counter() - start)
+        if best > max_seconds:
+            break
+
+    peak_bytes = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function(argument)
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best, peak_bytes
+
+def run(sizes=None, generators=None, stages=None, repeat=3, memory=True,
+        progress=None):
+    """Run the benchmarks.
+
+    Kwargs:
+        * sizes (list): The numbers of flips.
+            Default: `SIZES`
+        * generators, stages (list): The names of the generators
+            and stages to run (see `GENERATORS` and `STAGES`).
+            Default: All of them.
+        * repeat, memory: See `measure`.
+        * progress (callable): Called with every new result.
+
+    Returns:
+        * dict results: The metadata and the results, ready to be saved
+            as JSON (see `save`).
+    """
+    sizes = sizes if sizes else SIZES
+    generators = generators if generators else list(GENERATORS)
+    stages = stages if stages else list(STAGES)
+    for name in generators:
+        if name not in GENERATORS:
+            raise ValueError(f"Unknown generator: {name!r}.")
+    for name in stages:
+        if name not in STAGES:
+            raise ValueError(f"Unknown stage: {name!r}.")
+
+    results = []
+    for generator in generators:
+        for size in sizes:
+            inputs = _Inputs(GENERATORS[generator](size))
+            for stage in stages:
+                input_name, function = STAGES[stage]
+                seconds, peak_bytes = measure(function, inputs[input_name],
+                                              repeat=repeat, memory=memory)
+                result = {"generator": generator, "stage": stage,
+                          "flips": size, "seconds": seconds,
+                          "peak_bytes": peak_bytes}
+                results.append(result)
+                if progress:
+                    progress(result)
+    return {"meta": metadata(), "results": results}
+
+def profile(generator, size, memory=True):
+    """Run the whole pipeline once, under a `profiling.Profiler`.
+
+    Returns:
+        * profiling.Profiler profiler
+    """
+    texts = GENERATORS[generator](size)
+    with pprof.Profiler(memory=memory) as profiler:
+        seq = pseq.Sequence.from_flip_sequence(_flips(texts))
+        _write(seq)
+    return profiler
+
+def metadata():
+    return {
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+def save(results, filename):
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=1)
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def _key(result):
+    return (result["generator"], result["stage"], result["flips"])
+
+def scaling(results):
+    """Estimate how the wall time of every stage scales with the number
+    of flips: the exponent `k` of `seconds ~ flips**k`, fitted (in log-log)
+    over all the sizes.
+
+    Returns:
+        * dict exponents: {(generator, stage): k}
+    """
+    curves = {}
+    for result in results["results"]:
+        if result["seconds"] > 0:
+            curves.setdefault(_key(result)[:2], []).append(
+                (math.log(result["flips"]), math.log(result["seconds"])))
+    exponents = {}
+    for key, points in curves.items():
+        if len(points) < 2:
+            continue
+        mean_x = sum(x for x, _ in points) / len(points)
+        mean_y = sum(y for _, y in points) / len(points)
+        variance = sum((x - mean_x)**2 for x, _ in points)
+        if variance:
+            exponents[key] = sum((x - mean_x) * (y - mean_y)
+                                 for x, y in points) / variance
+    return exponents
+
+def compare(baseline, current, threshold=0.1, min_seconds=1e-3):
+    """Compare benchmark results with a baseline.
+
+    A result is a regression if its wall time or its peak memory use
+    grew by more than `threshold` (relative). Wall times under
+    `min_seconds` are too noisy and are not compared.
+
+    Returns:
+        * list rows: (generator, stage, flips, baseline seconds,
+            seconds, baseline peak bytes, peak bytes, regressed) tuples
+            of the results present in both.
+    """
+    base = {_key(result): result for result in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        old = base.get(_key(result))
+        if old is None:
+            continue
+        regressed = result["seconds"] >= min_seconds \
+                    and result["seconds"] > old["seconds"] * (1 + threshold)
+        if result["peak_bytes"] is not None \
+                and old["peak_bytes"] is not None:
+            regressed |= result["peak_bytes"] \
+                         > old["peak_bytes"] * (1 + threshold)
+        rows.append((*_key(result), old["seconds"], result["seconds"],
+                     old["peak_bytes"], result["peak_bytes"], regressed))
+    return rows
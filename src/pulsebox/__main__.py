@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""__main__.py
+The headless command line interface of the Arduino Due pulsebox.
+
+    python -m pulsebox compile seq.csv -o seq.ino
+    python -m pulsebox inspect seq.csv --timing --simulate
+    python -m pulsebox upload seq.csv --port /dev/ttyACM0
+    python -m pulsebox batch "scan/*.csv" -o scan_ino --jobs 8
+    python -m pulsebox convert seq.csv seq.pbx
+    python -m pulsebox player -o player.ino
+    python -m pulsebox push seq.csv --port /dev/ttyACM1
+
+The sequence files are the ones saved by the GUI (see `pulsebox.io`),
+or binary .pbx files (see `pulsebox.pbx`). `push` streams a sequence
+to the resident player (see `pulsebox.protocol`) written by `player`.
+GTK is never imported, and the modules needed only by some of the commands
+(arduino-cli support, NumPy) are imported only when needed, so that the
+interface starts quickly.
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+import argparse
+import os
+import sys
+
+import pulsebox.config as pcfg
+
+
+def _compile(args):
+    # Read the sequence file and compile it.
+    import pulsebox.io as pio
+    import pulsebox.sequences as pseq
+
+    if args.file.endswith(".pbx"):
+        import pulsebox.pbx as ppbx
+        flips = ppbx.PbxFile(args.file).flips
+    else:
+        flips = pio.load_flips(args.file)
+    fs = pseq.FlipSequence(flips)
+    seq = pseq.Sequence.from_flip_sequence(fs, triggered=args.triggered,
+                                           parameter=args.parameter,
+                                           backend=args.backend)
+    if args.optimize:
+        seq, _ = seq.optimize()
+    return fs, seq
+
+def compile_command(args):
+    _, seq = _compile(args)
+    if args.compress:
+        seq = seq.compress()
+    if args.output == "-":
+        seq.write_code(sys.stdout)
+        return 0
+    with open(args.output, "w") as f:
+        seq.write_code(f)
+    print(f"Source code written to {args.output}.", file=sys.stderr)
+    return 0
+
+def inspect_command(args):
+    import pulsebox.events as pev
+    import pulsebox.sequences as pseq
+
+    fs, seq = _compile(args)
+    print(f"Channels: {len(set(fs.flips.channels))}")
+    print(f"Flips: {len(fs.flips.timestamps)}")
+    print(f"Pulse trains: {len(fs.trains)}")
+    print(f"Duration: {pev.ticks2seconds(seq.time)} s")
+    print(f"Events: {len(seq.events)}")
+    print(f"Loops: {seq.loop_counter}")
+    print(f"Estimated flash usage: {seq.estimated_flash_bytes()} B "
+          f"(budget {seq.config.flash_budget} B, {seq.config.codegen} code)")
+    if args.events:
+        for event in seq.events[:args.events]:
+            print("\t* " + repr(event).replace("\n", "\n\t"))
+        if len(seq.events) > args.events:
+            print(f"\t* ... ({len(seq.events)} events in total)")
+    if args.timing:
+        print(pseq.format_timing_report(seq.timing_report(fs)))
+    if args.simulate:
+        import pulsebox.simulator as psim
+        diff = psim.compare(psim.simulate(seq), fs)
+        print(diff.summary())
+    return 0
+
+def upload_command(args):
+    import subprocess
+    import pulsebox.arduino as pard
+
+    _, seq = _compile(args)
+    seq = seq.fit_flash_budget()
+    try:
+        hit = pard.build_and_upload(seq, sketch_dir=args.sketch_dir,
+                                    port=args.port, fqbn=args.fqbn,
+                                    cache=False if args.no_cache else None)
+    except subprocess.CalledProcessError as e:
+        print(f"pulsebox: arduino-cli failed: {e.stderr}", file=sys.stderr)
+        return 1
+    cached = " (cached build)" if hit else ""
+    print(f"Sequence uploaded{cached}.", file=sys.stderr)
+    return 0
+
+def batch_command(args):
+    import pulsebox.batch as pbatch
+
+    filenames = pbatch.find_files(args.sources)
+    if not filenames:
+        print("pulsebox: no sequence files found", file=sys.stderr)
+        return 1
+
+    def progress(result):
+        print(result, file=sys.stderr)
+
+    results = pbatch.compile_files(filenames, output_dir=args.output,
+                                   workers=args.jobs,
+                                   triggered=args.triggered,
+                                   parameter=args.parameter,
+                                   backend=args.backend,
+                                   optimize=args.optimize,
+                                   compress=args.compress, progress=progress)
+    failed = [result for result in results if not result.ok]
+    print(f"{len(results) - len(failed)} of {len(results)} files compiled.",
+          file=sys.stderr)
+    return 1 if failed else 0
+
+def convert_command(args):
+    import pulsebox.pbx as ppbx
+
+    if args.output.endswith(".pbx"):
+        ppbx.csv_to_pbx(args.input, args.output, compile=args.compile,
+                        backend=args.backend)
+    elif args.input.endswith(".pbx"):
+        ppbx.pbx_to_csv(args.input, args.output)
+    else:
+        raise ValueError("One of the files has to be a .pbx file.")
+    print(f"{args.input} converted to {args.output}.", file=sys.stderr)
+    return 0
+
+def player_command(args):
+    import pulsebox.protocol as pproto
+
+    code = pproto.firmware(max_steps=args.max_steps,
+                           triggered=args.triggered,
+                           parameter=args.parameter)
+    if args.output == "-":
+        sys.stdout.write(code)
+        return 0
+    with open(args.output, "w") as f:
+        f.write(code)
+    print(f"Resident player written to {args.output}.", file=sys.stderr)
+    return 0
+
+def push_command(args):
+    import time
+    import pulsebox.protocol as pproto
+
+    _, seq = _compile(args)
+    steps = seq.table_steps()
+    start = time.perf_counter()
+    with pproto.PlayerClient(args.port, timeout=args.timeout) as client:
+        generation = client.upload(steps)
+    seconds = time.perf_counter() - start
+    print(f"{len(steps)} steps pushed in {seconds:.3f} s "
+          f"(table {generation}).", file=sys.stderr)
+    return 0
+
+def parser():
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("--config", metavar="FILE",
+                         help="use this config.ini instead of the default one")
+    options.add_argument("--triggered", action="store_true",
+                         help="wait for the trigger before every run")
+    options.add_argument("--parameter", type=int,
+                         help="the trigger pin (if triggered) or the delay "
+                              "between runs in ms (default: from "
+                              "config.ini)")
+    options.add_argument("--backend", choices=["loop", "numpy"],
+                         default="loop", help="the compiler backend "
+                                              "(default: loop)")
+    options.add_argument("--codegen", choices=["unrolled", "table"],
+                         help="unroll the events into code, or play them "
+                              "from a table (default: from config.ini)")
+    options.add_argument("--optimize", action="store_true",
+                         help="run the optimizer passes")
+    options.add_argument("--profile", action="store_true",
+                         help="show the time spent in the individual stages")
+    common = argparse.ArgumentParser(add_help=False, parents=[options])
+    common.add_argument("file", help="the sequence file (CSV, as saved "
+                                     "by the GUI, or .pbx)")
+
+    main_parser = argparse.ArgumentParser(
+        prog="python -m pulsebox",
+        description="Compile pulse sequences for the Arduino Due pulsebox.")
+    commands = main_parser.add_subparsers(dest="command", required=True)
+
+    compile_parser = commands.add_parser(
+        "compile", parents=[common], help="generate the .ino source code")
+    compile_parser.add_argument("-o", "--output", default="-",
+                                help="the .ino file (default: stdout)")
+    compile_parser.add_argument("--compress", action="store_true",
+                                help="put repeated runs of events into "
+                                     "counted loops")
+    compile_parser.set_defaults(function=compile_command)
+
+    inspect_parser = commands.add_parser(
+        "inspect", parents=[common], help="describe the compiled sequence")
+    inspect_parser.add_argument("--events", type=int, default=0,
+                                metavar="N", help="list the first N events")
+    inspect_parser.add_argument("--timing", action="store_true",
+                                help="compare the expected and requested "
+                                     "time of every edge")
+    inspect_parser.add_argument("--simulate", action="store_true",
+                                help="simulate the output and compare "
+                                     "every edge with the requested one "
+                                     "(requires NumPy)")
+    inspect_parser.set_defaults(function=inspect_command)
+
+    upload_parser = commands.add_parser(
+        "upload", parents=[common],
+        help="compile the firmware and upload it (using arduino-cli)")
+    upload_parser.add_argument("--sketch-dir", default="tmp_ino",
+                               help="the sketch directory (default: tmp_ino)")
+    upload_parser.add_argument("--port", help="the port of the Arduino Due "
+                                              "(default: from config.ini)")
+    upload_parser.add_argument("--fqbn", help="the board name "
+                                              "(default: from config.ini)")
+    upload_parser.add_argument("--no-cache", action="store_true",
+                               help="do not use the firmware build cache")
+    upload_parser.set_defaults(function=upload_command)
+
+    batch_parser = commands.add_parser(
+        "batch", parents=[options],
+        help="compile many sequence files into .ino files, in parallel")
+    batch_parser.add_argument("sources", nargs="+",
+                              help="sequence files, directories or glob "
+                                   "patterns")
+    batch_parser.add_argument("-o", "--output", metavar="DIR",
+                              help="the directory of the .ino files "
+                                   "(default: next to the sequence files)")
+    batch_parser.add_argument("-j", "--jobs", type=int,
+                              help="the number of worker processes "
+                                   "(default: the number of CPUs)")
+    batch_parser.add_argument("--compress", action="store_true",
+                              help="put repeated runs of events into "
+                                   "counted loops")
+    batch_parser.set_defaults(function=batch_command)
+
+    convert_parser = commands.add_parser(
+        "convert", parents=[options],
+        help="convert a CSV sequence file to .pbx, or back")
+    convert_parser.add_argument("input")
+    convert_parser.add_argument("output")
+    convert_parser.add_argument("--compile", action="store_true",
+                                help="also store the compiled sequence "
+                                     "(CSV to .pbx only)")
+    convert_parser.set_defaults(function=convert_command)
+
+    player_parser = commands.add_parser(
+        "player", parents=[options],
+        help="generate the resident player firmware, which plays tables "
+             "pushed over USB")
+    player_parser.add_argument("-o", "--output", default="-",
+                               help="the .ino file (default: stdout)")
+    player_parser.add_argument("--max-steps", type=int, default=4096,
+                               help="the size of the table buffers "
+                                    "(default: 4096)")
+    player_parser.set_defaults(function=player_command)
+
+    push_parser = commands.add_parser(
+        "push", parents=[common],
+        help="compile the sequence and push it to the resident player")
+    push_parser.add_argument("--port", required=True,
+                             help="the native USB port of the Arduino Due")
+    push_parser.add_argument("--timeout", type=float, default=2.0,
+                             help="how long to wait for a reply, in s "
+                                  "(default: 2.0)")
+    push_parser.set_defaults(function=push_command)
+    return main_parser
+
+def main(argv=None):
+    main_parser = parser()
+    args = main_parser.parse_args(argv)
+    if args.config and not os.path.isfile(args.config):
+        main_parser.error(f"No such config file: {args.config!r}.")
+    overrides = {"CodeBlocks": {"codegen": args.codegen}} \
+                if args.codegen else None
+    if args.config or overrides:
+        config = pcfg.Config([args.config] if args.config else None,
+                             overrides)
+    else:
+        config = pcfg.current()
+
+    profiler = None
+    try:
+        with config:
+            if not args.profile:
+                return args.function(args)
+            import pulsebox.profiling as pprof
+            with pprof.Profiler() as profiler:
+                return args.function(args)
+    except (ValueError, OSError) as e:
+        print(f"pulsebox: error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if profiler is not None:
+            print(profiler.format(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""arduino.py
+Compiling the .ino code and uploading it to the Arduino Due (using
+arduino-cli), with a cache of compiled firmware builds.
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from concurrent.futures import CancelledError
+
+from pulsebox import config
+
+
+class CommandRunner():
+    """Runs arduino-cli commands in a subprocess.
+
+    The runner is the single place where arduino-cli gets invoked, so any
+    other executable with the same command line interface (e.g. a fake one,
+    for testing) can be plugged in instead. A running command can be
+    cancelled from another thread.
+    """
+    def __init__(self, cli=None):
+        self.cli = cli if cli else config.arduino_cli
+        self.cancelled = threading.Event()
+        self._process = None
+        # Guards `cancelled` and `_process`, so that a command being
+        # started is either not started or terminated by `cancel`.
+        self._lock = threading.Lock()
+
+    def run(self, *args):
+        """Run `cli` with the given arguments and return its output.
+
+        Raises `subprocess.CalledProcessError` if the command fails and
+        `concurrent.futures.CancelledError` if it was cancelled.
+        """
+        with self._lock:
+            if self.cancelled.is_set():
+                raise CancelledError()
+            process = subprocess.Popen([self.cli, *args],
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, text=True)
+            self._process = process
+        stdout, stderr = process.communicate()
+        with self._lock:
+            self._process = None
+        if self.cancelled.is_set():
+            raise CancelledError()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode,
+                                                process.args, stdout, stderr)
+        return stdout
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled.set()
+            if self._process is not None:
+                self._process.terminate()
+
+
+_toolchain_versions = {}  # (executable path, mtime): version
+
+def toolchain_version(runner=None):
+    """Describe the toolchain (arduino-cli and the installed cores).
+
+    The result is a part of the build cache key, so that updating
+    the toolchain invalidates the cached builds. It is only determined
+    once per arduino-cli executable, until the executable changes (see
+    `clear_toolchain_versions` for the cores).
+
+    Kwargs:
+        * runner (CommandRunner): Runs the arduino-cli commands.
+            Default: A `CommandRunner` for `cli` from config.ini.
+
+    Returns:
+        * str version: The output of `arduino-cli version`
+            and `arduino-cli core list`.
+    """
+    runner = runner if runner else CommandRunner()
+    try:
+        path = os.path.realpath(shutil.which(runner.cli) or runner.cli)
+        key = path, os.stat(path).st_mtime_ns
+    except OSError:
+        key = None  # not found, left to `run` to report
+    version = _toolchain_versions.get(key)
+    if version is None:
+        version = "\n".join([runner.run("version"),
+                             runner.run("core", "list")])
+        if key is not None:
+            _toolchain_versions[key] = version
+    return version
+
+def clear_toolchain_versions():
+    """Forget the toolchain versions determined so far, e.g. after
+    installing or updating a core, which leaves arduino-cli itself as is.
+    """
+    _toolchain_versions.clear()
+
+
+class BuildCache():
+    """A content-addressed, on-disk cache of compiled firmware builds.
+
+    Every build (the output directory of `arduino-cli compile`) is stored
+    in a subdirectory named after its key, a hash of the .ino code,
+    the board and the toolchain version. The modification time of that
+    subdirectory marks its last use. When the cache grows over its size
+    limit, the least recently used builds are removed.
+    """
+    def __init__(self, directory=None, max_bytes=None):
+        if not directory:
+            directory = config.build_cache_dir
+        if not directory:
+            cache_home = os.environ.get("XDG_CACHE_HOME",
+                                        os.path.join(os.path.expanduser("~"),
+                                                     ".cache"))
+            directory = os.path.join(cache_home, "pulsebox", "builds")
+        if max_bytes is None:
+            max_bytes = config.build_cache_size_mb * 2**20
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(code_hash, fqbn, toolchain):
+        """Combine the hash of the .ino code, the board and the toolchain
+        version into a single cache key.
+        """
+        key = hashlib.sha256()
+        for part in (code_hash, fqbn, toolchain):
+            key.update(part.encode())
+            key.update(b"\0")
+        return key.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Return the path to the cached build, or `None` on a cache miss.
+        """
+        path = self.path(key)
+        if not os.path.isdir(path):
+            return None
+        os.utime(path)  # mark as recently used
+        return path
+
+    def put(self, key, build_dir):
+        """Store a copy of `build_dir` in the cache and return its path.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        # Copy into a temporary directory first and rename it afterwards,
+        # so that an interrupted copy never looks like a valid build.
+        tmp_path = tempfile.mkdtemp(dir=self.directory, prefix=".tmp-")
+        try:
+            shutil.copytree(build_dir, tmp_path, dirs_exist_ok=True)
+            os.replace(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        os.utime(path)
+        self.evict()
+        return path
+
+    def entries(self):
+        """List the cached builds as (last use, size in bytes, path) tuples,
+        least recently used first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(root, f))
+                       for root, _, files in os.walk(path) for f in files)
+            entries.append((os.path.getmtime(path), size, path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """Remove the least recently used builds until the cache fits
+        into `max_bytes`. The most recently used build is always kept.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def write_sketch(seq, sketch_dir):
+    """Write the .ino code of a sequence into a sketch directory.
+
+    arduino-cli requires the .ino file to be named after its directory.
+
+    Returns:
+        * str code_hash: The SHA-256 hash of the written code.
+    """
+    os.makedirs(sketch_dir, exist_ok=True)
+    ino_name = os.path.basename(os.path.normpath(sketch_dir)) + ".ino"
+    code_hash = hashlib.sha256()
+    with open(os.path.join(sketch_dir, ino_name), "w") as f:
+        for piece in seq.iter_code():
+            f.write(piece)
+            code_hash.update(piece.encode())
+    return code_hash.hexdigest()
+
+def compile_sketch(sketch_dir, output_dir, fqbn=None, runner=None):
+    fqbn = fqbn if fqbn else config.fqbn
+    runner = runner if runner else CommandRunner()
+    runner.run("compile", "--fqbn", fqbn, "--output-dir", output_dir,
+               sketch_dir)
+
+def upload_build(build_dir, port=None, fqbn=None, runner=None):
+    port = port if port else config.port
+    fqbn = fqbn if fqbn else config.fqbn
+    runner = runner if runner else CommandRunner()
+    runner.run("upload", "--port", port, "--fqbn", fqbn,
+               "--input-dir", build_dir)
+
+def build_and_upload(seq, sketch_dir="tmp_ino", port=None, fqbn=None,
+                     runner=None, cache=None):
+    """Compile a sequence (unless it is already cached) and upload it.
+
+    Args:
+        * seq (Sequence): The sequence to upload.
+
+    Kwargs:
+        * sketch_dir (str): The directory to write the .ino code into.
+            Default: "tmp_ino"
+        * port, fqbn (str): See the `Arduino` section of config.ini.
+        * runner (CommandRunner): Runs the arduino-cli commands.
+            Default: A `CommandRunner` for `cli` from config.ini.
+        * cache (BuildCache): The build cache. `None` creates the default
+            cache, `False` disables caching.
+
+    Returns:
+        * bool hit: Whether the build was found in the cache.
+    """
+    fqbn = fqbn if fqbn else config.fqbn
+    runner = runner if runner else CommandRunner()
+    if cache is None:
+        cache = BuildCache()
+
+    code_hash = write_sketch(seq, sketch_dir)
+    key = BuildCache.key(code_hash, fqbn, toolchain_version(runner)) \
+          if cache else None
+    build_dir = cache.get(key) if cache else None
+    hit = build_dir is not None
+
+    if not hit:
+        with tempfile.TemporaryDirectory(prefix="pulsebox-build-") as out:
+            compile_sketch(sketch_dir, out, fqbn=fqbn, runner=runner)
+            if not cache:
+                upload_build(out, port=port, fqbn=fqbn, runner=runner)
+                return hit
+            build_dir = cache.put(key, out)
+
+    upload_build(build_dir, port=port, fqbn=fqbn, runner=runner)
+    return hit
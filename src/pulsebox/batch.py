@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""batch.py
+Compiling many sequence files of the Arduino Due pulsebox at once,
+in a pool of worker processes.
+
+    results = batch.compile_files(batch.find_files(["scan/*.csv"]),
+                                  output_dir="scan_ino")
+    for result in results:
+        if result.error:
+            print(result.filename, result.error)
+
+Every worker process is started (and warmed up, see `_init_worker`) once
+and then compiles many files, with a snapshot of the configuration taken
+when the batch starts. The sequence files are independent, so the batch
+scales with the number of cores.
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+import glob
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pulsebox.config as pcfg
+import pulsebox.io as pio
+import pulsebox.sequences as pseq
+
+
+class BatchResult():
+    """The outcome of compiling one sequence file.
+
+    * filename (str): The sequence file.
+    * dest_file (str): The .ino file written (`None` on failure).
+    * error (str): What went wrong (`None` on success).
+    * events (int): The number of events of the compiled sequence.
+    * seconds (float): The time spent by the worker on the file.
+    """
+    def __init__(self, filename, dest_file=None, error=None, events=None,
+                 seconds=None):
+        self.filename = filename
+        self.dest_file = dest_file
+        self.error = error
+        self.events = events
+        self.seconds = seconds
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.error is not None:
+            return f"{self.filename}: FAILED ({self.error})"
+        return f"{self.filename} -> {self.dest_file}: {self.events} events, " \
+               f"{self.seconds:.3f} s"
+
+
+def find_files(sources, pattern="*.csv"):
+    """Expand directories and glob patterns into a list of sequence files.
+
+    Args:
+        * sources (list): Files, directories (all files matching `pattern`
+            in them) or glob patterns.
+
+    Kwargs:
+        * pattern (str): The sequence files in the directories.
+            Default: "*.csv"
+
+    Returns:
+        * list filenames: Without duplicates, in the order of `sources`
+            (the files of a directory or a pattern sorted by name).
+    """
+    filenames = []
+    for source in sources:
+        if os.path.isdir(source):
+            matches = sorted(glob.glob(os.path.join(source, pattern)))
+        elif glob.has_magic(source):
+            matches = sorted(glob.glob(source))
+        else:
+            matches = [source]
+        filenames.extend(matches)
+    return list(dict.fromkeys(filenames))
+
+def dest_filename(filename, output_dir=None):
+    """The .ino file for a sequence file: the same name with the .ino
+    extension, next to it or in `output_dir`.
+    """
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    directory = output_dir if output_dir else os.path.dirname(filename)
+    return os.path.join(directory, stem + ".ino")
+
+def config_snapshot(config=None):
+    """A copy of the configuration (default: the current one) with all
+    of its values fixed, so that the workers compile with the same
+    calibration and pins even if the configuration files change meanwhile.
+    """
+    config = config if config else pcfg.current()
+    parser = config.parser
+    overrides = {section: dict(parser.items(section))
+                 for section in parser.sections()}
+    return pcfg.Config(config.filenames, overrides)
+
+
+def _init_worker(config):
+    # Make the configuration current for the life of the worker process
+    # and compile a tiny sequence, so that the modules are imported and
+    # the values derived from the configuration are calculated only once.
+    config.__enter__()
+    pseq.compile_sequence([(0, "p1u1u")]).code()
+
+def _compile_file(filename, dest_file, triggered, parameter, backend,
+                  optimize, compress):
+    start = time.perf_counter()
+    try:
+        seq = pseq.compile_sequence(pio.load_channel_texts(filename),
+                                    triggered=triggered, parameter=parameter,
+                                    backend=backend)
+        if optimize:
+            seq, _ = seq.optimize()
+        seq = seq.compress() if compress else seq.fit_flash_budget()
+        with open(dest_file, "w") as f:
+            seq.write_code(f)
+    except Exception as e:
+        return BatchResult(filename, error=f"{type(e).__name__}: {e}")
+    return BatchResult(filename, dest_file=dest_file, events=len(seq.events),
+                       seconds=time.perf_counter() - start)
+
+def compile_files(filenames, output_dir=None, workers=None, triggered=False,
+                  parameter=None, backend="loop", optimize=False,
+                  compress=False, config=None, progress=None):
+    """Compile sequence files into .ino files, in parallel.
+
+    A file that fails to compile (or to be read or written) does not stop
+    the batch: its failure is reported in its `BatchResult`.
+
+    Args:
+        * filenames (list): The sequence files (see `find_files`).
+
+    Kwargs:
+        * output_dir (str): Where to write the .ino files
+            (see `dest_filename`). It is created if needed.
+            Default: next to the sequence files
+        * workers (int): The number of worker processes.
+            Default: the number of CPUs
+        * triggered (bool), parameter: See `codeblocks.setup`.
+        * backend (str): See `Sequence.from_flip_sequence`.
+        * optimize (bool): Run the optimizer passes (see `Sequence.optimize`).
+        * compress (bool): Compress the sequences (see `Sequence.compress`)
+            instead of only fitting them into the flash budget.
+        * config (config.Config): The configuration to compile with.
+            Default: The current configuration
+        * progress (callable): Called with every `BatchResult` as soon as
+            it is ready (in the calling process).
+
+    Returns:
+        * list results: `BatchResult`s, in the order of `filenames`.
+    """
+    filenames = list(filenames)
+    if not filenames:
+        return []
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    dest_files = [dest_filename(filename, output_dir)
+                  for filename in filenames]
+    if len(set(dest_files)) < len(dest_files):
+        raise ValueError("Several sequence files would be compiled into "
+                         "the same .ino file.")
+
+    workers = min(workers if workers else os.cpu_count() or 1,
+                  len(filenames))
+    results = [None] * len(filenames)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(config_snapshot(config),)) \
+            as executor:
+        futures = {executor.submit(_compile_file, filename, dest_file,
+                                   triggered, parameter, backend, optimize,
+                                   compress): i
+                   for i, (filename, dest_file)
+                   in enumerate(zip(filenames, dest_files))}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:  # e.g. a crashed worker
+                result = BatchResult(filenames[i],
+                                     error=f"{type(e).__name__}: {e}")
+            results[i] = result
+            if progress:
+                progress(result)
+    return results
@@ -10,11 +10,9 @@ Radim Hošák <hosak(at)optics.upol.cz>
 
 from . import config
 
-from functools import reduce
+from textwrap import indent
 
-from pulsebox.config import pulsebox_pins, pulsebox_pincount
-
-def header(msg=config.header):
+def header(msg=None):
     """A (usually) one-line comment written at the top of the .ino file.
     
     Kwargs:
@@ -25,6 +23,8 @@ def header(msg=config.header):
         * str hdr: The header (contents of `msg` wrapped in a comment).
         	If empty string `""` is given as input, return `None`.
     """
+    if msg is None:
+        msg = config.header
     if msg == "":
     	return None
     # We do not allow comment ending sequence "*/" to be present in `msg`.
@@ -112,16 +112,22 @@ def state_change(channel_states=None, odsr_value=None):
         * channel_states(iterable of ints): Channel states - 1 or 0.
             This iterable must contain as many values as there are
             pulsebox channels.
+
+    Kwargs:
+        * odsr_value (int): The value of `REG_PIOC_ODSR` (instead of
+            `channel_states`). A (binary or hex) literal string will do, too.
     
     Returns:
         * str chng: A piece of code responsible for writing a binary number
             into the `REG_PIOC_ODSR` to achieve the desired state change.
     """
-    if not odsr_value and not channel_states:
+    if odsr_value is None and not channel_states:
         raise ValueError("Neither channel states or ODSR value given.")
 
-    if not odsr_value:
+    if odsr_value is None:
         odsr_value = channel_states_to_odsr(channel_states)
+    elif not isinstance(odsr_value, str):
+        odsr_value = format_odsr(odsr_value)
     
     chng = f"   REG_PIOC_ODSR = {odsr_value};"
     return chng
@@ -133,16 +139,17 @@ def loop(iters, loop_suffix="0"):
         * iters (int): The number of loop iterations.
     
     Kwargs:
-        * loop_suffix (str): The suffix for ASM loop label.
+        * loop_suffix (str): Not used any more (kept for compatibility).
             Default: "0"
 
     Returns:
         * str asm_loop: The code containing the ASM delay loop.
     
     Notes:
-        * Please ensure that throughout your .ino code the individual
-            loops have unique identifiers (suffixes).
-            The .ino code won't compile otherwise!
+        * A numeric (local) ASM label is used, so that the code stays valid
+            even if the compiler duplicates it (e.g. when unrolling
+            a counted loop, see `repeat`). The loop counter register
+            is declared as clobbered.
     """
     # Check if `iters` is int. If not, attempt conversion (if safe).
     if type(iters) is not int:
@@ -167,14 +174,121 @@ def loop(iters, loop_suffix="0"):
     asm_loop = "   asm volatile (\n" \
                f'      "MOVW R1, #{bottom}\\n"\n' \
                f'      "MOVT R1, #{top}\\n"\n' \
-               f'      "LOOP{loop_suffix}:\\n\\t"\n' \
+               '      "1:\\n\\t"\n' \
                '      "NOP\\n\\t"\n' \
                '      "SUB R1, #1\\n\\t"\n' \
                '      "CMP R1, #0\\n\\t"\n' \
-               f'      "BNE LOOP{loop_suffix}\\n"\n' \
+               '      "BNE 1b\\n"\n' \
+               '      ::: "r1", "cc"\n' \
                "   );"
     return asm_loop
 
+def repeat(count, body, loop_suffix="0"):
+    """Code repeating a block of code using a counted loop.
+    
+    Args:
+        * count (int): The number of repetitions.
+        * body (str): The code to be repeated.
+    
+    Kwargs:
+        * loop_suffix (str): The suffix for the loop counter variable.
+            Default: "0"
+
+    Returns:
+        * str rep_loop: The code containing the counted loop.
+    
+    Notes:
+        * Every repetition costs a few clock cycles (incrementing
+            and comparing the counter, branching). See
+            `repeat_overhead_cycles` in config.ini.
+        * The body is contained in the code only once, so the ASM loop
+            labels in it stay unique.
+    """
+    # Check if `count` is int. If not, attempt conversion (if safe).
+    if type(count) is not int:
+        try:
+            assert int(count) == count
+            count = int(count)
+        except (ValueError, AssertionError):
+            raise TypeError("Repetition count `count` is not an int.")
+
+    if not 0 < count < 2**32:
+        raise ValueError("Repetition count is not a valid 32-bit unsigned " \
+                         "int or is zero.")
+
+    counter = f"REP{loop_suffix}"
+    rep_loop = f"   for (uint32_t {counter} = 0; {counter} < {count}; " \
+               f"{counter}++) {{\n" \
+               f"{indent(body, '   ')}\n" \
+               "   }"
+    return rep_loop
+
+def step_table(length):
+    """The beginning of the table of steps played by `player`. It is
+    followed by `length` rows (see `step`) and `step_table_end`.
+
+    Every step is a `REG_PIOC_ODSR` value and the number of delay loop
+    iterations to wait after writing it. The table is `const`, so it stays
+    in flash memory.
+    """
+    if not 0 < length < 2**32:
+        raise ValueError("The table needs at least one step.")
+    return f"const uint32_t SEQUENCE_STEPS[{length}][2] = {{"
+
+def step(odsr_value, iters):
+    """A row of the table of steps (see `step_table`).
+    """
+    if not 0 <= iters < 2**32:
+        raise ValueError("Iteration count is not a valid 32-bit unsigned int.")
+    if not isinstance(odsr_value, str):
+        odsr_value = format_odsr(odsr_value)
+    return f"   {{{odsr_value}, {iters}}},"
+
+def step_table_end():
+    return "};\n"
+
+def player(length, table="SEQUENCE_STEPS"):
+    """The body of `sequence()` playing the table of steps (see
+    `step_table`) of the given length (at least one step).
+
+    Every step loads the ODSR value and the iteration count, writes
+    the value into `REG_PIOC_ODSR` and runs the same delay loop as `loop`
+    (skipped for zero iterations), so the calibration holds. The fixed
+    cost of a step is `table_step_cycles` (see config.ini).
+
+    Kwargs:
+        * table (str): The C expression of the table (an array of steps),
+            e.g. a buffer in RAM.
+            Default: "SEQUENCE_STEPS"
+
+    Returns:
+        * str body: The code of the player loop.
+
+    Notes:
+        * Numeric (local) ASM labels are used, so that the code stays valid
+            even if the compiler duplicates it.
+    """
+    body = f"   const uint32_t *step = {table}[0];\n" \
+           f"   const uint32_t *end = {table}[{length}];\n" \
+           "   asm volatile (\n" \
+           '      "1:\\n\\t"\n' \
+           '      "LDMIA %[step]!, {R1, R2}\\n\\t"\n' \
+           '      "STR R1, [%[odsr]]\\n\\t"\n' \
+           '      "CBZ R2, 3f\\n"\n' \
+           '      "2:\\n\\t"\n' \
+           '      "NOP\\n\\t"\n' \
+           '      "SUB R2, #1\\n\\t"\n' \
+           '      "CMP R2, #0\\n\\t"\n' \
+           '      "BNE 2b\\n"\n' \
+           '      "3:\\n\\t"\n' \
+           '      "CMP %[step], %[end]\\n\\t"\n' \
+           '      "BNE 1b\\n"\n' \
+           '      : [step] "+r" (step)\n' \
+           '      : [end] "r" (end), [odsr] "r" (&REG_PIOC_ODSR)\n' \
+           '      : "r1", "r2", "cc", "memory"\n' \
+           "   );"
+    return body
+
 def end():
     """The ending of the .ino source code.
     Contains an empty `loop()` function.
@@ -188,15 +302,117 @@ def end():
            "}"
     return tail
 
-def channel_states_to_odsr(channel_states):
-    if len(channel_states) != pulsebox_pincount:
-            raise ValueError("Incorrect number of channel states given.")
-
-    high_pins = [pin for state, pin in zip(channel_states, pulsebox_pins)
-                 if state == 1]
-    # Calculate the value of `REG_PIOC_ODSR`.
-    # Start with a binary number full of zeros.
-    # For every pin that must be set to high,
-    # flip the corresponding bit.
-    odsr = bin(reduce(lambda x, y: x ^ (1 << y), high_pins, 0))
+def _odsr_tables(cfg):
+    """Lookup tables converting channel masks to `REG_PIOC_ODSR` values,
+    one byte (8 channels) at a time. Derived from `pulsebox_pins` of the
+    configuration `cfg` (see `config.Config.derived`).
+
+    The ODSR value of a channel mask is the bitwise OR of
+    `tables[n][(mask >> 8 * n) & 0xff]` over all tables `n`.
+    """
+    tables = []
+    for first in range(0, cfg.pulsebox_pincount, 8):
+        pin_masks = cfg.pin_masks[first:first + 8]
+        table = [0] * 256
+        for byte in range(1, 256):
+            lowest = byte & -byte  # the lowest set bit
+            channel = lowest.bit_length() - 1
+            if channel < len(pin_masks):
+                table[byte] = table[byte ^ lowest] | pin_masks[channel]
+            else:
+                table[byte] = table[byte ^ lowest]
+        tables.append(table)
+    return tables
+
+def channel_states_to_mask(channel_states):
+    """Convert a list of channel states (1 or 0) to a channel mask,
+    an int whose bit number `channel` is the state of that channel.
+    """
+    if len(channel_states) != config.current().pulsebox_pincount:
+        raise ValueError("Incorrect number of channel states given.")
+    mask = 0
+    for channel, state in enumerate(channel_states):
+        if state == 1:
+            mask |= 1 << channel
+    return mask
+
+def mask_to_channel_states(mask):
+    """The inverse of `channel_states_to_mask`."""
+    return [(mask >> channel) & 1
+            for channel in range(config.current().pulsebox_pincount)]
+
+def channel_mask_to_odsr(mask):
+    """Convert a channel mask to the (int) value of `REG_PIOC_ODSR`.
+    """
+    odsr = 0
+    for table in config.current().derived(_odsr_tables):
+        odsr |= table[mask & 0xff]
+        mask >>= 8
     return odsr
+
+def channel_masks_to_odsr(masks):
+    """Convert many channel masks to `REG_PIOC_ODSR` values at once.
+
+    Args:
+        * masks (iterable of ints): The channel masks. A NumPy integer
+            array is converted without any per-mask Python code.
+
+    Returns:
+        * list odsr_values (or a NumPy array, for a NumPy array input)
+    """
+    tables = config.current().derived(_odsr_tables)
+    if hasattr(masks, "dtype"):  # a NumPy array
+        import numpy as np
+        odsr_values = np.zeros(masks.shape, dtype=np.int64)
+        for n, table in enumerate(tables):
+            odsr_values |= np.array(table, dtype=np.int64)[
+                (masks >> (8 * n)) & 0xff]
+        return odsr_values
+
+    odsr_values = [0] * len(masks) if hasattr(masks, "__len__") else None
+    if odsr_values is None:
+        masks = list(masks)
+        odsr_values = [0] * len(masks)
+    for n, table in enumerate(tables):
+        shift = 8 * n
+        odsr_values = [odsr | table[(mask >> shift) & 0xff]
+                       for odsr, mask in zip(odsr_values, masks)]
+    return odsr_values
+
+def flip_masks_to_odsr(flip_masks, initial_mask=0):
+    """Convert flip masks (deltas) to `REG_PIOC_ODSR` values at once.
+
+    Every flip mask has the bits of the channels flipped at a given moment
+    set. The channel states after every moment are the cumulative XOR
+    of the flip masks, starting at `initial_mask`.
+
+    Returns:
+        * list channel_masks: The channel masks after every moment.
+        * list odsr_values: The corresponding `REG_PIOC_ODSR` values.
+    """
+    channel_masks = []
+    mask = initial_mask
+    for flip_mask in flip_masks:
+        mask ^= flip_mask
+        channel_masks.append(mask)
+    return channel_masks, channel_masks_to_odsr(channel_masks)
+
+def format_odsr(odsr, style=None):
+    """Format a `REG_PIOC_ODSR` value as a C literal.
+
+    Kwargs:
+        * style (str): "bin" or "hex".
+            Default: See `odsr_format` in config.ini.
+    """
+    style = style if style else config.current().odsr_format
+    if style == "bin":
+        return bin(odsr)
+    if style == "hex":
+        return hex(odsr)
+    raise ValueError(f"Unknown ODSR format: {style!r}.")
+
+def channel_states_to_odsr(channel_states):
+    """Convert a list of channel states to the `REG_PIOC_ODSR` literal.
+    """
+    mask = channel_states_to_mask(channel_states)
+    return format_odsr(channel_mask_to_odsr(mask))
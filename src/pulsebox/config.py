@@ -2,14 +2,16 @@
 # -*- coding: utf-8 -*-
 
 """config.py
-Reads the pulsebox configuration from the config.ini file.
+Reads the pulsebox configuration from the config.ini file (lazily).
 
 Radim Hošák <hosak(at)optics.upol.cz>
 2021 Quantum Optics Lab Olomouc
 """
 
 import configparser
+import contextvars
 import os
+import threading
 
 from functools import reduce
 
@@ -19,42 +21,244 @@ DEFAULTS = {
         "pulsebox_pins": "1,3,5,7,9,18,16,14,12,2,4,6,8,19,17,15",
         "trigger_pin": 52,
         "cont_mode_delay_ms": 0,
-        "calibration": 6.4e-08
+        "calibration": 6.4e-08,
+        "clock_frequency": 84000000
+    },
+    "Timing": {
+        "repeat_overhead_cycles": 5,
+        "state_change_cycles": 4,
+        "loop_overhead_cycles": 2,
+        "table_step_cycles": 12,
+        "timing_violations": "warn"
+    },
+    "Flash": {
+        "budget": 524288,
+        "base_bytes": 10700,
+        "loop_bytes": 16,
+        "state_change_bytes": 8,
+        "repeat_bytes": 16,
+        "table_player_bytes": 64
     },
     "CodeBlocks": {
-        "header": "Automatically generated file"
+        "header": "Automatically generated file",
+        "odsr_format": "bin",
+        "codegen": "unrolled"
     },
     "Arduino": {
         "port": "/dev/ttyACM0",
-        "by_id_string": ""
+        "by_id_string": "",
+        "fqbn": "arduino:sam:arduino_due_x_dbg",
+        "cli": "arduino-cli",
+        "build_cache_dir": "",
+        "build_cache_size_mb": 200
     }
 }
 
 forbidden_portc_pins = [10, 11, 20, 27]
 
-parser = configparser.ConfigParser()
-parser.read_dict(DEFAULTS)  # load the default configuration
-
-# The values in the config.ini file override the defaults.
-# In any scenario, only one of the two paths should contain the file.
-# Which of these two it is depends on our working directory.
+# The config.ini file is looked for in these locations, in this order.
+# Which of the first three applies depends on our working directory.
 # If we are running `import config` from the `pulsebox` directory,`config.ini`
 # is the correct path. However, when running `import pulsebox.config`
 # from the `src` directory, we need to descend into `pulsebox` first.
-# We will store the path to the configuration file, just in case we need it.
-filename = parser.read(["config.ini",
-                       os.path.join("pulsebox", "config.ini"),
-                       os.path.join("src", "pulsebox", "config.ini")])[0]
-
-pulsebox_pins = [*map(int, parser.get("Pulsebox", "pulsebox_pins").split(","))]
-trigger_pin = parser.getint("Pulsebox", "trigger_pin")
-cont_mode_delay_ms = parser.getint("Pulsebox", "cont_mode_delay_ms")
-calibration = parser.getfloat("Pulsebox", "calibration")
-header = parser.get("CodeBlocks", "header")
-port = parser.get("Arduino", "port")
-by_id_string = parser.get("Arduino", "by_id_string")
-
-# Two convenience variables: pulsebox pin count and a binary value
-# corresponding to all pulsebox pins being enabled (set to 1):
-pulsebox_pincount = len(pulsebox_pins)
-all_pins_enabled = bin(reduce(lambda x, y: x ^ (1 << y), pulsebox_pins, 0))
+# The example config.ini of the package itself is the last resort.
+FILENAMES = ["config.ini",
+             os.path.join("pulsebox", "config.ini"),
+             os.path.join("src", "pulsebox", "config.ini"),
+             os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "config.ini")]
+
+# The options: (attribute name, section, option, type)
+OPTIONS = [
+    ("trigger_pin", "Pulsebox", "trigger_pin", int),
+    ("cont_mode_delay_ms", "Pulsebox", "cont_mode_delay_ms", int),
+    ("calibration", "Pulsebox", "calibration", float),
+    ("clock_frequency", "Pulsebox", "clock_frequency", int),
+    ("repeat_overhead_cycles", "Timing", "repeat_overhead_cycles", int),
+    ("state_change_cycles", "Timing", "state_change_cycles", int),
+    ("loop_overhead_cycles", "Timing", "loop_overhead_cycles", int),
+    ("table_step_cycles", "Timing", "table_step_cycles", int),
+    ("timing_violations", "Timing", "timing_violations", str),
+    ("flash_budget", "Flash", "budget", int),
+    ("flash_base_bytes", "Flash", "base_bytes", int),
+    ("flash_loop_bytes", "Flash", "loop_bytes", int),
+    ("flash_state_change_bytes", "Flash", "state_change_bytes", int),
+    ("flash_repeat_bytes", "Flash", "repeat_bytes", int),
+    ("flash_table_player_bytes", "Flash", "table_player_bytes", int),
+    ("header", "CodeBlocks", "header", str),
+    ("odsr_format", "CodeBlocks", "odsr_format", str),
+    ("codegen", "CodeBlocks", "codegen", str),
+    ("port", "Arduino", "port", str),
+    ("by_id_string", "Arduino", "by_id_string", str),
+    ("fqbn", "Arduino", "fqbn", str),
+    ("arduino_cli", "Arduino", "cli", str),
+    ("build_cache_dir", "Arduino", "build_cache_dir", str),
+    ("build_cache_size_mb", "Arduino", "build_cache_size_mb", int)
+]
+
+
+class Config():
+    """The pulsebox configuration.
+
+    The configuration files are only read when one of the values is first
+    needed. The values are then available as attributes (e.g. `calibration`,
+    see `OPTIONS`), together with a few values derived from them:
+
+        * pulsebox_pins (list): The Arduino Due pin of every channel.
+        * pulsebox_pincount (int): The number of channels.
+        * pin_masks (tuple): The `REG_PIOC_ODSR` bit mask of every channel.
+        * all_pins_mask (int): The bit mask of all the pulsebox pins.
+        * all_pins_enabled (str): The same, as a binary literal.
+        * pin_channels (dict): The channel of every pulsebox pin.
+        * signature (tuple): All the configuration values, for comparison.
+
+    Other modules cache their own values derived from the configuration
+    using `derived`. After recalibration, `reload` reads the configuration
+    files again and invalidates all of the derived values. Loading
+    and reloading are serialized by a lock, so the configuration can be
+    reloaded while other threads use it.
+
+    The configuration in effect is the one returned by `current`. Use
+    the configuration as a context manager to make it current:
+
+        with Config(overrides={"Pulsebox": {"calibration": 6.5e-8}}):
+            seq = sequences.compile_sequence(channel_texts)
+
+    Kwargs:
+        * filenames (list): The configuration files to read.
+            Default: `FILENAMES`
+        * overrides (dict): Values overriding those in the files,
+            in the format of `DEFAULTS`.
+    """
+    def __init__(self, filenames=None, overrides=None):
+        self.filenames = filenames if filenames else FILENAMES
+        self.overrides = overrides
+        self.generation = 0
+        self._loaded = False
+        self._derived = {}
+        self._lock = threading.RLock()  # for loading and reloading
+        self._local = threading.local()  # the context tokens, per thread
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, i.e. before loading
+        # (or while another thread reloads).
+        if name.startswith("_"):
+            raise AttributeError(f"The configuration has no value {name!r}.")
+        with self._lock:
+            self.load()
+            try:
+                return self.__dict__[name]
+            except KeyError:
+                raise AttributeError("The configuration has no value "
+                                     f"{name!r}.") from None
+
+    def load(self):
+        """Read the configuration files (if not read yet).
+        """
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                self._load()
+
+    def _load(self):
+        parser = configparser.ConfigParser()
+        parser.read_dict(DEFAULTS)  # load the default configuration
+        # The values in the config.ini file override the defaults.
+        # We will store the path to the configuration file,
+        # just in case we need it.
+        filenames = parser.read(self.filenames)
+        if self.overrides:
+            parser.read_dict(self.overrides)
+
+        values = {"parser": parser,
+                  "filename": filenames[0] if filenames else None}
+        for name, section, option, kind in OPTIONS:
+            if kind is int:
+                values[name] = parser.getint(section, option)
+            elif kind is float:
+                values[name] = parser.getfloat(section, option)
+            else:
+                values[name] = parser.get(section, option)
+
+        pins = [*map(int, parser.get("Pulsebox", "pulsebox_pins").split(","))]
+        values["pulsebox_pins"] = pins
+        values["pulsebox_pincount"] = len(pins)
+        values["pin_masks"] = tuple(1 << pin for pin in pins)
+        values["all_pins_mask"] = reduce(lambda x, y: x ^ (1 << y), pins, 0)
+        values["all_pins_enabled"] = bin(values["all_pins_mask"])
+        values["pin_channels"] = {pin: channel
+                                  for channel, pin in enumerate(pins)}
+        values["signature"] = tuple((section, tuple(parser.items(section)))
+                                    for section in parser.sections())
+
+        self.__dict__.update(values)
+        self._loaded = True
+
+    def reload(self):
+        """Forget all the values, so that the configuration files are read
+        again when a value is needed next time.
+        """
+        with self._lock:
+            self._loaded = False
+            for name in [*self.__dict__]:
+                if name not in ("filenames", "overrides", "generation") \
+                        and not name.startswith("_"):
+                    del self.__dict__[name]
+            # A new dict, so that the values derived from the old ones
+            # in other threads are not stored in it.
+            self._derived = {}
+            self.generation += 1
+
+    def derived(self, function):
+        """Return `function(self)`, calculated only once (per `reload`).
+        """
+        derived = self._derived
+        try:
+            return derived[function]
+        except KeyError:
+            value = derived[function] = function(self)
+            return value
+
+    def __enter__(self):
+        tokens = self._local.__dict__.setdefault("tokens", [])
+        tokens.append(_current.set(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        _current.reset(self._local.tokens.pop())
+
+    def __getstate__(self):
+        # Only the recipe is pickled. The values are read again when needed.
+        return {"filenames": self.filenames, "overrides": self.overrides}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __repr__(self):
+        state = f"from {self.filename}" if self._loaded else "not loaded"
+        return f"Pulsebox configuration ({state})"
+
+
+default = Config()
+_current = contextvars.ContextVar("pulsebox_config", default=default)
+
+# The configuration in effect: the innermost one used as a context manager,
+# or `default`. (This is called very often, hence the bare method.)
+current = _current.get
+
+def reload():
+    """Reload the current configuration (see `Config.reload`).
+    """
+    current().reload()
+
+def __getattr__(name):
+    # The configuration values used to be module attributes (read
+    # at import time). For compatibility, they are looked up
+    # in the current configuration.
+    if name.startswith("__"):
+        raise AttributeError(name)
+    try:
+        return getattr(current(), name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
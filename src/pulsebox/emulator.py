@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""emulator.py
+An emulator of the resident player of the Arduino Due pulsebox
+(see `pulsebox.protocol`), for testing the protocol and its throughput
+without the hardware.
+
+    with emulator.PlayerEmulator() as device:
+        with protocol.PlayerClient(device.port) as client:
+            client.push(seq)
+        print(device.tables[device.active])
+
+The emulator serves a pseudo-terminal (POSIX only) from a thread, and
+handles the frames the same way as the firmware: only while waiting
+between the repetitions of the playing table (for `wait_seconds`,
+the delay of the continuous mode), at most a frame at a time, and none
+while playing (for `repetition_seconds`). The throughput of pushing
+to the emulator is thus limited the same way as that of the device.
+
+    python -m pulsebox.emulator
+
+runs the emulator until interrupted, for clients in other processes.
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+import os
+import select
+import struct
+import threading
+import time
+import zlib
+
+import pulsebox.protocol as pproto
+
+
+class PlayerEmulator():
+    """The resident player, emulated.
+
+    Kwargs:
+        * max_steps (int): The size of the two table buffers (steps).
+            Default: `protocol.MAX_STEPS`
+        * repetition_seconds (float): How long a repetition of the playing
+            table takes.
+            Default: 0.001
+        * wait_seconds (float): How long the player waits between
+            the repetitions (handling the frames).
+            Default: 0.001
+        * corrupt_every (int): Treat every n-th received frame as corrupted
+            (to test the recovery), 0 for none.
+            Default: 0
+        * drop_replies (iterable): The frame kinds whose first reply gets
+            lost (to test the recovery).
+            Default: ()
+
+    Attributes:
+        * port (str): The pseudo-terminal to connect to (once started).
+        * tables (list): The two buffers, lists of (ODSR value, iterations)
+            pairs.
+        * active (int): The index of the playing buffer.
+        * generation (int): The number of committed tables.
+        * repetitions (int): The repetitions of the playing table.
+        * playing (bool): Whether a repetition is being played (and no
+            frames are handled).
+        * frames (int): The number of received frames.
+    """
+    def __init__(self, max_steps=pproto.MAX_STEPS, repetition_seconds=0.001,
+                 wait_seconds=0.001, corrupt_every=0, drop_replies=()):
+        self.max_steps = max_steps
+        self.repetition_seconds = repetition_seconds
+        self.wait_seconds = wait_seconds
+        self.corrupt_every = corrupt_every
+        self.drop_replies = set(drop_replies)
+        self.tables = [[], []]
+        self.active = 0
+        self.generation = 0
+        self.repetitions = 0
+        self.playing = False
+        self.frames = 0
+        self.port = None
+        self._back = bytearray()
+        self._loading_length = None  # `None` unless loading
+        self._loading_crc = 0
+        self._decoder = pproto.FrameDecoder()
+        self._fds = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def handle(self, frame):
+        """Handle a received `Frame`.
+
+        Returns:
+            * bytes reply: The reply frame.
+        """
+        self.frames += 1
+        if not frame.valid or (self.corrupt_every
+                               and self.frames % self.corrupt_every == 0):
+            return self._nak(frame, pproto.ERR_CRC)
+        payload = frame.payload
+        if frame.kind == pproto.INFO:
+            return self._reply(frame, struct.pack("<BBHI", pproto.VERSION,
+                                                  2, pproto.MAX_PAYLOAD,
+                                                  self.max_steps))
+        if frame.kind == pproto.BEGIN:
+            if len(payload) != 8:
+                return self._nak(frame, pproto.ERR_LENGTH)
+            length, crc = struct.unpack("<II", payload)
+            if not 0 < length <= self.max_steps:
+                return self._nak(frame, pproto.ERR_RANGE)
+            self._loading_length, self._loading_crc = length, crc
+            self._back = bytearray(8 * length)
+            return self._reply(frame)
+        if frame.kind == pproto.DATA:
+            if self._loading_length is None:
+                return self._nak(frame, pproto.ERR_STATE)
+            if len(payload) < 4 or (len(payload) - 4) % 8:
+                return self._nak(frame, pproto.ERR_LENGTH)
+            offset = struct.unpack_from("<I", payload)[0]
+            count = (len(payload) - 4) // 8
+            if offset > self._loading_length \
+                    or count > self._loading_length - offset:
+                return self._nak(frame, pproto.ERR_RANGE)
+            self._back[8 * offset:8 * offset + len(payload) - 4] = \
+                payload[4:]
+            return self._reply(frame)
+        if frame.kind == pproto.COMMIT:
+            if self._loading_length is None:
+                return self._nak(frame, pproto.ERR_STATE)
+            if zlib.crc32(self._back) != self._loading_crc:
+                return self._nak(frame, pproto.ERR_TABLE_CRC)
+            words = struct.unpack(f"<{2 * self._loading_length}I",
+                                  self._back)
+            back = 1 - self.active
+            self.tables[back] = list(zip(words[::2], words[1::2]))
+            self.active = back
+            self._loading_length = None
+            self.generation += 1
+            self.repetitions = 0
+            return self._reply(frame, struct.pack("<I", self.generation))
+        if frame.kind == pproto.STATUS:
+            return self._reply(frame, struct.pack(
+                "<IIIB", self.generation, self.repetitions,
+                len(self.tables[self.active]),
+                self._loading_length is not None))
+        return self._nak(frame, pproto.ERR_KIND)
+
+    def _reply(self, frame, payload=b""):
+        return pproto.encode_frame(frame.kind | pproto.REPLY, frame.seq,
+                                   payload)
+
+    def _nak(self, frame, error):
+        return pproto.encode_frame(pproto.NAK, frame.seq, bytes([error]))
+
+    def feed(self, data):
+        """Handle received bytes.
+
+        Returns:
+            * bytes replies: The replies to the frames completed by `data`.
+        """
+        replies = []
+        for frame in self._decoder.feed(data):
+            reply = self.handle(frame)
+            if frame.kind in self.drop_replies:
+                self.drop_replies.discard(frame.kind)
+            else:
+                replies.append(reply)
+        return b"".join(replies)
+
+    def start(self):
+        """Open the pseudo-terminal and serve it from a thread.
+
+        Returns:
+            * str port: The pseudo-terminal (see `port`).
+        """
+        import tty
+
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self._fds = master, slave
+        self.port = os.ttyname(slave)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self.port
+
+    def _serve(self):
+        master = self._fds[0]
+        while not self._stop.is_set():
+            # Waiting between the repetitions, polling for the frames
+            # (see `poll_serial` in the firmware).
+            deadline = time.monotonic() + self.wait_seconds
+            while not self._stop.is_set():
+                remaining = deadline - time.monotonic()
+                if select.select([master], [], [],
+                                 min(max(remaining, 0), 0.05))[0]:
+                    if not self._poll(master):
+                        return
+                if remaining <= 0:
+                    break
+            if self.tables[self.active]:
+                # Playing, with the interrupts disabled.
+                self.playing = True
+                self._stop.wait(self.repetition_seconds)
+                self.repetitions += 1
+                self.playing = False
+
+    def _poll(self, master):
+        # Read and handle at most a frame (and its framing) of bytes.
+        # Returns `False` once the pseudo-terminal was closed.
+        try:
+            data = os.read(master, pproto.MAX_PAYLOAD + 10)
+        except OSError:
+            return False
+        replies = self.feed(data)
+        if replies:
+            os.write(master, replies)
+        return True
+
+    def close(self):
+        """Stop serving and close the pseudo-terminal."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._fds is not None:
+            for fd in self._fds:
+                os.close(fd)
+            self._fds = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def main():
+    device = PlayerEmulator()
+    print(f"Resident player emulated on {device.start()} "
+          "(Ctrl+C to stop).")
+    try:
+        while True:
+            time.sleep(1)
+            print(f"generation {device.generation}, "
+                  f"{len(device.tables[device.active])} steps, "
+                  f"{device.repetitions} repetitions")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,68 @@ Radim Hošák <hosak(at)optics.upol.cz>
 2021 Quantum Optics Lab Olomouc
 """
 
+import re
+import warnings
+
+from array import array
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
 from functools import reduce
+from operator import add, index, itemgetter
+
+from pulsebox.codeblocks import state_change, loop, repeat, \
+                                channel_states_to_mask, channel_mask_to_odsr, \
+                                mask_to_channel_states
+from pulsebox import config, profiling
+
+# All times in pulsebox are integer numbers of ticks (picoseconds).
+TICKS_PER_SECOND = 10**12
+
+
+def _timebase(cfg):
+    """The values of the configuration `cfg` needed for time conversions
+    (see `config.Config.derived`):
+
+        * int calibration_ticks: The calibration constant, quantized
+            to ticks exactly once, here.
+        * dict time_factors: Ticks per time unit, as (numerator, denominator)
+            pairs. See `read_time`.
+    """
+    calibration_ticks = round(cfg.calibration * TICKS_PER_SECOND)
+    time_factors = {
+        "n": (TICKS_PER_SECOND // 10**9, 1),
+        "u": (TICKS_PER_SECOND // 10**6, 1),
+        "m": (TICKS_PER_SECOND // 10**3, 1),
+        "s": (TICKS_PER_SECOND, 1),
+        "c": (TICKS_PER_SECOND, cfg.clock_frequency),
+        "i": (calibration_ticks, 1)
+    }
+    return calibration_ticks, time_factors
+
+def _calibration_ticks():
+    return config.current().derived(_timebase)[0]
+
+def _time_factors():
+    return config.current().derived(_timebase)[1]
 
-from pulsebox.codeblocks import state_change, loop, channel_states_to_odsr
-from pulsebox.config import calibration, pulsebox_pincount
+def __getattr__(name):
+    # The calibration constant (in ticks) follows the current configuration.
+    if name == "calibration_ticks":
+        return _calibration_ticks()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# A single event of an event string: either a well-formed pulse with plain
+# decimal times (the start and the duration, number and unit), or anything
+# else.
+_PLAIN_TIME = r"(\d+\.?\d*|\.\d+)([nusmci])"
+_EVENT_RE = re.compile(rf"[pP]{_PLAIN_TIME}{_PLAIN_TIME}(?!\S)|(\S+)")
+# Long event strings of plain pulses only are read by NumPy, if installed
+# (see `_read_plain_pulses_numpy`).
+_NUMPY_MIN_LENGTH = 10000
+# The latest time of an event, in ticks (`FlipTable.timestamps` are 64-bit).
+_MAX_TICKS = 2**63 - 1
+_TIME = r"([^a-zA-Z]*(?:[eE][+-]?\d+)?[a-zA-Z])"
+_PULSE_RE = re.compile(rf"[pP]{_TIME}(.+)")
+_TRAIN_RE = re.compile(rf"[tT]{_TIME}{_TIME}{_TIME}[xX](\d+)")
 
 
 class DelayEvent():
@@ -23,7 +81,7 @@ class DelayEvent():
         elif duration:
             iters = time2iters(duration)
         elif iters:
-            duration = calibration * iters
+            duration = _calibration_ticks() * iters
 
         codeblock = loop(iters, loop_suffix)
 
@@ -31,34 +89,87 @@ class DelayEvent():
         self.iters = iters
         self.loop_suffix = loop_suffix
         self.codeblock = codeblock
+        self.flash_bytes = config.current().flash_loop_bytes
 
     def from_time_string(self):
         duration = read_time(time_string)
         __init__(self, duration)
 
     def __repr__(self):
-        return f"Delay: {self.duration} s " \
+        return f"Delay: {ticks2seconds(self.duration)} s " \
                f"({self.iters} iters)"
 
 
 class StateChangeEvent():
-    def __init__(self, channel_states):
-        odsr = channel_states_to_odsr(channel_states)
-        codeblock = state_change(odsr_value=odsr)
-        
-        self.channel_states = channel_states
+    """A change of the pulsebox channel states.
+
+    Args:
+        * channel_states (list or int): The channel states (1 or 0),
+            or a channel mask (see `codeblocks.channel_states_to_mask`).
+
+    Kwargs:
+        * odsr (int): The corresponding value of `REG_PIOC_ODSR`,
+            if already known (see `codeblocks.channel_masks_to_odsr`).
+
+    The state is kept as integers. It is formatted into code only when
+    `codeblock` is needed.
+    """
+    def __init__(self, channel_states, odsr=None):
+        if isinstance(channel_states, int):
+            channel_mask = channel_states
+        else:
+            channel_mask = channel_states_to_mask(channel_states)
+        if odsr is None:
+            odsr = channel_mask_to_odsr(channel_mask)
+
+        self.channel_mask = channel_mask
         self.odsr = odsr
-        self.codeblock = codeblock
+        self.flash_bytes = config.current().flash_state_change_bytes
+
+    @property
+    def channel_states(self):
+        return mask_to_channel_states(self.channel_mask)
+
+    @property
+    def codeblock(self):
+        return state_change(odsr_value=self.odsr)
 
     def __repr__(self):
         # msg = "Pulsebox state change: \n"
         msg = "State change: "
-        for channel, state in enumerate(self.channel_states):
+        channel_states = self.channel_states
+        for channel, state in enumerate(channel_states):
             msg += f"{state}"
-            if channel % 4 == 3 and (channel + 1) < pulsebox_pincount:
+            if channel % 4 == 3 and (channel + 1) < len(channel_states):
                 msg +="."
             # msg += f"\tCH{channel}: {state}"
-        msg += f" ({self.odsr})"
+        msg += f" ({bin(self.odsr)})"
+        return msg
+
+
+class RepeatEvent():
+    """A block of low-level events repeated using a counted loop.
+    
+    The overhead of the counted loop (see `repeat_overhead_cycles`
+    in config.ini) is expected to have been already subtracted
+    from the delays in `events`.
+    """
+    def __init__(self, events, count, loop_suffix="0"):
+        self.events = events
+        self.count = count
+        self.loop_suffix = loop_suffix
+        self.flash_bytes = config.current().flash_repeat_bytes \
+                           + sum(event.flash_bytes for event in events)
+
+    @property
+    def codeblock(self):
+        body = "\n".join([event.codeblock for event in self.events])
+        return repeat(self.count, body, self.loop_suffix)
+
+    def __repr__(self):
+        msg = f"Repeat {self.count}x:"
+        for event in self.events:
+            msg += "\n\t\t" + repr(event).replace("\n", "\n\t")
         return msg
 
 
@@ -67,12 +178,73 @@ class PulseEvent():
         self.channel = channel
         self.timestamp = timestamp
         self.duration = duration
-        self.flips = [FlipEvent(channel, timestamp=timestamp),
-                      FlipEvent(channel, timestamp=(timestamp+duration))]
+
+    @property
+    def flips(self):
+        flips = FlipTable()
+        flips.append_pulse(self.channel, self.timestamp, self.duration)
+        return flips
 
     def __repr__(self):
         return f"Pulse on channel {self.channel} - " \
-               f"start: {self.timestamp} s, duration: {self.duration} s"
+               f"start: {ticks2seconds(self.timestamp)} s, " \
+               f"duration: {ticks2seconds(self.duration)} s"
+
+class PulseTrain():
+    """A train of `count` identical pulses on a single channel.
+
+    The pulses start at `timestamp`, `timestamp + period`, ... and each
+    of them lasts for `width` (all times in ticks). Pulse trains are kept
+    compact (see `FlipTable.trains`), so that a long train costs no more
+    than a single pulse until it is expanded into flips.
+    """
+    def __init__(self, channel, timestamp, width, period, count):
+        if count < 1:
+            raise ValueError("A pulse train needs at least one pulse.")
+        if not 0 < width < period:
+            raise ValueError("The pulse width has to be positive " \
+                             "and shorter than the period.")
+        self.channel = channel
+        self.timestamp = timestamp
+        self.width = width
+        self.period = period
+        self.count = count
+
+    @property
+    def end(self):
+        """The timestamp of the last falling edge."""
+        return self.timestamp + (self.count - 1) * self.period + self.width
+
+    @property
+    def flips(self):
+        """The train expanded into a `FlipTable` of channel flips."""
+        stop = self.timestamp + self.count * self.period
+        flips = FlipTable()
+        flips.timestamps = array(FlipTable.timestamp_typecode, [0]) \
+                           * (2 * self.count)
+        flips.timestamps[0::2] = array(FlipTable.timestamp_typecode,
+                                       range(self.timestamp, stop,
+                                             self.period))
+        flips.timestamps[1::2] = array(FlipTable.timestamp_typecode,
+                                       range(self.timestamp + self.width,
+                                             stop + self.width, self.period))
+        flips.channels = array(FlipTable.channel_typecode, [self.channel]) \
+                         * (2 * self.count)
+        return flips
+
+    def __eq__(self, other):
+        if not isinstance(other, PulseTrain):
+            return NotImplemented
+        return (self.channel, self.timestamp, self.width, self.period,
+                self.count) == (other.channel, other.timestamp, other.width,
+                                other.period, other.count)
+
+    def __repr__(self):
+        return f"Pulse train on channel {self.channel} - " \
+               f"start: {ticks2seconds(self.timestamp)} s, " \
+               f"width: {ticks2seconds(self.width)} s, " \
+               f"period: {ticks2seconds(self.period)} s, " \
+               f"count: {self.count}"
 
 class FlipEvent():
     """The fundamental channel flip event.
@@ -80,7 +252,7 @@ class FlipEvent():
     of pulsebox channel flips.
     """
     def __init__(self, channel, time_string=None, timestamp=None):
-        if not timestamp:
+        if timestamp is None:
             if not time_string:
                 raise ValueError("Neither time string nor timestamp given.")
             timestamp = read_time(time_string)
@@ -88,14 +260,139 @@ class FlipEvent():
         self.timestamp = timestamp
 
     def __repr__(self):
-        return f"Channel {self.channel} flip at {self.timestamp} s"
+        return f"Channel {self.channel} flip at " \
+               f"{ticks2seconds(self.timestamp)} s"
+
+
+class FlipTable():
+    """A compact, columnar table of channel flips.
+
+    Channels and timestamps (in ticks) are stored in two typed arrays
+    instead of a list of `FlipEvent` instances. For compatibility,
+    iterating over the table (or indexing it with an int) yields
+    `FlipEvent` instances, created on the fly.
+
+    Pulse trains are not expanded into flips. They are kept in the `trains`
+    list instead (see `expanded`). The length, iteration and indexing only
+    concern the individual flips.
+
+    The columns may also be read-only memoryviews of the same types,
+    e.g. of a memory-mapped .pbx file (see `pbx`). Such a table can be
+    compiled, but not appended to; its `copy` can.
+    """
+    channel_typecode = "B"  # unsigned char
+    timestamp_typecode = "q"  # signed long long (64 bits)
+
+    def __init__(self, channels=(), timestamps=(), trains=()):
+        self.channels = _typed_array(self.channel_typecode, channels)
+        self.timestamps = _typed_array(self.timestamp_typecode, timestamps)
+        self.trains = list(trains)
+        if len(self.channels) != len(self.timestamps):
+            raise ValueError("Channel and timestamp columns differ in length.")
+
+    @classmethod
+    def from_flips(cls, flips):
+        """Create a table from an iterable of `FlipEvent` instances.
+        """
+        if isinstance(flips, cls):
+            return flips.copy()
+        table = cls()
+        table.extend(flips)
+        return table
+
+    def copy(self):
+        return type(self)(self.channels, self.timestamps, self.trains)
+
+    def expanded(self):
+        """A copy of the table with all the pulse trains expanded to flips.
+        """
+        table = type(self)(self.channels, self.timestamps)
+        for train in self.trains:
+            table.extend(train.flips)
+        return table
+
+    def append(self, flip):
+        self.channels.append(flip.channel)
+        self.timestamps.append(flip.timestamp)
+
+    def append_pulse(self, channel, timestamp, duration):
+        """Append the two flips (rising and falling edge) of a pulse.
+        """
+        self.channels.extend((channel, channel))
+        self.timestamps.extend((timestamp, timestamp + duration))
+
+    def extend(self, flips):
+        """Bulk append, either another `FlipTable` or `FlipEvent`s.
+        """
+        if isinstance(flips, FlipTable):
+            self.channels.extend(flips.channels)
+            self.timestamps.extend(flips.timestamps)
+            self.trains.extend(flips.trains)
+        else:
+            for flip in flips:
+                self.append(flip)
+
+    def sort(self):
+        """Sort the flips by timestamp, in place. The sort is stable.
+        """
+        timestamps = self.timestamps
+        order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+        self.channels = array(self.channel_typecode,
+                              map(self.channels.__getitem__, order))
+        self.timestamps = array(self.timestamp_typecode,
+                                map(timestamps.__getitem__, order))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        for channel, timestamp in zip(self.channels, self.timestamps):
+            yield FlipEvent(channel, timestamp=timestamp)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return type(self)(self.channels[key], self.timestamps[key])
+        return FlipEvent(self.channels[key], timestamp=self.timestamps[key])
+
+    def __add__(self, other):
+        table = self.copy()
+        table.extend(other)
+        return table
+
+    def __radd__(self, other):
+        table = type(self).from_flips(other)
+        table.extend(self)
+        return table
+
+    def __eq__(self, other):
+        if not isinstance(other, FlipTable):
+            return NotImplemented
+        return self.channels == other.channels \
+               and self.timestamps == other.timestamps \
+               and self.trains == other.trains
+
+    def __repr__(self):
+        if self.trains:
+            return f"Flip table ({len(self)} flips, " \
+                   f"{len(self.trains)} pulse trains)"
+        return f"Flip table ({len(self)} flips)"
+
+def _typed_array(typecode, values):
+    # A typed array of `values`. Memoryviews of the same type are copied
+    # in bulk rather than item by item.
+    if isinstance(values, memoryview) and values.format == typecode:
+        typed = array(typecode)
+        typed.frombytes(values.cast("B"))
+        return typed
+    return array(typecode, values)
 
 def read_time(time_string):
     """Calculate time from a string containing a number and a time unit.
     
     The unit is denoted by the last character of `time_string`. Time is
     calculated by multiplying the 'number part' of `time_string` by a factor
-    corresponding to the unit.
+    corresponding to the unit. The calculation is exact (rational) and
+    the result is rounded to the nearest tick only once, at the very end.
     
     The following units are accepted:
 
@@ -103,22 +400,15 @@ def read_time(time_string):
         * u: microseconds (1e-6)
         * m: milliseconds (1e-3)
         * s: seconds (1)
-        * TODO: c: MCU clock cycles (12e-9)
-        * TODO: i: delay loop iterations (see `calibration` in config.ini)
+        * c: MCU clock cycles (1 / `clock_frequency`, see config.ini)
+        * i: delay loop iterations (see `calibration` in config.ini)
     
     Args:
         * time_string (str): The (number + unit) string, for example "1m"
     
     Returns:
-        * float time: Time (in seconds).
+        * int time: Time (in ticks, see `TICKS_PER_SECOND`).
     """
-    factors = {
-        "n": 1e-9,
-        "u": 1e-6,
-        "m": 1e-3,
-        "s": 1
-    }
-    
     # Check that the time string is properly formatted, e. g. time part
     # is followed by the unit part. The string should contain at least two
     # character, otherwise splitting it into two parts will raise an IndexError.
@@ -127,8 +417,13 @@ def read_time(time_string):
     except (IndexError, TypeError):
         raise ValueError("Invalid time string given.")
 
-    # If the 'time part' cannot be converted to float, this raises a ValueError.
-    number = float(number)
+    # If the 'time part' is not a finite number, raise a ValueError.
+    try:
+        number = Decimal(number)
+    except InvalidOperation:
+        raise ValueError("Invalid time string given.")
+    if not number.is_finite():
+        raise ValueError("Invalid time string given.")
     
     if number < 0:
         raise ValueError("Negative time values are not allowed.")
@@ -137,18 +432,194 @@ def read_time(time_string):
     # then what we call 'unit' will in fact be the last digit of the time value
     # and as we do not use numeric unit symbols, we still get an error.
     try:
-        factor = factors[unit]
+        factor_numerator, factor_denominator = _time_factors()[unit]
     except KeyError:
         raise ValueError("Invalid time unit given.")
 
-    time = number * factor
-    return time
+    numerator, denominator = number.as_integer_ratio()
+    return _divide_half_even(numerator * factor_numerator,
+                             denominator * factor_denominator)
+
+def format_time(ticks):
+    """Format time (in ticks) as a time string that `read_time` reads back
+    exactly, in the largest of the units s, m, u, n that is not longer
+    than the time (e.g. "1.5u").
+    """
+    if ticks < 0:
+        raise ValueError("Negative time values are not allowed.")
+    for unit, digits in (("s", 12), ("m", 9), ("u", 6), ("n", 3)):
+        if ticks >= 10**digits or unit == "n":
+            break
+    whole, fraction = divmod(ticks, 10**digits)
+    fraction = f"{fraction:0{digits}d}".rstrip("0")
+    return f"{whole}.{fraction}{unit}" if fraction else f"{whole}{unit}"
+
+def _read_plain_time(time_string, time_factors):
+    """A fast `read_time` for a plain decimal number (no sign, no exponent)
+    followed by a valid unit.
+    """
+    number = time_string[:-1]
+    factor_numerator, factor_denominator = time_factors[time_string[-1]]
+    if factor_denominator == 1 and "." not in number:
+        return int(number) * factor_numerator
+    whole, _, fraction = number.partition(".")
+    return _divide_half_even(int(whole + fraction) * factor_numerator,
+                             10**len(fraction) * factor_denominator)
+
+def _read_plain_times(numbers, units, memo):
+    """Convert plain decimal numbers (see `_read_plain_time`) with their
+    units to an array of ticks, in bulk.
 
-def time2iters(time):
+    Integer numbers in a single unit, which is the usual case, are converted
+    without any per-number Python code. Otherwise every distinct time
+    string is converted once and looked up in `memo`.
+    """
+    if len(set(units)) == 1:
+        factor_numerator, factor_denominator = memo.time_factors[units[0]]
+        if factor_denominator == 1 and "." not in "".join(numbers):
+            return array(FlipTable.timestamp_typecode,
+                         map(factor_numerator.__mul__, map(int, numbers)))
+    return array(FlipTable.timestamp_typecode,
+                 map(memo.__getitem__, map(add, numbers, units)))
+
+def _read_plain_pulses_numpy(event_string, time_factors):
+    """Convert an event string of plain pulses only (see `_EVENT_RE`)
+    to the timestamps of its flips (the rising and falling edges
+    interleaved, an `array`), in bulk, using NumPy. All the characters
+    are classified and the numbers are summed up from their digits
+    at once, without any per-pulse Python code.
+
+    Returns `None` (for the general path of `parse_events`) if NumPy is not
+    installed, or if the string has any other event, or a time whose
+    calculation might overflow 64 bits.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        return None
+    try:
+        data = np.frombuffer(event_string.encode("ascii"), dtype=np.uint8)
+    except UnicodeEncodeError:
+        return None
+
+    # The character classes: 1 whitespace (as in `re`), 2 digit, 3 decimal
+    # point, 4 unit, 5 pulse, 0 anything else.
+    classes = np.zeros(256, dtype=np.uint8)
+    classes[[9, 10, 11, 12, 13, 28, 29, 30, 31, 32]] = 1
+    classes[ord("0"):ord("9") + 1] = 2
+    classes[ord(".")] = 3
+    classes[[ord(unit) for unit in "nusmci"]] = 4
+    classes[[ord("p"), ord("P")]] = 5
+    kinds = classes[data]
+    token = kinds != 1
+    if not token.any():
+        return None
+    edges = np.diff(np.concatenate(([False], token, [False])).view(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    # Every token is "p", a number, a unit, a number, a unit.
+    units = np.flatnonzero(kinds == 4)
+    if len(units) != 2 * len(starts) or np.any(kinds[starts] != 5) \
+            or np.any(units[1::2] != ends - 1) \
+            or np.any(units[0::2] <= starts) \
+            or np.count_nonzero(kinds == 5) != len(starts) \
+            or np.count_nonzero(kinds == 0):
+        return None
+    # The numbers, from `number_starts` to their units (exclusive).
+    number_starts = np.empty(len(units), dtype=np.int64)
+    number_starts[0::2] = starts + 1
+    number_starts[1::2] = units[0::2] + 1
+    # The numbers of digits and decimal points of every number
+    # (`reduceat` sums up to the next index, so every other sum is left
+    # out).
+    bounds = np.empty(2 * len(units), dtype=np.int64)
+    bounds[0::2], bounds[1::2] = number_starts, units
+    digit = kinds == 2
+    digit_counts = np.add.reduceat(digit, bounds, dtype=np.int64)[0::2]
+    points = np.flatnonzero(kinds == 3)
+    point_counts = np.add.reduceat(kinds == 3, bounds,
+                                   dtype=np.int64)[0::2]
+    if np.any(digit_counts < 1) or np.any(digit_counts > 18) \
+            or np.any(point_counts > 1):
+        return None
+
+    # Every digit times its power of ten within its number (the digits
+    # of the number after it), summed up.
+    lasts = np.cumsum(digit_counts) - 1  # the last digit of every number
+    exponents = np.repeat(lasts, digit_counts) \
+                - np.arange(lasts[-1] + 1)
+    powers = 10**np.arange(19, dtype=np.int64)
+    terms = (data[digit] - ord("0")) * powers[exponents]
+    mantissas = np.add.reduceat(terms, lasts - digit_counts + 1)
+    decimals = np.zeros(len(units), dtype=np.int64)
+    pointed = np.flatnonzero(point_counts)
+    if len(pointed):
+        bounds = np.empty(2 * len(pointed), dtype=np.int64)
+        bounds[0::2], bounds[1::2] = points + 1, units[pointed]
+        decimals[pointed] = np.add.reduceat(digit, bounds,
+                                            dtype=np.int64)[0::2]
+
+    # The exact rational value of the unit factor, rounded half to even
+    # once (see `_read_plain_time`).
+    unit_chars = data[units]
+    numerators = np.zeros(256, dtype=np.int64)
+    denominators = np.ones(256, dtype=np.int64)
+    for unit, (numerator, denominator) in time_factors.items():
+        numerators[ord(unit)], denominators[ord(unit)] = numerator, \
+                                                         denominator
+    numerators, denominators = numerators[unit_chars], \
+                               denominators[unit_chars]
+    limit = np.iinfo(np.int64).max
+    if np.any(mantissas > limit // numerators) \
+            or np.any(decimals > np.log10(limit / denominators) - 1):
+        return None
+    numerators *= mantissas
+    denominators *= 10**decimals
+    times, remainders = np.divmod(numerators, denominators)
+    times += (2 * remainders > denominators) \
+             | ((2 * remainders == denominators) & (times % 2 == 1))
+    starts, durations = times[0::2], times[1::2]
+    if np.any(starts > limit - durations):
+        return None
+    times[1::2] += starts
+    return array(FlipTable.timestamp_typecode, times.tobytes())
+
+def _divide_half_even(numerator, denominator):
+    """Integer division, rounding half to even (like the built-in `round`).
+    """
+    quotient, remainder = divmod(numerator, denominator)
+    if 2 * remainder > denominator \
+            or (2 * remainder == denominator and quotient % 2 == 1):
+        quotient += 1
+    return quotient
+
+def ticks2seconds(ticks):
+    """Convert time in ticks to (float) seconds. Meant for display only.
+    """
+    return ticks / TICKS_PER_SECOND
+
+def repeat_overhead_iters():
+    """The overhead of one counted loop repetition in delay loop iterations.
+    """
+    cycles = config.current().repeat_overhead_cycles
+    return time2iters(read_time(f"{cycles}c"))
+
+def cycles2ticks(cycles):
+    """Convert a number of MCU clock cycles to ticks.
+    """
+    return _divide_half_even(cycles * TICKS_PER_SECOND,
+                             config.current().clock_frequency)
+
+def time2iters(time, calibration_ticks=None):
     """Get the number of loop iterations required to achieve a given time delay.
     
     Args:
-        * time (float): The time to convert to the number of delay loop iters.
+        * time (int): The time (in ticks) to convert
+            to the number of delay loop iters.
+
+    Kwargs:
+        * calibration_ticks (int): The calibration constant (in ticks).
+            Default: See `calibration` in config.ini.
 
     Returns:
         * int iters: The number of iterations through the ASM delay loop
@@ -165,36 +636,369 @@ def time2iters(time):
         required. As this is impossible, we round this to the nearest integer
         amount of iterations. In this case, that's 2 iterations and instead of
         120 ns delay we produced a 100 ns delay.
+
+        To avoid accumulating rounding errors, convert absolute timestamps
+        and take differences of the results, rather than converting
+        the individual delays.
     """
     if time < 0:
         raise ValueError("Negative time is not allowed.")
-    iters = int(round(time / calibration))
-    return iters
+    if calibration_ticks is None:
+        calibration_ticks = _calibration_ticks()
+    return int(_divide_half_even(time, calibration_ticks))
+
+
+class TimingWarning(UserWarning):
+    """An edge of a sequence cannot be produced at its requested time."""
+
+
+class TimingModel():
+    """A cycle-accurate model of the timing of the generated code.
 
+    Besides the delay loop iterations (see `calibration` in config.ini),
+    every `REG_PIOC_ODSR` write, every delay loop setup and every counted
+    loop repetition takes a fixed number of MCU clock cycles (see
+    the `Timing` section of config.ini). The model keeps track of the
+    expected time, with the fixed costs and the delay loop iterations
+    accumulated separately, so that the delays can be quantized from
+    absolute times (without accumulating rounding errors).
 
-def parse_events(event_string, channel=None):
-    """Convert a long string of events into an array of event instances.
+    The time origin is the end of the first `REG_PIOC_ODSR` write,
+    if there is no delay before it.
+
+    The table-driven player (see `codeblocks.player`) is modelled the same
+    way: every step costs `table_step_cycles` (as if it were the write),
+    followed by the delay loop iterations.
+
+    Kwargs:
+        * cfg (config.Config): The configuration.
+            Default: The current configuration.
+        * codegen (str): "unrolled" or "table" (see `codegen`
+            in config.ini).
+            Default: "unrolled"
     """
-    event_substrings = event_string.split(" ")
-    events = []
-    for substring in event_substrings:
+    def __init__(self, cfg=None, codegen="unrolled"):
+        cfg = cfg if cfg else config.current()
+        if codegen not in ("unrolled", "table"):
+            raise ValueError(f"Unknown code generation mode: {codegen!r}.")
+        with cfg:
+            self.calibration_ticks = _calibration_ticks()
+            if codegen == "table":
+                self.write_ticks = cycles2ticks(cfg.table_step_cycles)
+                self.loop_ticks = 0
+            else:
+                self.write_ticks = cycles2ticks(cfg.state_change_cycles)
+                self.loop_ticks = cycles2ticks(cfg.loop_overhead_cycles)
+            self.repeat_ticks = cycles2ticks(cfg.repeat_overhead_cycles)
+        self.violations = cfg.timing_violations
+        if self.violations not in ("ignore", "warn", "error"):
+            raise ValueError("Unknown timing_violations setting: " \
+                             f"{self.violations!r}.")
+        self.overhead = -self.write_ticks  # the fixed costs so far
+        self.iters = 0  # the delay loop iterations so far
+
+    @property
+    def ideal(self):
+        """Whether the state changes and the delay loop setup are free,
+        i.e. the delays are just the quantized differences of timestamps.
+        """
+        return self.write_ticks == 0 and self.loop_ticks == 0
+
+    @property
+    def edge_iters(self):
+        """The cost of an edge (a delay loop setup and a state change),
+        rounded to delay loop iterations.
+        """
+        return time2iters(self.write_ticks + self.loop_ticks,
+                          self.calibration_ticks)
+
+    @property
+    def time(self):
+        """The expected time (in ticks)."""
+        return self.overhead + self.iters * self.calibration_ticks
+
+    def delay_iters(self, timestamp):
+        """The delay loop iterations needed before the next `REG_PIOC_ODSR`
+        write, so that it ends as close to `timestamp` as possible.
+        0 means that no delay is needed (or possible).
+        """
+        available = timestamp - self.overhead - self.write_ticks \
+                    - self.loop_ticks
+        if available < 0:
+            return 0
+        return max(time2iters(available, self.calibration_ticks) - self.iters,
+                   0)
+
+    def delay(self, iters):
+        self.overhead += self.loop_ticks
+        self.iters += iters
+
+    def write(self):
+        self.overhead += self.write_ticks
+
+    def run(self, events):
+        """Advance the time through a list of low-level events.
+        """
+        for event in events:
+            if isinstance(event, DelayEvent):
+                self.delay(event.iters)
+            elif isinstance(event, StateChangeEvent):
+                self.write()
+            elif isinstance(event, RepeatEvent):
+                overhead, iters = self.overhead, self.iters
+                self.overhead, self.iters = 0, 0
+                self.run(event.events)  # a single repetition
+                self.overhead = overhead + event.count \
+                                * (self.repeat_ticks + self.overhead)
+                self.iters = iters + event.count * self.iters
+
+    def edge_times(self, events):
+        """Yield the expected times of the edges (the `REG_PIOC_ODSR` writes
+        that change the state) of a list of low-level events, advancing
+        the time. The repeated blocks are expanded.
+        """
+        for time, _ in self.edges(events):
+            yield time
+
+    def edges(self, events):
+        """Like `edge_times`, but yield (time, ODSR value) pairs.
+        """
+        yield from self._edges(events, [0])
+
+    def _edges(self, events, odsr):
+        # `odsr` holds the current value of `REG_PIOC_ODSR`.
+        for event in events:
+            if isinstance(event, RepeatEvent):
+                for _ in range(event.count):
+                    self.overhead += self.repeat_ticks
+                    yield from self._edges(event.events, odsr)
+            elif isinstance(event, StateChangeEvent):
+                self.write()
+                if event.odsr != odsr[0]:
+                    odsr[0] = event.odsr
+                    yield self.time, event.odsr
+            else:
+                self.run([event])
+
+    def plan(self, timestamps):
+        """Plan the delays before the edges at the given (sorted, distinct)
+        timestamps, advancing the time past the last edge.
+
+        An edge is late if it ends more than half a delay loop iteration
+        after its requested time, i.e. if the requested spacing is below
+        what the hardware can do. Late edges are ignored, reported with
+        a `TimingWarning` or rejected with a `ValueError`, depending
+        on `timing_violations` in config.ini.
+
+        Returns:
+            * list iters: The delay loop iterations before every edge.
+        """
+        planned = []
+        late = []
+        for timestamp in timestamps:
+            iters = self.delay_iters(timestamp)
+            if iters > 0:
+                self.delay(iters)
+            self.write()
+            planned.append(iters)
+            if 2 * (self.time - timestamp) > self.calibration_ticks:
+                late.append(timestamp)
+        if late and self.violations != "ignore":
+            msg = f"{len(late)} edge(s) cannot be produced in time, " \
+                  f"the first one at {ticks2seconds(late[0])} s. " \
+                  "The requested spacing is below the physical minimum."
+            if self.violations == "error":
+                raise ValueError(msg)
+            warnings.warn(msg, TimingWarning, stacklevel=2)
+        return planned
+
+
+class EventParseError(ValueError):
+    """Invalid events in an event string.
+
+    All the invalid events are collected in `errors`, as (column, event,
+    message) tuples, the column being the 1-based position of the event
+    in the event string.
+    """
+    def __init__(self, errors, channel=None):
+        self.errors = errors
+        self.channel = channel
+        lines = [f"column {column}: {event!r}: {message}"
+                 for column, event, message in errors]
+        super().__init__(f"CH {channel} - Invalid events:\n   "
+                         + "\n   ".join(lines))
+
+
+class _TimeMemo(dict):
+    """Converted time strings, each one converted only once."""
+    def __init__(self):
+        self.time_factors = _time_factors()
+
+    def __missing__(self, time_string):
+        time = self[time_string] = _read_plain_time(time_string,
+                                                    self.time_factors)
+        return time
+
+
+def _check_end(end):
+    """Raise a `ValueError` unless an event ending at `end` (in ticks) fits
+    the 64-bit timestamps.
+    """
+    if end > _MAX_TICKS:
+        raise ValueError(f"The event ends too late (the latest possible "
+                         f"time is {ticks2seconds(_MAX_TICKS):.0f} s).")
+
+def _read_event(event, channel=None):
+    """Read an event that does not match the fast path of `parse_events`.
+
+    Returns the (start, duration) tuple of a pulse or a `PulseTrain`.
+    Raises a `ValueError` describing the problem if the event is invalid.
+    """
+    event_type = event[0].lower()
+    if event_type == "p":
+        match = _PULSE_RE.fullmatch(event)
+        if match is None:
+            raise ValueError("A pulse needs a start time and a duration.")
+        start, duration = read_time(match.group(1)), \
+                          read_time(match.group(2))
+        _check_end(start + duration)
+        return start, duration
+    if event_type == "t":
+        match = _TRAIN_RE.fullmatch(event)
+        if match is None:
+            raise ValueError("A pulse train needs a start time, a pulse " \
+                             "width, a period and a count (e.g. t1u2u10ux5).")
+        start, width, period = map(read_time, match.groups()[:3])
+        train = PulseTrain(channel, start, width, period,
+                           int(match.group(4)))
+        _check_end(train.end)
+        return train
+    raise ValueError(f"Unknown event type {event[0]!r}.")
+
+
+def _locate_errors(event_string, channel=None):
+    """Collect all the invalid events of an event string (with their
+    columns) into an `EventParseError`.
+    """
+    errors = []
+    memo = _TimeMemo()
+    for match in _EVENT_RE.finditer(event_string):
+        start, start_unit, duration, duration_unit, other = match.groups()
         try:
-            event_type, event_params = substring[0], substring[1:]
-        except (IndexError, ValueError):
-            print(f"CH {channel} - Invalid event string: " \
-                  f"{event_string.__repr__()}")
-            return events
-        if event_type.lower() == "p":  # PulseEvent
-            # Pulse event contains two timestrings - start and duration.
-            # Separate them.
-            timestamp, duration = None, None
-            for n, ch in enumerate(event_params):
-                if ch.isalpha():
-                    timestamp = read_time(event_params[:n+1])
-                    duration = read_time(event_params[n+1:])
-                    break
-            pe = PulseEvent(channel, timestamp, duration)
-            new_events = pe.flips
-        for event in new_events:
-            events.append(event)
-    return events
+            if other:
+                _read_event(other, channel)
+            else:
+                _check_end(memo[start + start_unit]
+                           + memo[duration + duration_unit])
+        except ValueError as e:
+            errors.append((match.start() + 1, match.group(), str(e)))
+    return EventParseError(errors, channel)
+
+
+def _check_channel(channel):
+    """Raise a `ValueError` unless `channel` is a pulsebox channel number.
+    """
+    pincount = config.current().pulsebox_pincount
+    if isinstance(channel, bool):
+        channel = None  # not a channel number, although an int
+    try:
+        channel = index(channel)
+    except TypeError:
+        raise ValueError(f"Invalid channel: {channel!r}.") from None
+    if not 0 <= channel < pincount:
+        raise ValueError(f"Invalid channel: {channel} (the pulsebox has "
+                         f"{pincount} channels).")
+    return channel
+
+def parse_events(event_string, channel):
+    """Convert a long string of events into a `FlipTable` of channel flips.
+
+    The events are separated by whitespace. The following events exist:
+
+        * "p<start><duration>", a pulse. It yields two flips, its rising
+            and falling edge. For example "p1u3u".
+        * "t<start><width><period>x<count>", a train of `count` pulses.
+            It is kept compact, in the `trains` of the table (see
+            `PulseTrain`). For example "t1u2u10ux1000".
+
+    The whole string is tokenized in one pass and the times of the pulses
+    are converted in bulk. Long strings of plain pulses (the usual case)
+    are read by NumPy, if it is installed, a million pulses in well under
+    a second. The pure Python path takes about two seconds for those,
+    most of it in the tokenizer regex.
+
+    Args:
+        * event_string (str): The events, for example "p1u3u p5u2u".
+        * channel (int): The channel of the flips (0 to the number
+            of channels - 1, see `pulsebox_pins` in config.ini).
+
+    Returns:
+        * FlipTable flips
+
+    Raises:
+        * EventParseError: If any of the events is invalid. All the invalid
+            events are reported at once.
+        * ValueError: If the channel is invalid.
+    """
+    channel = _check_channel(channel)
+    with profiling.stage("parse_events") as stage:
+        flips = _parse_events(event_string, channel)
+        stage.items = len(flips.timestamps)
+    return flips
+
+def _parse_events(event_string, channel):
+    if len(event_string) >= _NUMPY_MIN_LENGTH:
+        timestamps = _read_plain_pulses_numpy(event_string,
+                                              _time_factors())
+        if timestamps is not None:
+            flips = FlipTable()
+            flips.timestamps = timestamps
+            flips.channels = array(FlipTable.channel_typecode, [channel]) \
+                             * len(timestamps)
+            return flips
+    tokens = _EVENT_RE.findall(event_string)
+    others = [*filter(None, map(itemgetter(4), tokens))]
+    other_starts, other_durations, trains = [], [], []
+    if others:
+        # Events other than plain pulses are rare, so they are read
+        # one by one. Only if one of them is invalid, the whole string
+        # is scanned again to locate all the invalid events.
+        tokens = [token for token in tokens if not token[4]]
+        try:
+            for other in others:
+                event = _read_event(other, channel)
+                if isinstance(event, PulseTrain):
+                    trains.append(event)
+                else:
+                    other_starts.append(event[0])
+                    other_durations.append(event[1])
+        except ValueError:
+            raise _locate_errors(event_string, channel) from None
+
+    memo = _TimeMemo()
+    flips = FlipTable(trains=trains)
+    try:
+        if tokens:
+            columns = [[*map(itemgetter(n), tokens)] for n in range(4)]
+            starts = _read_plain_times(columns[0], columns[1], memo)
+            durations = _read_plain_times(columns[2], columns[3], memo)
+        else:
+            starts = array(FlipTable.timestamp_typecode)
+            durations = array(FlipTable.timestamp_typecode)
+        starts.extend(other_starts)
+        durations.extend(other_durations)
+        ends = array(FlipTable.timestamp_typecode,
+                     map(add, starts, durations))
+    except OverflowError:
+        # A plain pulse ends too late (the others are checked when read).
+        raise _locate_errors(event_string, channel) from None
+
+    # Interleave the rising and falling edges.
+    if starts:
+        flips.timestamps = array(FlipTable.timestamp_typecode, [0]) \
+                           * (2 * len(starts))
+        flips.timestamps[0::2] = starts
+        flips.timestamps[1::2] = ends
+        flips.channels = array(FlipTable.channel_typecode, [channel]) \
+                         * len(flips.timestamps)
+    return flips
@@ -8,18 +8,29 @@ Radim Hošák <hosak(at)optics.upol.cz>
 2021 Quantum Optics Lab Olomouc
 """
 
-import csv
-
 import gi
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk, Gio
+from gi.repository import Gtk, Gio, GLib
 
 import os
+import subprocess
+
+from concurrent.futures import CancelledError
+from contextlib import contextmanager
 
+import pulsebox.arduino as pard
 import pulsebox.config as pcfg
 import pulsebox.events as pev
+import pulsebox.io as pio
+import pulsebox.pipeline as ppl
+import pulsebox.profiling as pprof
 import pulsebox.sequences as pseq
 
+# Live parsing starts this long after the last change of the entries.
+LIVE_PARSE_DELAY_MS = 200
+# The number of events shown in the live preview.
+LIVE_PREVIEW_EVENTS = 1000
+
 
 class ChannelEntry(Gtk.Entry):
     def __init__(self, channel):
@@ -45,6 +56,8 @@ class PulseboxToolbar(Gtk.Toolbar):
         # self.quick_upload_button = Gtk.ToolButton(label="Quick upload")
         self.make_ino_button = Gtk.ToolButton(label="Make .ino")
         self.config_button = Gtk.ToolButton(label="Configure")
+        self.cancel_button = Gtk.ToolButton(label="Cancel")
+        self.cancel_button.set_sensitive(False)
 
         # self.insert(self.load_seq_button, -1)
         # self.insert(self.save_seq_button, -1)
@@ -53,6 +66,8 @@ class PulseboxToolbar(Gtk.Toolbar):
         # self.insert(self.quick_upload_button, -1)
         self.insert(self.make_ino_button, -1)
         self.insert(self.config_button, -1)
+        self.insert(Gtk.SeparatorToolItem(), -1)
+        self.insert(self.cancel_button, -1)
 
         # self.pack_start(self.parse_seq_button, False, False, 0)
 
@@ -103,6 +118,19 @@ class MainWindow(Gtk.Window):
         self.toolbar.parse_seq_button.connect("clicked", self.parse_seq)
         self.toolbar.make_ino_button.connect("clicked", self.make_ino)
         self.toolbar.config_button.connect("clicked", self.config)
+        self.toolbar.cancel_button.connect("clicked", self.cancel)
+
+        # Parsing, compiling and uploading run in a background thread.
+        # The results are handed back to the GTK main loop by `idle_add`.
+        self.pipeline = ppl.Pipeline(post=GLib.idle_add)
+
+        # Live parsing: the parsed flips of every channel are cached, and
+        # a change of the entries is only parsed once the typing stops.
+        self.flip_cache = ppl.FlipCache()
+        self.live_parse_source = None
+        # Compiled sequences are cached as well, so going back to a previous
+        # version of the sequence (e.g. by undoing an edit) is instant.
+        self.compile_cache = pseq.CompileCache()
 
         self.hpaned = Gtk.HPaned()
         self.hpaned.set_position(400)
@@ -178,6 +206,20 @@ class MainWindow(Gtk.Window):
                                                self.channel_entries) \
                 if toggle.get_active() == True]
 
+    @contextmanager
+    def entry_changes_blocked(self):
+        """Do not call `set_entry_changed` on changes of the channel
+        toggles and entries (e.g. when loading a sequence).
+        """
+        widgets = self.channel_toggles + self.channel_entries
+        for widget in widgets:
+            widget.handler_block_by_func(self.set_entry_changed)
+        try:
+            yield
+        finally:
+            for widget in widgets:
+                widget.handler_unblock_by_func(self.set_entry_changed)
+
     def unset_entry_changed(self):
         self.entry_changed = False
         self.toolbar.parse_seq_button.set_sensitive(False)
@@ -186,6 +228,24 @@ class MainWindow(Gtk.Window):
         self.entry_changed = True
         self.toolbar.parse_seq_button.set_sensitive(True)
 
+        # (Re)start the debounce timer of the live parsing.
+        if self.live_parse_source is not None:
+            GLib.source_remove(self.live_parse_source)
+        self.live_parse_source = GLib.timeout_add(LIVE_PARSE_DELAY_MS,
+                                                  self.live_parse)
+
+    def live_parse(self):
+        # Do not interrupt a running upload etc., try again later instead.
+        job = self.pipeline.job
+        if job is not None and job.action != "preview":
+            return True
+        self.live_parse_source = None
+        job = ppl.PipelineJob(self.get_channel_texts(), action="preview",
+                              flip_cache=self.flip_cache,
+                              compile_cache=self.compile_cache)
+        self.run_job(job, self.show_sequence)
+        return False  # do not repeat
+
     def load_seq(self, widget):
         dialog = Gtk.FileChooserDialog(
             title="Load sequence file",
@@ -206,17 +266,25 @@ class MainWindow(Gtk.Window):
         src_file = dialog.get_filename()
         dialog.destroy()
 
-        for toggle in self.channel_toggles:
-            toggle.set_active(False)
-
-        with open(src_file, "r") as f:
-            reader = csv.reader(f)
-            for row in reader:
-                ch, entry = int(row[0]), " ".join(row[1:])
-                print(ch, type(ch))
-                print(entry, type(entry))
-                self.channel_entries[ch].set_text(entry)
-                self.channel_toggles[ch].set_active(True)
+        try:
+            channel_texts = pio.load_channel_texts(src_file)
+        except (ValueError, OSError, ImportError) as e:
+            self.statusbar.push(0, f"Error: {e}")
+            return
+        for channel, _ in channel_texts:
+            if not 0 <= channel < len(self.channel_entries):
+                self.statusbar.push(0, f"Error: No channel {channel}.")
+                return
+
+        # The entries are filled in all at once, and the change is handled
+        # only once, afterwards.
+        with self.entry_changes_blocked():
+            for toggle in self.channel_toggles:
+                toggle.set_active(False)
+            for channel, text in channel_texts:
+                self.channel_entries[channel].set_text(text)
+                self.channel_toggles[channel].set_active(True)
+        self.set_entry_changed(self)
 
         self.statusbar.push(0, f"Loaded sequence from {src_file}.")
 
@@ -242,44 +310,97 @@ class MainWindow(Gtk.Window):
         dest_file = dialog.get_filename()
         dialog.destroy()
 
-        with open(dest_file, "w") as f:
-            writer = csv.writer(f)
-            enabled_entries = self.get_enabled_entries()
-            for entry in enabled_entries:
-                row = [entry.channel] + entry.get_text().split(" ")
-                writer.writerow(row)
+        try:
+            pio.save_channel_texts(dest_file, self.get_channel_texts())
+        except (ValueError, OSError, ImportError) as e:
+            self.statusbar.push(0, f"Error: {e}")
+            return
 
         self.statusbar.push(0, f"Sequence saved at {dest_file}.")
 
         return dest_file
 
+    def get_channel_texts(self):
+        return [(entry.channel, entry.get_text())
+                for entry in self.get_enabled_entries()]
+
+    def run_job(self, job, on_done):
+        # The stage timings are shown in the statusbar (see `push_status`).
+        job.profiler = pprof.Profiler()
+        self.toolbar.cancel_button.set_sensitive(True)
+        self.pipeline.submit(job, on_stage=self.show_stage, on_done=on_done,
+                             on_error=self.show_error)
+
+    def job_finished(self):
+        if not self.pipeline.busy:
+            self.toolbar.cancel_button.set_sensitive(False)
+
+    def push_status(self, msg, result):
+        """Push a message into the statusbar, followed by the time spent
+        in the stages of the job.
+        """
+        timings = result.profiler.status() if result.profiler else ""
+        self.statusbar.push(0, f"{msg} ({timings})" if timings else msg)
+
+    def show_stage(self, stage):
+        self.statusbar.push(0, f"{stage}...")
+
+    def show_error(self, error):
+        self.job_finished()
+        if isinstance(error, CancelledError):
+            self.statusbar.push(0, "Cancelled.")
+        elif isinstance(error, subprocess.CalledProcessError):
+            self.statusbar.push(0, f"arduino-cli failed: {error.stderr}")
+        else:
+            self.statusbar.push(0, f"Error: {error}")
+
+    def cancel(self, widget):
+        self.pipeline.cancel()
+
     def parse_seq(self, widget):
         self.unset_entry_changed()
-
-        enabled_entries = self.get_enabled_entries()
-        flips = []
-        for entry in enabled_entries:
-            entry_text = entry.get_text()
-            new_flips = pev.parse_events(entry_text, entry.channel)
-            for flip in new_flips:
-                flips.append(flip)
-        fs = pseq.FlipSequence(flips)
-        seq = pseq.Sequence.from_flip_sequence(fs)
-        code = seq.code()
-
-        self.seq_details_label.set_text(f"Duration: {seq.time}\n" \
-                                        f"Loops: {seq.loop_counter}")
+        job = ppl.PipelineJob(self.get_channel_texts(), action="parse",
+                              flip_cache=self.flip_cache,
+                              compile_cache=self.compile_cache)
+        self.run_job(job, self.show_sequence)
+
+    def show_sequence(self, result):
+        self.job_finished()
+        seq = result.seq
+        self.seq_details_label.set_text(f"Duration: {pev.ticks2seconds(seq.time)} s\n" \
+                                        f"Loops: {seq.loop_counter}\n" \
+                                        "Estimated flash usage: " \
+                                        f"{seq.estimated_flash_bytes()} B")
+
+        if result.code is None:
+            # Live preview: show only the beginning of a long sequence.
+            events = seq.events[:LIVE_PREVIEW_EVENTS]
+            preview = pseq.Sequence(events, triggered=seq.triggered,
+                                    parameter=seq.parameter)
+            preview.time, preview.loop_counter = seq.time, seq.loop_counter
+            text = repr(preview)
+            if len(seq.events) > LIVE_PREVIEW_EVENTS:
+                text += f"\n\t* ... ({len(seq.events)} events in total)"
+            self.seq_textbuf.set_text(text)
+            self.code_textbuf.set_text("Press \"Parse sequence\" " \
+                                       "to generate the source code.")
+            self.push_status("Sequence preview updated.", result)
+            return
 
         self.seq_textbuf.set_text(seq.__repr__())
-        self.code_textbuf.set_text(code)
-        return seq
+        self.code_textbuf.set_text(result.code)
+        self.push_status("Sequence parsed.", result)
 
     def quick_upload(self, widget):
-        seq = self.parse_seq(self)
-        code = seq.code()
-        dest_dir = "tmp_ino"
-        dest_file = os.path.join(dest_dir, "tmp_ino.ino")
+        job = ppl.PipelineJob(self.get_channel_texts(), action="upload",
+                              sketch_dir="tmp_ino",
+                              compile_cache=self.compile_cache)
+        self.run_job(job, self.uploaded)
 
+    def uploaded(self, result):
+        self.job_finished()
+        cached = " (cached build)" if result.cache_hit else ""
+        self.push_status(f"Sequence uploaded{cached}.", result)
 
     def make_ino(self, widget):
         # Let the user select the directory for the .ino
@@ -305,26 +426,33 @@ class MainWindow(Gtk.Window):
         ino_name = os.path.split(dest_dir)[-1] + ".ino"
         dest_file = os.path.join(dest_dir, ino_name)
 
-        enabled_entries = self.get_enabled_entries()
-        flips = []
-        for entry in enabled_entries:
-            entry_text = entry.get_text()
-            new_flips = pev.parse_events(entry_text, entry.channel)
-            for flip in new_flips:
-                flips.append(flip)
-        fs = pseq.FlipSequence(flips)
-        seq = pseq.Sequence.from_flip_sequence(fs)
-
-        code = seq.code()
+        job = ppl.PipelineJob(self.get_channel_texts(), action="make_ino",
+                              dest_file=dest_file,
+                              compile_cache=self.compile_cache)
+        self.run_job(job, self.ino_written)
 
-        with open(dest_file, "w") as f:
-            f.write(code)
+    def ino_written(self, result):
+        self.job_finished()
+        self.push_status(f"Source code written to {result.dest_file}.",
+                         result)
 
     def config(self, widget):
-        pass
+        # Read config.ini again (e.g. after recalibration). The values derived
+        # from the configuration and the cached parses follow automatically.
+        # The toolchain is determined again too (e.g. after a core update).
+        pcfg.reload()
+        pard.clear_toolchain_versions()
+        self.statusbar.push(0, f"Configuration reloaded from {pcfg.filename}.")
+        self.set_entry_changed(widget)
+
+
+def main():
+    window = MainWindow()
+    window.connect("destroy", lambda window: window.pipeline.shutdown())
+    window.connect("destroy", Gtk.main_quit)
+    window.show_all()
+    Gtk.main()
 
 
-window = MainWindow()
-window.connect("destroy", Gtk.main_quit)
-window.show_all()
-Gtk.main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""io.py
+Reading and writing pulse sequence files of the Arduino Due pulsebox.
+
+A sequence file is a CSV file with one row per (enabled) channel:
+the channel number, followed by the events of the channel, one per column.
+For example:
+
+    0,p1u3u,p5u2u
+    1,p2u1u
+
+Files ending with .gz are compressed with gzip, files ending with .zst
+with Zstandard (which needs the zstandard package, or Python 3.14).
+
+The channel rows are read and written one by one (see `iter_channel_texts`
+and `write_channel_texts`). For very large files, `load_flips` parses
+the events straight into a `FlipTable` while reading the file in chunks,
+so that only the flips (not the text) are kept in memory.
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+import csv
+
+import pulsebox.events as pev
+
+# The size of the chunks read by `iter_channel_chunks` (characters).
+CHUNK_SIZE = 1 << 20
+
+
+def open_sequence_file(filename, mode="r"):
+    """Open a sequence file as a text file, (de)compressing it according
+    to its extension (.gz, .zst).
+
+    Kwargs:
+        * mode (str): "r" (read), "w" (write) or "a" (append).
+            Default: "r"
+    """
+    if mode not in ("r", "w", "a"):
+        raise ValueError(f"Invalid mode: {mode!r}.")
+    if filename.endswith(".gz"):
+        import gzip
+        return gzip.open(filename, mode + "t", newline="")
+    if filename.endswith(".zst"):
+        try:
+            from compression import zstd  # Python 3.14+
+        except ImportError:
+            try:
+                import zstandard as zstd
+            except ImportError:
+                raise ImportError("Zstandard compressed sequence files "
+                                  "require the zstandard package.")
+        return zstd.open(filename, mode + "t", newline="")
+    return open(filename, mode, newline="")
+
+def _channel_number(text):
+    try:
+        return int(text)
+    except ValueError:
+        raise ValueError(f"Invalid channel number: {text!r}.") from None
+
+def iter_channel_texts(fileobj):
+    """Read a sequence file from an open (text) file object, row by row.
+
+    Yields:
+        * tuple (channel, event string)
+    """
+    for row in csv.reader(fileobj):
+        if not row:
+            continue
+        yield _channel_number(row[0]), " ".join(row[1:])
+
+def read_channel_texts(fileobj):
+    """Read a sequence file from an open (text) file object.
+
+    Returns:
+        * list channel_texts: (channel, event string) pairs.
+    """
+    return list(iter_channel_texts(fileobj))
+
+def write_channel_texts(fileobj, channel_texts):
+    """Write (channel, event string) pairs into an open (text) file object
+    as a sequence file. `channel_texts` can be any iterable (e.g.
+    a generator), the rows are written as they come.
+    """
+    writer = csv.writer(fileobj)
+    for channel, text in channel_texts:
+        writer.writerow([channel] + text.split(" "))
+
+def load_channel_texts(filename):
+    with open_sequence_file(filename) as f:
+        return read_channel_texts(f)
+
+def save_channel_texts(filename, channel_texts):
+    with open_sequence_file(filename, "w") as f:
+        write_channel_texts(f, channel_texts)
+
+def iter_channel_chunks(fileobj, chunk_size=CHUNK_SIZE):
+    """Read a sequence file from an open (text) file object in chunks
+    of `chunk_size` characters, so that even a single row does not have
+    to fit into memory.
+
+    The event strings never contain commas or newlines, so the columns
+    are split without the `csv` module (and any quotes are dropped).
+
+    Yields:
+        * tuple (channel, event string): A part of a row. Long rows are
+            yielded in several parts, which always end between events.
+    """
+    channel = None  # the channel of the current row, once read
+    pending = ""    # the last (possibly incomplete) column read
+    while True:
+        chunk = fileobj.read(chunk_size)
+        lines = (pending + chunk).split("\n")
+        # Unless the file ends, the last line goes on in the next chunk.
+        last = lines.pop() if chunk else None
+        for line in lines:
+            channel, events = _split_columns(channel, line.split(","))
+            if events:
+                yield channel, events
+            channel = None
+        if last is None:
+            return
+        columns = last.split(",")
+        pending = columns.pop()
+        channel, events = _split_columns(channel, columns)
+        if events:
+            yield channel, events
+
+def _split_columns(channel, columns):
+    # The channel number (read from the first column, if not known yet)
+    # and the events of `columns`.
+    if channel is None:
+        if not columns or not columns[0].strip():
+            return None, ""
+        channel = _channel_number(columns[0].strip().strip('"'))
+        columns = columns[1:]
+    return channel, " ".join(columns).replace('"', " ").strip()
+
+def read_flips(fileobj, chunk_size=CHUNK_SIZE):
+    """Parse a sequence file from an open (text) file object into
+    a `FlipTable`, chunk by chunk (see `iter_channel_chunks`).
+
+    The column numbers in the error messages (see `events.EventParseError`)
+    count from the beginning of the chunk.
+    """
+    flips = pev.FlipTable()
+    for channel, text in iter_channel_chunks(fileobj, chunk_size):
+        flips.extend(pev.parse_events(text, channel))
+    return flips
+
+def load_flips(filename, chunk_size=CHUNK_SIZE):
+    """Parse a (possibly compressed) sequence file into a `FlipTable`
+    (see `read_flips`).
+    """
+    with open_sequence_file(filename) as f:
+        return read_flips(f, chunk_size)
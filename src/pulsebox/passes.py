@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""passes.py
+Optimizer passes over the low-level events of a compiled sequence
+of the Arduino Due pulsebox.
+
+Every pass is a function taking a list of low-level events and returning
+a new list (the events themselves are never modified, as they may be
+shared with other sequences). The passes run in linear time. They work
+on the top level of the sequence, the bodies of counted loops are left
+as they are.
+
+Removing a state change or a delay loop saves its fixed cost (see
+`events.TimingModel`), so after the passes, the delays are planned again
+(see `retime`), for the edges to keep their times.
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+import copy
+
+import pulsebox.events as pev
+
+# The largest delay a single delay loop can do (see `codeblocks.loop`).
+MAX_LOOP_ITERS = 2**32 - 1
+
+PASSES = {}
+
+
+def register_pass(name):
+    """Register an optimizer pass (a function) under `name`.
+    """
+    def register(function):
+        PASSES[name] = function
+        return function
+    return register
+
+
+class PassResult():
+    """What a single optimizer pass saved."""
+    def __init__(self, name, events_saved, flash_bytes_saved):
+        self.name = name
+        self.events_saved = events_saved
+        self.flash_bytes_saved = flash_bytes_saved
+
+    def __repr__(self):
+        return f"{self.name}: {self.events_saved} events, " \
+               f"{self.flash_bytes_saved} B saved"
+
+
+def count_events(events):
+    """The number of low-level events, including the bodies of counted
+    loops.
+    """
+    count = 0
+    for event in events:
+        count += 1
+        if isinstance(event, pev.RepeatEvent):
+            count += count_events(event.events)
+    return count
+
+def _last_odsr(events, odsr):
+    # The value of `REG_PIOC_ODSR` after the events, starting at `odsr`.
+    for event in events:
+        if isinstance(event, pev.StateChangeEvent):
+            odsr = event.odsr
+        elif isinstance(event, pev.RepeatEvent):
+            odsr = _last_odsr(event.events, odsr)
+    return odsr
+
+
+@register_pass("merge_writes")
+def merge_writes(events):
+    """Merge state changes that follow each other without a delay
+    (e.g. after sub-iteration gaps were rounded to zero iterations).
+    Only the last state change of such a run is kept.
+
+    This is done only if the state changes are free (see
+    `state_change_cycles` in config.ini), so that such state changes happen
+    at once. Otherwise, they are a write apart, closer than any delay can
+    make them, and merging them would move the edges.
+    """
+    if pev.TimingModel().write_ticks:
+        return list(events)
+    merged = []
+    for event in events:
+        if isinstance(event, pev.StateChangeEvent) and merged \
+                and isinstance(merged[-1], pev.StateChangeEvent):
+            merged[-1] = event
+        else:
+            merged.append(event)
+    return merged
+
+@register_pass("drop_noop_writes")
+def drop_noop_writes(events):
+    """Drop the state changes that do not change `REG_PIOC_ODSR`.
+    """
+    kept = []
+    odsr = 0  # every channel starts at 0
+    for event in events:
+        if isinstance(event, pev.StateChangeEvent):
+            if event.odsr == odsr:
+                continue
+            odsr = event.odsr
+        elif isinstance(event, pev.RepeatEvent):
+            odsr = _last_odsr(event.events, odsr)
+        kept.append(event)
+    return kept
+
+@register_pass("coalesce_delays")
+def coalesce_delays(events):
+    """Join neighbouring delays into a single delay loop.
+    """
+    coalesced = []
+    for event in events:
+        if isinstance(event, pev.DelayEvent) and coalesced \
+                and isinstance(coalesced[-1], pev.DelayEvent) \
+                and coalesced[-1].iters + event.iters <= MAX_LOOP_ITERS:
+            previous = coalesced[-1]
+            coalesced[-1] = pev.DelayEvent(
+                iters=previous.iters + event.iters,
+                loop_suffix=previous.loop_suffix)
+        else:
+            coalesced.append(event)
+    return coalesced
+
+@register_pass("renumber_loops")
+def renumber_loops(events):
+    """Renumber the loop suffixes (the labels of the delay loops and
+    of the counted loops) consecutively, starting at 0.
+    """
+    counters = {"loop": 0, "repeat": 0}
+
+    def renumber(events):
+        renumbered = []
+        for event in events:
+            if isinstance(event, pev.DelayEvent):
+                suffix = str(counters["loop"])
+                counters["loop"] += 1
+                if event.loop_suffix != suffix:
+                    event = pev.DelayEvent(iters=event.iters,
+                                           loop_suffix=suffix)
+            elif isinstance(event, pev.RepeatEvent):
+                suffix = str(counters["repeat"])
+                counters["repeat"] += 1
+                event = pev.RepeatEvent(renumber(event.events), event.count,
+                                        loop_suffix=suffix)
+            renumbered.append(event)
+        return renumbered
+
+    return renumber(events)
+
+def _anchors(events):
+    # The top-level events starting an edge (the state changes changing
+    # the state and the counted loops with edges), as (index, time, ODSR
+    # value) tuples, in the current configuration.
+    timing = pev.TimingModel()
+    anchors = []
+    odsr = 0
+    for i, event in enumerate(events):
+        if isinstance(event, pev.RepeatEvent):
+            first = copy.copy(timing)
+            first.overhead += timing.repeat_ticks
+            edge = next(first._edges(event.events, [odsr]), None)
+            if edge is not None:
+                anchors.append((i, *edge))
+            odsr = _last_odsr([event], odsr)
+        elif isinstance(event, pev.StateChangeEvent) and event.odsr != odsr:
+            odsr = event.odsr
+            timing.write()
+            anchors.append((i, timing.time, odsr))
+            continue
+        timing.run([event])
+    return anchors
+
+def retime(events, reference):
+    """Plan the delays of optimized events again, so that their edges keep
+    their times in the `reference` events (the events before the passes),
+    to within half a delay loop iteration.
+
+    The delay before every edge (the last one since the edge before it)
+    is adjusted. The counted loops are moved as a whole, by their first
+    edge. An edge without such a delay cannot be moved, it comes early
+    by the costs removed since the last one. If the edges do not match
+    those of `reference` (e.g. after a custom pass), the events are
+    returned as they are.
+
+    Returns:
+        * list events: The retimed events.
+    """
+    timing = pev.TimingModel()
+    if timing.ideal:
+        return events
+    targets = _anchors(reference)
+    anchors = _anchors(events)
+    if [odsr for _, _, odsr in anchors] != [odsr for _, _, odsr in targets]:
+        return events
+    events = list(events)
+    calibration_ticks = timing.calibration_ticks
+    shift = 0  # the iterations added so far
+    previous = 0  # the index after the last edge
+    for (i, time, _), (_, target, _) in zip(anchors, targets):
+        delays = [j for j in range(previous, i)
+                  if isinstance(events[j], pev.DelayEvent)]
+        previous = i + 1
+        if not delays:
+            continue
+        error = target - (time + shift * calibration_ticks)
+        adjust = pev.time2iters(abs(error), calibration_ticks)
+        adjust = adjust if error > 0 else -adjust
+        delay = events[delays[-1]]
+        adjust = max(adjust, 1 - delay.iters)
+        if adjust:
+            events[delays[-1]] = pev.DelayEvent(
+                iters=delay.iters + adjust, loop_suffix=delay.loop_suffix)
+            shift += adjust
+    return events
+
+DEFAULT_PASSES = ["merge_writes", "drop_noop_writes", "coalesce_delays",
+                  "renumber_loops"]
+
+
+class PassManager():
+    """Runs optimizer passes over the low-level events, one after another.
+
+    Kwargs:
+        * passes (list): The passes to run, as names (see `PASSES`)
+            or functions.
+            Default: `DEFAULT_PASSES`
+
+    The passes only remove events or join them. The delays are planned
+    again afterwards (see `retime`), so every edge stays within half
+    a delay loop iteration of its time before the passes.
+    """
+    def __init__(self, passes=None):
+        passes = passes if passes is not None else DEFAULT_PASSES
+        self.passes = []
+        for optimizer_pass in passes:
+            if isinstance(optimizer_pass, str):
+                if optimizer_pass not in PASSES:
+                    raise ValueError("Unknown optimizer pass: " \
+                                     f"{optimizer_pass!r}.")
+                self.passes.append((optimizer_pass, PASSES[optimizer_pass]))
+            else:
+                self.passes.append((optimizer_pass.__name__, optimizer_pass))
+
+    def run(self, events):
+        """Run the passes.
+
+        Returns:
+            * list events: The optimized events.
+            * list results: A `PassResult` for every pass.
+        """
+        results = []
+        reference = events
+        count = count_events(events)
+        flash_bytes = sum(event.flash_bytes for event in events)
+        for name, optimizer_pass in self.passes:
+            events = optimizer_pass(events)
+            new_count = count_events(events)
+            new_flash_bytes = sum(event.flash_bytes for event in events)
+            results.append(PassResult(name, count - new_count,
+                                      flash_bytes - new_flash_bytes))
+            count, flash_bytes = new_count, new_flash_bytes
+        return retime(events, reference), results
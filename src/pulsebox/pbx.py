@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""pbx.py
+The binary .pbx sequence format of the Arduino Due pulsebox.
+
+Unlike the CSV sequence files (see `pulsebox.io`), which have to be
+tokenized and parsed whenever they are loaded, a .pbx file stores
+the flips (and, optionally, the compiled events) as typed columns.
+The file is memory-mapped when opened, so opening even a very large
+sequence takes next to no time, and the flip columns are handed over
+to the compiler without copying:
+
+    with pbx.PbxFile("scan.pbx") as f:
+        seq = Sequence.from_flip_sequence(FlipSequence(f.flips),
+                                          backend="numpy")
+
+The layout of the file is:
+
+    * magic (4 bytes, b"PBX\\0"), format version (uint32, little endian),
+      header length (uint32, little endian),
+    * the header: UTF-8 JSON with the pin map, the calibration and
+      the timing configuration, the mode (triggered, parameter), the byte
+      order of the columns and the offsets of the sections (from the end
+      of the header), padded with spaces to a multiple of 8 bytes,
+    * the sections, each aligned to 8 bytes:
+        - "flip_channels" (uint8), "flip_timestamps" (int64, in ticks),
+        - "trains" (int64): channel, timestamp, width, period and count
+          of every compact pulse train,
+        - "event_kinds" (uint8), "event_values" (int64), "event_extras"
+          (int64): the compiled events (see `_flatten_events`), if any.
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+import json
+import mmap
+import struct
+import sys
+
+from array import array
+
+import pulsebox.config as pcfg
+import pulsebox.events as pev
+import pulsebox.io as pio
+import pulsebox.sequences as pseq
+
+MAGIC = b"PBX\0"
+VERSION = 1
+_PREFIX = struct.Struct("<4sII")
+_ALIGNMENT = 8
+
+# The kinds of the compiled events. A counted loop is stored as
+# a `_REPEAT` row, the rows of its body and an `_END` row.
+_DELAY, _STATE_CHANGE, _REPEAT, _END = range(4)
+_TRAIN_FIELDS = 5
+
+
+def _config_header(cfg):
+    # The configuration values the compiled events depend on.
+    return {"pins": cfg.pulsebox_pins,
+            "calibration": cfg.calibration,
+            "clock_frequency": cfg.clock_frequency,
+            "timing": {"repeat_overhead_cycles": cfg.repeat_overhead_cycles,
+                       "state_change_cycles": cfg.state_change_cycles,
+                       "loop_overhead_cycles": cfg.loop_overhead_cycles}}
+
+def _flatten_events(events, kinds, values, extras):
+    """Append the rows of `events` to the event columns:
+
+        * delay: iterations, loop suffix,
+        * state change: channel mask, ODSR value,
+        * counted loop: count, loop suffix (then the body and an end row).
+    """
+    for event in events:
+        if isinstance(event, pev.DelayEvent):
+            row = (_DELAY, event.iters, int(event.loop_suffix))
+        elif isinstance(event, pev.StateChangeEvent):
+            row = (_STATE_CHANGE, event.channel_mask, event.odsr)
+        elif isinstance(event, pev.RepeatEvent):
+            kinds.append(_REPEAT)
+            values.append(event.count)
+            extras.append(int(event.loop_suffix))
+            _flatten_events(event.events, kinds, values, extras)
+            row = (_END, 0, 0)
+        else:
+            raise ValueError(f"Cannot store the event {event!r}.")
+        kinds.append(row[0])
+        values.append(row[1])
+        extras.append(row[2])
+
+def save(filename, flips=None, seq=None):
+    """Write a .pbx file.
+
+    Kwargs:
+        * flips (events.FlipTable): The flips (and pulse trains).
+        * seq (sequences.Sequence): The compiled sequence.
+
+    At least one of them has to be given. The header describes
+    the configuration `seq` was compiled with (or the current one).
+    """
+    if flips is None and seq is None:
+        raise ValueError("Nothing to save: neither flips nor a sequence "
+                         "given.")
+    cfg = seq.config if seq is not None else pcfg.current()
+    header = _config_header(cfg)
+    header["byteorder"] = sys.byteorder
+
+    sections = {}
+    if flips is not None:
+        trains = array("q")
+        for train in flips.trains:
+            trains.extend((train.channel, train.timestamp, train.width,
+                           train.period, train.count))
+        sections["flip_channels"] = flips.channels
+        sections["flip_timestamps"] = flips.timestamps
+        sections["trains"] = trains
+    if seq is not None:
+        kinds, values, extras = array("B"), array("q"), array("q")
+        _flatten_events(seq.events, kinds, values, extras)
+        sections["event_kinds"] = kinds
+        sections["event_values"] = values
+        sections["event_extras"] = extras
+        header["triggered"] = seq.triggered
+        header["parameter"] = seq.parameter
+        header["sequence"] = {"time": seq.time,
+                              "loop_counter": seq.loop_counter,
+                              "repeat_counter": seq.repeat_counter}
+
+    # The offsets are relative to the end of the header.
+    offset = 0
+    header["sections"] = {}
+    for name, column in sections.items():
+        typecode = column.typecode if isinstance(column, array) \
+                   else column.format
+        header["sections"][name] = {"typecode": typecode,
+                                    "length": len(column), "offset": offset}
+        offset = _padded(offset + len(column) * struct.calcsize(typecode))
+    header_bytes = json.dumps(header).encode()
+    header_bytes = header_bytes.ljust(_padded(_PREFIX.size
+                                              + len(header_bytes))
+                                      - _PREFIX.size)
+
+    with open(filename, "wb") as f:
+        f.write(_PREFIX.pack(MAGIC, VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        start = f.tell()
+        for name, column in sections.items():
+            offset = header["sections"][name]["offset"]
+            f.write(b"\0" * (start + offset - f.tell()))
+            f.write(column)
+
+def _padded(length):
+    return -(-length // _ALIGNMENT) * _ALIGNMENT
+
+
+class PbxFile():
+    """A memory-mapped .pbx file (see the module docstring).
+
+    The flip columns are read-only views of the file. The file is closed
+    by `close` (or at the end of a `with` block), or, if some of the views
+    are still in use, as soon as they are gone.
+
+    Args:
+        * filename (str): The .pbx file.
+
+    Attributes:
+        * header (dict): The header of the file.
+    """
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # an empty file
+                raise ValueError(f"{filename!r} is not a .pbx file.")
+        self._buffer = memoryview(self._mmap)
+        self._flips = None
+        try:
+            magic, version, header_length = \
+                _PREFIX.unpack_from(self._buffer)
+        except struct.error:
+            magic = None
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{filename!r} is not a .pbx file.")
+        if version != VERSION:
+            self.close()
+            raise ValueError(f"Unsupported .pbx format version {version}.")
+        self._start = _PREFIX.size + header_length
+        self.header = json.loads(bytes(self._buffer[_PREFIX.size:
+                                                    self._start]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._flips = None
+        self._buffer.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass  # closed when the views handed out are gone
+
+    def _column(self, name):
+        # A section as a typed view of the file (or, if the file was
+        # written on a machine of the other byte order, as a swapped copy).
+        section = self.header["sections"][name]
+        typecode = section["typecode"]
+        start = self._start + section["offset"]
+        stop = start + section["length"] * struct.calcsize(typecode)
+        view = self._buffer[start:stop].cast(typecode)
+        if self.header["byteorder"] == sys.byteorder:
+            return view
+        column = array(typecode)
+        column.frombytes(view.cast("B"))
+        column.byteswap()
+        return column
+
+    @property
+    def has_flips(self):
+        return "flip_timestamps" in self.header["sections"]
+
+    @property
+    def has_sequence(self):
+        return "event_kinds" in self.header["sections"]
+
+    @property
+    def flips(self):
+        """The flips and the pulse trains, as an `events.FlipTable` viewing
+        the file (see `events.FlipTable`).
+        """
+        if self._flips is None:
+            if not self.has_flips:
+                raise ValueError("The file contains no flips.")
+            trains = self._column("trains").tolist()
+            table = pev.FlipTable(trains=[
+                pev.PulseTrain(*trains[i:i + _TRAIN_FIELDS])
+                for i in range(0, len(trains), _TRAIN_FIELDS)])
+            table.channels = self._column("flip_channels")
+            table.timestamps = self._column("flip_timestamps")
+            self._flips = table
+        return self._flips
+
+    def check_config(self, cfg=None):
+        """Raise a `ValueError` unless the compiled events are valid
+        for the configuration `cfg` (default: the current one), i.e.
+        the pins, the calibration and the timing are the same.
+        """
+        cfg = cfg if cfg else pcfg.current()
+        stored = {key: self.header[key] for key in _config_header(cfg)}
+        if stored != json.loads(json.dumps(_config_header(cfg))):
+            raise ValueError("The sequence was compiled with a different "
+                             "configuration (pins, calibration or timing). "
+                             "Compile it again from the flips.")
+
+    def sequence(self):
+        """The compiled `sequences.Sequence` (with the current
+        configuration, see `check_config`).
+        """
+        if not self.has_sequence:
+            raise ValueError("The file contains no compiled sequence.")
+        self.check_config()
+        events = [[]]
+        repeats = []
+        for kind, value, extra in zip(self._column("event_kinds"),
+                                      self._column("event_values"),
+                                      self._column("event_extras")):
+            if kind == _DELAY:
+                events[-1].append(pev.DelayEvent(iters=value,
+                                                 loop_suffix=str(extra)))
+            elif kind == _STATE_CHANGE:
+                events[-1].append(pev.StateChangeEvent(value, odsr=extra))
+            elif kind == _REPEAT:
+                events.append([])
+                repeats.append((value, extra))
+            elif kind == _END and repeats:
+                count, suffix = repeats.pop()
+                body = events.pop()
+                events[-1].append(pev.RepeatEvent(body, count,
+                                                  loop_suffix=str(suffix)))
+            else:
+                raise ValueError(f"Corrupted event section (kind {kind}).")
+        if repeats:
+            raise ValueError("Corrupted event section (unterminated loop).")
+
+        seq = pseq.Sequence(events[0], triggered=self.header["triggered"],
+                            parameter=self.header["parameter"])
+        seq.time = self.header["sequence"]["time"]
+        seq.loop_counter = self.header["sequence"]["loop_counter"]
+        seq.repeat_counter = self.header["sequence"]["repeat_counter"]
+        return seq
+
+
+def flips_to_channel_texts(flips):
+    """Describe the flips of a `FlipTable` with (channel, event string)
+    pairs (pulses and pulse trains), e.g. to save them as a CSV sequence
+    file.
+
+    Every channel has to have an even number of flips (every pulse ends).
+    The event strings reproduce the flips exactly, though not necessarily
+    the event strings they were parsed from (e.g. overlapping pulses).
+    """
+    timestamps = {}
+    for channel, timestamp in zip(flips.channels, flips.timestamps):
+        timestamps.setdefault(channel, []).append(timestamp)
+    for train in flips.trains:
+        timestamps.setdefault(train.channel, [])
+
+    channel_texts = []
+    for channel in sorted(timestamps):
+        edges = sorted(timestamps[channel])
+        if len(edges) % 2:
+            raise ValueError(f"Channel {channel} has an odd number of flips, "
+                             "so they cannot be written as pulses.")
+        events = [f"p{pev.format_time(start)}"
+                  f"{pev.format_time(stop - start)}"
+                  for start, stop in zip(edges[0::2], edges[1::2])]
+        events += [f"t{pev.format_time(train.timestamp)}"
+                   f"{pev.format_time(train.width)}"
+                   f"{pev.format_time(train.period)}x{train.count}"
+                   for train in flips.trains if train.channel == channel]
+        channel_texts.append((channel, " ".join(events)))
+    return channel_texts
+
+def csv_to_pbx(csv_filename, pbx_filename, compile=False, backend="loop"):
+    """Convert a CSV sequence file into a .pbx file.
+
+    Kwargs:
+        * compile (bool): Also store the compiled sequence.
+        * backend (str): See `sequences.Sequence.from_flip_sequence`.
+    """
+    flips = pio.load_flips(csv_filename)
+    seq = None
+    if compile:
+        seq = pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips),
+                                               backend=backend)
+    save(pbx_filename, flips=flips, seq=seq)
+
+def pbx_to_csv(pbx_filename, csv_filename):
+    """Convert the flips of a .pbx file into a CSV sequence file
+    (see `flips_to_channel_texts`).
+    """
+    with PbxFile(pbx_filename) as f:
+        channel_texts = flips_to_channel_texts(f.flips)
+    pio.save_channel_texts(csv_filename, channel_texts)
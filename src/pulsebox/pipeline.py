@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""pipeline.py
+Running the parse → compile → write/upload pipeline of the Arduino Due
+pulsebox in the background, so that the GUI stays responsive.
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+import threading
+
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+import pulsebox.arduino as pard
+import pulsebox.config as pcfg
+import pulsebox.events as pev
+import pulsebox.profiling as pprof
+import pulsebox.sequences as pseq
+
+
+class PipelineResult():
+    def __init__(self, seq, code=None, dest_file=None, cache_hit=None,
+                 profiler=None):
+        self.seq = seq
+        self.code = code
+        self.dest_file = dest_file
+        self.cache_hit = cache_hit
+        self.profiler = profiler
+
+
+class FlipCache():
+    """Parsed flips of the individual channels.
+
+    A channel is only parsed again when its event string (or the current
+    configuration) changes, so editing one channel does not require
+    re-parsing all of them.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, channel, text):
+        """Return the `FlipTable` of a channel, parsing it if needed.
+        """
+        signature = pcfg.current().signature
+        cached = self.entries.get(channel)
+        if cached is not None and cached[:2] == (text, signature):
+            return cached[2]
+        flips = pev.parse_events(text, channel)
+        self.entries[channel] = (text, signature, flips)
+        return flips
+
+
+class PipelineJob():
+    """A single run of the pipeline.
+
+    The stages are:
+        1. parsing the per-channel event strings,
+        2. compiling the flips into a `Sequence`,
+        3. one of the following, depending on `action`:
+            - "preview": nothing else (e.g. for a live preview),
+            - "parse": generating the source code,
+            - "make_ino": writing the source code into `dest_file`,
+            - "upload": compiling the firmware and uploading it.
+
+    Args:
+        * channel_texts (list): (channel, event string) pairs.
+
+    Kwargs:
+        * action (str): See above.
+            Default: "parse"
+        * dest_file (str): The .ino file to write (for "make_ino").
+        * sketch_dir (str): The sketch directory (for "upload").
+            Default: "tmp_ino"
+        * runner (arduino.CommandRunner): Runs arduino-cli (for "upload").
+        * cache (arduino.BuildCache): See `arduino.build_and_upload`.
+        * flip_cache (FlipCache): Reuse the flips of unchanged channels.
+        * compile_cache (sequences.CompileCache): Skip parsing and compiling
+            of previously compiled inputs.
+        * config (config.Config): The configuration to run the job with.
+            Default: The current configuration (when creating the job).
+        * profiler (profiling.Profiler): Record the stages of the job.
+            It is handed over in `PipelineResult.profiler`.
+    """
+    actions = ["preview", "parse", "make_ino", "upload"]
+
+    def __init__(self, channel_texts, action="parse", dest_file=None,
+                 sketch_dir="tmp_ino", runner=None, cache=None,
+                 flip_cache=None, compile_cache=None, config=None,
+                 profiler=None):
+        if action not in self.actions:
+            raise ValueError(f"Unknown pipeline action: {action!r}.")
+        if action == "make_ino" and not dest_file:
+            raise ValueError("No destination file given.")
+
+        self.channel_texts = channel_texts
+        self.action = action
+        self.dest_file = dest_file
+        self.sketch_dir = sketch_dir
+        self.runner = runner if runner else pard.CommandRunner()
+        self.cache = cache
+        self.flip_cache = flip_cache
+        self.compile_cache = compile_cache
+        # The job runs in another thread, which does not share our context.
+        self.config = config if config else pcfg.current()
+        self.profiler = profiler
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+        self.runner.cancel()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise CancelledError()
+
+    def compile(self, report):
+        report("Parsing")
+        flips = pev.FlipTable()
+        for channel, text in self.channel_texts:
+            self.check_cancelled()
+            if self.flip_cache is not None:
+                flips.extend(self.flip_cache.get(channel, text))
+            else:
+                flips.extend(pev.parse_events(text, channel))
+
+        self.check_cancelled()
+        report("Compiling")
+        return pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips))
+
+    def run(self, report=None):
+        """Run all the stages of the job (in the calling thread).
+
+        Kwargs:
+            * report (callable): Called with the name of every stage
+                as it begins.
+
+        Returns:
+            * PipelineResult result
+        """
+        report = report if report else (lambda stage: None)
+        with self.config:
+            if self.profiler is None:
+                return self._run(report)
+            with self.profiler:
+                result = self._run(report)
+            result.profiler = self.profiler
+            return result
+
+    def _run(self, report):
+        seq = None
+        if self.compile_cache is not None:
+            key = self.compile_cache.key(self.channel_texts)
+            seq = self.compile_cache.get(key)
+        if seq is None:
+            seq = self.compile(report)
+            if self.compile_cache is not None:
+                self.compile_cache.put(key, seq)
+
+        self.check_cancelled()
+        if self.action == "preview":
+            return PipelineResult(seq)
+        if self.action == "parse":
+            report("Generating code")
+            return PipelineResult(seq, code=seq.code())
+
+        seq = seq.fit_flash_budget()
+        self.check_cancelled()
+        if self.action == "make_ino":
+            report("Writing")
+            with open(self.dest_file, "w") as f:
+                seq.write_code(f)
+            return PipelineResult(seq, dest_file=self.dest_file)
+
+        report("Building and uploading firmware")
+        with pprof.stage("build_and_upload"):
+            hit = pard.build_and_upload(seq, sketch_dir=self.sketch_dir,
+                                        runner=self.runner, cache=self.cache)
+        return PipelineResult(seq, cache_hit=hit)
+
+
+class Pipeline():
+    """Runs `PipelineJob`s in a background thread, one at a time.
+
+    The callbacks are not called directly from the background thread.
+    Instead, they are handed over to `post` (together with their arguments),
+    which should schedule them in the main thread. For GTK applications,
+    this is `GLib.idle_add`. By default, the callbacks are called directly.
+    """
+    def __init__(self, post=None):
+        self.post = post if post else (lambda callback, *args:
+                                       callback(*args))
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.job = None
+
+    @property
+    def busy(self):
+        return self.job is not None
+
+    def submit(self, job, on_stage=None, on_done=None, on_error=None):
+        """Run `job` in the background. A running job is cancelled first.
+
+        Kwargs:
+            * on_stage (callable): Called with the name of every stage.
+            * on_done (callable): Called with the `PipelineResult`.
+            * on_error (callable): Called with the exception raised by
+                the job (`concurrent.futures.CancelledError` if cancelled).
+
+        Returns:
+            * concurrent.futures.Future future
+        """
+        self.cancel()
+        self.job = job
+
+        def report(stage):
+            if on_stage:
+                self.post(on_stage, stage)
+
+        def work():
+            try:
+                result = job.run(report=report)
+            except Exception as e:
+                self._finish(job)
+                if on_error:
+                    self.post(on_error, e)
+                raise
+            self._finish(job)
+            if on_done:
+                self.post(on_done, result)
+            return result
+
+        return self.executor.submit(work)
+
+    def _finish(self, job):
+        if self.job is job:
+            self.job = None
+
+    def cancel(self):
+        job = self.job
+        if job is not None:
+            job.cancel()
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
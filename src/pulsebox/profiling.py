@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""profiling.py
+Per-stage profiling of the parse → compile → codegen pipeline
+of the Arduino Due pulsebox.
+
+The pipeline marks its stages with `stage`:
+
+    with profiling.stage("parse_events") as st:
+        ...
+        st.items = len(flips)
+
+Nothing is recorded (and next to nothing is spent) unless a `Profiler`
+is active:
+
+    with profiling.Profiler() as profiler:
+        seq = Sequence.from_flip_sequence(fs)
+        code = seq.code()
+    print(profiler.format())
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+import time
+
+from contextvars import ContextVar
+
+_active = ContextVar("profiler", default=None)
+
+
+class StageRecord():
+    """A single run of a pipeline stage.
+
+    * name (str): The name of the stage.
+    * seconds (float): The wall time.
+    * items (int): The number of processed items (flips, events, ...),
+        if the stage counts them.
+    * allocated (int): The peak memory allocated during the stage (in bytes),
+        if the profiler traces memory allocations.
+    * depth (int): How deeply the stage is nested in other stages.
+    """
+    def __init__(self, name, seconds, items, allocated, depth):
+        self.name = name
+        self.seconds = seconds
+        self.items = items
+        self.allocated = allocated
+        self.depth = depth
+
+    def __repr__(self):
+        return f"{self.name}: {self.seconds:.6f} s, {self.items} items, " \
+               f"{self.allocated} B"
+
+
+class _Stage():
+    def __init__(self, profiler, name, items):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        profiler = self.profiler
+        self.depth = len(profiler._stack)
+        profiler._stack.append(self)
+        if profiler.memory:
+            tracemalloc = profiler._tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            self.memory_start = current
+            self.peak = 0
+            if profiler._stack[:-1]:
+                parent = profiler._stack[-2]
+                parent.peak = max(parent.peak, peak)
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        profiler = self.profiler
+        allocated = None
+        if profiler.memory:
+            self.peak = max(self.peak,
+                            profiler._tracemalloc.get_traced_memory()[1])
+            allocated = self.peak - self.memory_start
+            if profiler._stack[:-1]:
+                parent = profiler._stack[-2]
+                parent.peak = max(parent.peak, self.peak)
+        profiler._stack.pop()
+        profiler.records.append(StageRecord(self.name, seconds, self.items,
+                                            allocated, self.depth))
+        return False
+
+
+class _NullStage():
+    # What `stage` returns when no profiler is active.
+    items = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, items=None):
+    """Mark a stage of the pipeline (a context manager).
+
+    Args:
+        * name (str): The name of the stage.
+
+    Kwargs:
+        * items (int): The number of processed items, if known beforehand.
+            It can be set later, as the `items` attribute of the returned
+            object.
+    """
+    profiler = _active.get()
+    if profiler is None:
+        return _NULL_STAGE
+    return _Stage(profiler, name, items)
+
+def active():
+    """The active `Profiler` (or `None`)."""
+    return _active.get()
+
+
+class Profiler():
+    """Records the stages of the pipeline run while the profiler is active
+    (as a context manager, in the current thread or context).
+
+    Kwargs:
+        * memory (bool): Also record the memory allocated by every stage
+            (using `tracemalloc`, which slows everything down).
+            Default: False
+    """
+    def __init__(self, memory=False):
+        if memory:
+            # Imported only when needed, for a quick start of the CLI.
+            import tracemalloc
+            self._tracemalloc = tracemalloc
+        self.memory = memory
+        self.records = []
+        self._stack = []
+        self._tokens = []
+        self._tracing = False
+
+    def __enter__(self):
+        if self.memory and not self._tracemalloc.is_tracing():
+            self._tracemalloc.start()
+            self._tracing = True
+        self._tokens.append(_active.set(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        _active.reset(self._tokens.pop())
+        if self._tracing and not self._tokens:
+            self._tracemalloc.stop()
+            self._tracing = False
+        return False
+
+    def summary(self):
+        """Sum the records up by the stage name (in the order of the first
+        record of every stage).
+
+        Returns:
+            * dict stages: {name: {"calls": int, "seconds": float,
+                "items": int, "allocated": int}}. "items" and "allocated"
+                are `None` if not recorded.
+        """
+        stages = {}
+        for record in self.records:
+            totals = stages.setdefault(record.name, {"calls": 0,
+                                                     "seconds": 0.0,
+                                                     "items": None,
+                                                     "allocated": None})
+            totals["calls"] += 1
+            totals["seconds"] += record.seconds
+            if record.items is not None:
+                totals["items"] = (totals["items"] or 0) + record.items
+            if record.allocated is not None:
+                totals["allocated"] = max(totals["allocated"] or 0,
+                                          record.allocated)
+        return stages
+
+    def format(self):
+        """A table of the stages (see `summary`)."""
+        lines = [f"{'stage':<20} {'calls':>6} {'seconds':>10} {'items':>10} "
+                 f"{'peak alloc.':>12}"]
+        for name, totals in self.summary().items():
+            items = totals["items"] if totals["items"] is not None else "-"
+            allocated = f"{totals['allocated'] / 2**20:.1f} MiB" \
+                        if totals["allocated"] is not None else "-"
+            lines.append(f"{name:<20} {totals['calls']:>6} "
+                         f"{totals['seconds']:10.4f} {items:>10} "
+                         f"{allocated:>12}")
+        return "\n".join(lines)
+
+    def status(self):
+        """A one-line summary of the top-level stages (e.g. for a status
+        bar).
+        """
+        stages = {}
+        for record in self.records:
+            if record.depth == 0:
+                stages[record.name] = stages.get(record.name, 0.0) \
+                                      + record.seconds
+        return ", ".join(f"{name} {seconds * 1000:.0f} ms"
+                         for name, seconds in stages.items())
@@ -0,0 +1,672 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""protocol.py
+The serial protocol of the resident player of the Arduino Due pulsebox.
+
+The resident player (see `firmware`) is flashed once. It keeps two tables
+of steps (see `Sequence.table_steps`) in RAM and plays the active one
+over and over, while new tables are pushed over the native USB port
+(`SerialUSB`) without reflashing:
+
+    with protocol.PlayerClient("/dev/ttyACM1") as client:
+        generation = client.push(seq)
+
+Every message is a frame:
+
+    A5 5A | kind (1 B) | seq (1 B) | length (2 B) | payload | CRC-32 (4 B)
+
+with little-endian integers and the CRC-32 (as `zlib.crc32`) of everything
+between the sync bytes and the CRC. The device answers every frame
+with a reply (kind | `REPLY`, the same seq) or with a `NAK` and an error
+code. A table is loaded into the inactive buffer (`BEGIN`, `DATA` frames
+at given offsets, `COMMIT` with the CRC-32 of the whole table). The device
+handles frames only between repetitions of the sequence (with
+the interrupts disabled while playing), so a committed table takes effect
+at a repetition boundary and the playing table is never touched.
+
+The device can be emulated on a pseudo-terminal (see `pulsebox.emulator`).
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+import os
+import select
+import struct
+import time
+import zlib
+
+from array import array
+from sys import byteorder
+
+import pulsebox.codeblocks as pcb
+from pulsebox import config
+
+SYNC = b"\xa5\x5a"
+VERSION = 1
+# The longest payload of a frame (bytes).
+MAX_PAYLOAD = 1024
+# The number of steps of a `DATA` frame (after the 4-byte offset).
+DATA_STEPS = (MAX_PAYLOAD - 4) // 8
+# The default size of the two table buffers of the firmware (steps).
+# Two tables of 4096 steps take 64 KiB of the 96 KiB of RAM of the Due.
+MAX_STEPS = 4096
+
+# Frame kinds.
+INFO = 0x01    # -> protocol version, buffer count, max. payload, max. steps
+BEGIN = 0x02   # table length, table CRC-32 -> (nothing)
+DATA = 0x03    # offset (in steps), steps -> (nothing)
+COMMIT = 0x04  # (nothing) -> generation (the number of committed tables)
+STATUS = 0x05  # -> generation, repetitions, active length, loading
+REPLY = 0x80   # or-ed with the kind of the request
+NAK = 0xff     # error code
+
+# Error codes.
+ERR_CRC = 1
+ERR_LENGTH = 2
+ERR_KIND = 3
+ERR_STATE = 4
+ERR_RANGE = 5
+ERR_TABLE_CRC = 6
+ERRORS = {
+    ERR_CRC: "corrupted frame",
+    ERR_LENGTH: "invalid payload length",
+    ERR_KIND: "unknown frame kind",
+    ERR_STATE: "no table is being loaded",
+    ERR_RANGE: "steps out of the range of the buffer",
+    ERR_TABLE_CRC: "table checksum mismatch",
+}
+
+_HEADER = struct.Struct("<BBH")
+_CRC = struct.Struct("<I")
+
+
+class ProtocolError(OSError):
+    """The device refused a frame, or did not answer.
+
+    Attributes:
+        * error (int): The error code of the refusal (`None` if the device
+            did not answer).
+        * resent (bool): Whether the refused frame had been resent.
+    """
+    def __init__(self, message, error=None, resent=False):
+        super().__init__(message)
+        self.error = error
+        self.resent = resent
+
+
+class Frame():
+    """A received frame.
+
+    * kind (int): The frame kind.
+    * seq (int): The sequence number (0 to 255).
+    * payload (bytes)
+    * valid (bool): Whether the CRC matches.
+    """
+    def __init__(self, kind, seq, payload, valid=True):
+        self.kind = kind
+        self.seq = seq
+        self.payload = payload
+        self.valid = valid
+
+    def __repr__(self):
+        return f"Frame(kind={self.kind:#04x}, seq={self.seq}, " \
+               f"{len(self.payload)} B{'' if self.valid else ', invalid'})"
+
+
+def encode_frame(kind, seq, payload=b""):
+    """The bytes of a frame (see the module docstring)."""
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError("The payload of the frame is too long.")
+    body = _HEADER.pack(kind, seq & 0xff, len(payload)) + bytes(payload)
+    return SYNC + body + _CRC.pack(zlib.crc32(body))
+
+
+class FrameDecoder():
+    """Splits a byte stream into frames, the same way as the firmware:
+    bytes are skipped until the sync bytes, and a frame with a wrong CRC
+    is returned as invalid (the stream goes on after it).
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes.
+
+        Returns:
+            * list frames: The `Frame`s completed by `data`.
+        """
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        while True:
+            start = buffer.find(SYNC)
+            if start < 0:
+                # Keep a trailing first sync byte.
+                del buffer[:len(buffer) - 1 if buffer[-1:] == SYNC[:1]
+                           else len(buffer)]
+                return frames
+            del buffer[:start]
+            if len(buffer) < 2 + _HEADER.size:
+                return frames
+            kind, seq, length = _HEADER.unpack_from(buffer, 2)
+            if length > MAX_PAYLOAD:
+                frames.append(Frame(kind, seq, b"", valid=False))
+                del buffer[:2 + _HEADER.size]
+                continue
+            end = 2 + _HEADER.size + length + _CRC.size
+            if len(buffer) < end:
+                return frames
+            body = bytes(buffer[2:end - _CRC.size])
+            valid = zlib.crc32(body) == _CRC.unpack_from(buffer,
+                                                          end - _CRC.size)[0]
+            frames.append(Frame(kind, seq, body[_HEADER.size:], valid))
+            del buffer[:end]
+
+
+def pack_steps(steps):
+    """The bytes of a table of steps: (ODSR value, iterations) pairs
+    as little-endian 32-bit unsigned ints.
+    """
+    words = array("I")
+    if words.itemsize != 4:
+        words = array("L")
+    for odsr_value, iters in steps:
+        words.append(odsr_value)
+        words.append(iters)
+    if byteorder != "little":
+        words.byteswap()
+    return words.tobytes()
+
+
+def open_serial(port):
+    """Open a serial port (POSIX) in raw mode.
+
+    Returns:
+        * int fd: The file descriptor.
+    """
+    import termios
+    import tty
+
+    fd = os.open(port, os.O_RDWR | os.O_NOCTTY)
+    try:
+        tty.setraw(fd)
+        attrs = termios.tcgetattr(fd)
+        # The native USB port ignores the baud rate, but 1200 Bd on the
+        # programming port would erase the board.
+        attrs[4] = attrs[5] = termios.B115200
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    except termios.error:
+        pass  # not a terminal (e.g. a pipe)
+    return fd
+
+
+class PlayerClient():
+    """The host side of the protocol.
+
+    Args:
+        * port (str or int): The serial port of the resident player
+            (see `open_serial`), or an open file descriptor.
+
+    Kwargs:
+        * timeout (float): How long to wait for a reply (in seconds).
+            The device answers only between repetitions, so it has to
+            be longer than a repetition of the playing sequence.
+            Default: 2.0
+        * window (int): The number of `DATA` frames sent before waiting
+            for their replies.
+            Default: 8
+        * retries (int): How many times to resend a frame that timed out
+            or was corrupted.
+            Default: 3
+    """
+    def __init__(self, port, timeout=2.0, window=8, retries=3):
+        if not 0 < window < 128:
+            raise ValueError("The window has to be between 1 and 127 "
+                             "frames.")
+        self._owned = not isinstance(port, int)
+        self.fd = open_serial(port) if self._owned else port
+        self.timeout = timeout
+        self.window = window
+        self.retries = retries
+        self._decoder = FrameDecoder()
+        self._received = []
+        self._seq = 0
+
+    def close(self):
+        if self._owned and self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _send(self, kind, payload=b""):
+        seq = self._seq
+        self._seq = (seq + 1) & 0xff
+        frame = encode_frame(kind, seq, payload)
+        view = memoryview(frame)
+        while view:
+            view = view[os.write(self.fd, view):]
+        return seq
+
+    def _receive(self, timeout):
+        # The next valid frame, or `None` after `timeout`.
+        deadline = time.monotonic() + timeout
+        while not self._received:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or \
+                    not select.select([self.fd], [], [], remaining)[0]:
+                return None
+            data = os.read(self.fd, 65536)
+            if not data:
+                raise ProtocolError("The serial port was closed.")
+            self._received.extend(frame
+                                  for frame in self._decoder.feed(data)
+                                  if frame.valid)
+        return self._received.pop(0)
+
+    def request(self, kind, payload=b""):
+        """Send a frame and wait for its reply, resending it if it times
+        out or gets corrupted.
+
+        Returns:
+            * bytes payload: The payload of the reply.
+        """
+        for attempt in range(self.retries + 1):
+            seq = self._send(kind, payload)
+            deadline = time.monotonic() + self.timeout
+            while True:
+                frame = self._receive(max(deadline - time.monotonic(), 0))
+                if frame is None:
+                    break  # resend
+                if frame.seq != seq:
+                    continue  # a late reply to an earlier frame
+                if frame.kind == kind | REPLY:
+                    return frame.payload
+                if frame.kind == NAK:
+                    error = frame.payload[0] if frame.payload else 0
+                    if error == ERR_CRC:
+                        break  # resend
+                    raise ProtocolError(f"The device refused the frame: "
+                                        f"{ERRORS.get(error, error)}.",
+                                        error, attempt > 0)
+        raise ProtocolError("The device does not answer.")
+
+    def info(self):
+        """The capabilities of the device.
+
+        Returns:
+            * dict info: {"version": int, "buffers": int,
+                "max_payload": int, "max_steps": int}
+        """
+        version, buffers, max_payload, max_steps = \
+            struct.unpack("<BBHI", self.request(INFO))
+        return {"version": version, "buffers": buffers,
+                "max_payload": max_payload, "max_steps": max_steps}
+
+    def status(self):
+        """The state of the device.
+
+        Returns:
+            * dict status: {"generation": int (the number of committed
+                tables), "repetitions": int (of the playing table),
+                "steps": int (of the playing table), "loading": bool}
+        """
+        generation, repetitions, steps, loading = \
+            struct.unpack("<IIIB", self.request(STATUS))
+        return {"generation": generation, "repetitions": repetitions,
+                "steps": steps, "loading": bool(loading)}
+
+    def upload(self, steps):
+        """Load a table of steps into the inactive buffer and commit it,
+        so that it is played from the next repetition on.
+
+        Args:
+            * steps (list): (ODSR value, iterations) pairs.
+
+        Returns:
+            * int generation: The number of tables committed so far.
+        """
+        data = pack_steps(steps)
+        count = len(data) // 8
+        if not count:
+            raise ValueError("The table needs at least one step.")
+        self.request(BEGIN, struct.pack("<II", count, zlib.crc32(data)))
+
+        chunks = [struct.pack("<I", offset)
+                  + data[8 * offset:8 * (offset + DATA_STEPS)]
+                  for offset in range(0, count, DATA_STEPS)]
+        self._send_window(chunks)
+        try:
+            return struct.unpack("<I", self.request(COMMIT))[0]
+        except ProtocolError as e:
+            # If only the reply got lost, the resent `COMMIT` finds no
+            # table being loaded. Only a commit ends the loading.
+            if not e.resent or e.error != ERR_STATE:
+                raise
+            status = self.status()
+            if status["loading"]:
+                raise
+            return status["generation"]
+
+    def _send_window(self, chunks):
+        # Send the `DATA` frames, up to `window` of them unanswered.
+        # The frames write at fixed offsets, so resending them (in any
+        # order) is harmless.
+        pending = list(range(len(chunks)))[::-1]  # to be sent, last first
+        outstanding = {}  # seq: chunk
+        failures = 0
+        while pending or outstanding:
+            while pending and len(outstanding) < self.window:
+                i = pending.pop()
+                outstanding[self._send(DATA, chunks[i])] = i
+            frame = self._receive(self.timeout)
+            if frame is None or (frame.kind == NAK and frame.payload
+                                 and frame.payload[0] == ERR_CRC):
+                failures += 1
+                if failures > self.retries:
+                    raise ProtocolError("The device does not answer.")
+                if frame is not None and frame.seq in outstanding:
+                    pending.append(outstanding.pop(frame.seq))
+                elif frame is None:
+                    pending.extend(sorted(outstanding.values(),
+                                          reverse=True))
+                    outstanding.clear()
+                continue
+            if frame.seq not in outstanding:
+                continue  # a late reply to a resent frame
+            if frame.kind == NAK:
+                error = frame.payload[0] if frame.payload else 0
+                raise ProtocolError(f"The device refused the table: "
+                                    f"{ERRORS.get(error, error)}.")
+            if frame.kind == DATA | REPLY:
+                del outstanding[frame.seq]
+                failures = 0
+
+    def push(self, seq):
+        """Upload a compiled `Sequence` (see `Sequence.table_steps`).
+
+        Returns:
+            * int generation: See `upload`.
+        """
+        return self.upload(seq.table_steps())
+
+
+def _crc_table():
+    # The table of the (reflected) CRC-32 of `zlib.crc32`.
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0xedb88320 if crc & 1 else 0)
+        table.append(crc)
+    return table
+
+
+def firmware(max_steps=MAX_STEPS, triggered=False, parameter=None):
+    """The .ino source code of the resident player.
+
+    Kwargs:
+        * max_steps (int): The size of the two table buffers (steps).
+            Default: `MAX_STEPS`
+        * triggered (bool), parameter: See `codeblocks.setup`. The trigger
+            pin is polled (between the frames) instead of interrupting,
+            and the frames are handled while waiting for the trigger
+            or during the delay between repetitions.
+
+    Returns:
+        * str code
+    """
+    if not 0 < max_steps < 2**28:
+        raise ValueError("Invalid number of steps.")
+    if triggered:
+        trigger_pin = parameter if parameter else config.trigger_pin
+        if not (type(trigger_pin) is int and 0 <= trigger_pin <= 78):
+            raise ValueError("Trigger pin is not a valid Arduino Due pin.")
+        if trigger_pin in config.pulsebox_pins:
+            raise ValueError("Trigger pin is identical to a pulsebox pin.")
+        wait = "   int last = digitalRead(TRIGGER_PIN);\n" \
+               "   while (1) {\n" \
+               "      poll_serial();\n" \
+               "      int now = digitalRead(TRIGGER_PIN);\n" \
+               "      if (now && !last)\n" \
+               "         break;\n" \
+               "      last = now;\n" \
+               "   }\n"
+        defines = f"#define TRIGGER_PIN {trigger_pin}\n"
+        pin_setup = "   pinMode(TRIGGER_PIN, INPUT);\n"
+    else:
+        delay = parameter if parameter is not None \
+                else config.cont_mode_delay_ms
+        if int(delay) != delay or not 0 <= delay < 2**32:
+            raise ValueError("Continuous mode delay (ms) is not a 32-bit "
+                             "int.")
+        wait = "   uint32_t start = millis();\n" \
+               "   do\n" \
+               "      poll_serial();\n" \
+               "   while (millis() - start < DELAY_MS);\n"
+        defines = f"#define DELAY_MS {int(delay)}\n"
+        pin_setup = ""
+
+    crc_rows = [", ".join(f"0x{crc:08x}" for crc in row)
+                for row in zip(*[iter(_crc_table())] * 4)]
+    lines = [pcb.header() or "",
+             "// The resident player (see pulsebox/protocol.py).",
+             f"#define MAX_STEPS {max_steps}",
+             f"#define MAX_PAYLOAD {MAX_PAYLOAD}",
+             f"#define VERSION {VERSION}",
+             f"#define INFO {INFO:#04x}",
+             f"#define BEGIN {BEGIN:#04x}",
+             f"#define DATA {DATA:#04x}",
+             f"#define COMMIT {COMMIT:#04x}",
+             f"#define STATUS {STATUS:#04x}",
+             f"#define REPLY {REPLY:#04x}",
+             f"#define NAK {NAK:#04x}",
+             f"#define ERR_CRC {ERR_CRC}",
+             f"#define ERR_LENGTH {ERR_LENGTH}",
+             f"#define ERR_KIND {ERR_KIND}",
+             f"#define ERR_STATE {ERR_STATE}",
+             f"#define ERR_RANGE {ERR_RANGE}",
+             f"#define ERR_TABLE_CRC {ERR_TABLE_CRC}",
+             defines,
+             "const uint32_t CRC_TABLE[256] = {",
+             ",\n".join("   " + row for row in crc_rows),
+             "};\n"]
+    code = "\n".join(lines) + _FIRMWARE.format(
+        all_pins_enabled=config.all_pins_enabled, pin_setup=pin_setup,
+        wait=wait, player=pcb.player("LENGTHS[active]",
+                                     table="TABLES[active]"))
+    return code
+
+
+_FIRMWARE = """
+uint32_t TABLES[2][MAX_STEPS][2];
+uint32_t LENGTHS[2] = {{0, 0}};
+uint32_t active = 0;
+uint32_t generation = 0;
+uint32_t repetitions = 0;
+uint32_t loading = 0;
+uint32_t loading_length = 0;
+uint32_t loading_crc = 0;
+
+// The frame being received (without the sync bytes).
+uint8_t rx[8 + MAX_PAYLOAD];
+uint32_t rx_pos = 0;
+uint32_t rx_need = 0;
+uint32_t rx_state = 0;
+
+uint32_t crc32(const uint8_t *data, uint32_t length) {{
+   uint32_t crc = 0xffffffff;
+   for (uint32_t i = 0; i < length; i++)
+      crc = CRC_TABLE[(crc ^ data[i]) & 0xff] ^ (crc >> 8);
+   return crc ^ 0xffffffff;
+}}
+
+uint32_t read_u32(const uint8_t *data) {{
+   return data[0] | (data[1] << 8) | (data[2] << 16)
+          | ((uint32_t)data[3] << 24);
+}}
+
+void write_u32(uint8_t *data, uint32_t value) {{
+   for (int i = 0; i < 4; i++)
+      data[i] = (value >> (8 * i)) & 0xff;
+}}
+
+void reply(uint8_t kind, uint8_t seq, const uint8_t *payload,
+           uint32_t length) {{
+   uint8_t frame[32];
+   frame[0] = 0xa5;
+   frame[1] = 0x5a;
+   frame[2] = kind;
+   frame[3] = seq;
+   frame[4] = length & 0xff;
+   frame[5] = length >> 8;
+   memcpy(frame + 6, payload, length);
+   write_u32(frame + 6 + length, crc32(frame + 2, 4 + length));
+   SerialUSB.write(frame, 10 + length);
+}}
+
+void nak(uint8_t seq, uint8_t error) {{
+   reply(NAK, seq, &error, 1);
+}}
+
+void handle_frame() {{
+   uint8_t kind = rx[0];
+   uint8_t seq = rx[1];
+   uint32_t length = rx[2] | (rx[3] << 8);
+   const uint8_t *payload = rx + 4;
+   uint32_t back = 1 - active;
+   uint8_t out[16];
+   if (crc32(rx, 4 + length) != read_u32(rx + 4 + length)) {{
+      nak(seq, ERR_CRC);
+      return;
+   }}
+   switch (kind) {{
+   case INFO:
+      out[0] = VERSION;
+      out[1] = 2;
+      out[2] = MAX_PAYLOAD & 0xff;
+      out[3] = MAX_PAYLOAD >> 8;
+      write_u32(out + 4, MAX_STEPS);
+      reply(INFO | REPLY, seq, out, 8);
+      break;
+   case BEGIN:
+      if (length != 8) {{
+         nak(seq, ERR_LENGTH);
+      }} else if (read_u32(payload) == 0
+                 || read_u32(payload) > MAX_STEPS) {{
+         nak(seq, ERR_RANGE);
+      }} else {{
+         loading = 1;
+         loading_length = read_u32(payload);
+         loading_crc = read_u32(payload + 4);
+         reply(BEGIN | REPLY, seq, out, 0);
+      }}
+      break;
+   case DATA:
+      if (!loading) {{
+         nak(seq, ERR_STATE);
+      }} else if (length < 4 || (length - 4) % 8) {{
+         nak(seq, ERR_LENGTH);
+      }} else if (read_u32(payload) > loading_length
+                 || (length - 4) / 8 > loading_length - read_u32(payload)) {{
+         nak(seq, ERR_RANGE);
+      }} else {{
+         memcpy(TABLES[back][read_u32(payload)], payload + 4, length - 4);
+         reply(DATA | REPLY, seq, out, 0);
+      }}
+      break;
+   case COMMIT:
+      if (!loading) {{
+         nak(seq, ERR_STATE);
+      }} else if (crc32((const uint8_t *)TABLES[back], 8 * loading_length)
+                 != loading_crc) {{
+         nak(seq, ERR_TABLE_CRC);
+      }} else {{
+         // Frames are handled only between repetitions, so the swap
+         // happens at a repetition boundary.
+         LENGTHS[back] = loading_length;
+         active = back;
+         loading = 0;
+         generation++;
+         repetitions = 0;
+         write_u32(out, generation);
+         reply(COMMIT | REPLY, seq, out, 4);
+      }}
+      break;
+   case STATUS:
+      write_u32(out, generation);
+      write_u32(out + 4, repetitions);
+      write_u32(out + 8, LENGTHS[active]);
+      out[12] = loading;
+      reply(STATUS | REPLY, seq, out, 13);
+      break;
+   default:
+      nak(seq, ERR_KIND);
+   }}
+}}
+
+void receive(uint8_t byte) {{
+   if (rx_state == 0) {{
+      if (byte == 0xa5)
+         rx_state = 1;
+      return;
+   }}
+   if (rx_state == 1) {{
+      if (byte == 0x5a) {{
+         rx_state = 2;
+         rx_pos = 0;
+         rx_need = 4;
+      }} else if (byte != 0xa5) {{
+         rx_state = 0;
+      }}
+      return;
+   }}
+   rx[rx_pos++] = byte;
+   if (rx_pos == 4) {{
+      uint32_t length = rx[2] | (rx[3] << 8);
+      if (length > MAX_PAYLOAD) {{
+         nak(rx[1], ERR_LENGTH);
+         rx_state = 0;
+         return;
+      }}
+      rx_need = 8 + length;
+   }}
+   if (rx_pos == rx_need) {{
+      handle_frame();
+      rx_state = 0;
+   }}
+}}
+
+void poll_serial() {{
+   // At most a frame at a time, so that the pause between repetitions
+   // stays short while a table is being loaded.
+   for (int n = 0; n < 10 + MAX_PAYLOAD && SerialUSB.available(); n++)
+      receive(SerialUSB.read());
+}}
+
+void sequence() {{
+   if (LENGTHS[active] == 0)
+      return;
+   noInterrupts();
+{player}
+   interrupts();
+   repetitions++;
+}}
+
+void setup() {{
+   REG_PIOC_OER = {all_pins_enabled};
+   REG_PIOC_OWER = {all_pins_enabled};
+{pin_setup}   SerialUSB.begin(0);
+}}
+
+void loop() {{
+{wait}   sequence();
+}}
+"""
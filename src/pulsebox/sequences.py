@@ -8,104 +8,531 @@ Radim Hošák <hosak(at)optics.upol.cz>
 2021 Quantum Optics Lab Olomouc
 """
 
-from copy import deepcopy
-from operator import attrgetter
+import os
+
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import groupby, zip_longest
+from math import gcd
+from operator import attrgetter, itemgetter
 
 import pulsebox.codeblocks as pcb
+import pulsebox.config as pcfg
+import pulsebox.passes as ppass
+import pulsebox.profiling as pprof
 import pulsebox.events as pev
-from pulsebox.config import pulsebox_pincount
+
+# The size of a step of the table-driven code (two 32-bit values).
+TABLE_STEP_BYTES = 8
 
 
 class FlipSequence():
-    def __init__(self, flips = []):
+    def __init__(self, flips=()):
+        # Lists of `FlipEvent` instances are converted to a `FlipTable`.
+        if not isinstance(flips, pev.FlipTable):
+            flips = pev.FlipTable.from_flips(flips)
         self.flips = flips
 
+    @property
+    def trains(self):
+        """The compact pulse trains (see `events.PulseTrain`)."""
+        return self.flips.trains
+
     def sort_flips(self):
-        self.flips.sort(key=attrgetter("timestamp"))
+        self.flips.sort()
 
 
 class Sequence():
-    def __init__(self, events = [], triggered=False, parameter=1000):
+    def __init__(self, events = [], triggered=False, parameter=None):
         self.events = events
         self.loop_counter = 0
+        self.repeat_counter = 0
         self.time = 0
         self.triggered = triggered
         self.parameter = parameter
+        # The configuration the sequence was compiled with.
+        self.config = pcfg.current()
+
+    def iter_code(self, codegen=None):
+        """Generate the .ino source code piece by piece.
+
+        Yields the header, the setup, the individual code blocks
+        and the end, each terminated by a newline (except the end).
+        The code blocks are formatted (with the configuration
+        of the sequence) in batches, as they are needed.
 
-    def code(self):
-        code = "\n".join([pcb.header(), pcb.setup(), ""])
+        Kwargs:
+            * codegen (str): "unrolled" (a code block for every event)
+                or "table" (a table of steps, see `table_steps`).
+                Default: See `codegen` in config.ini.
+        """
+        with self.config:
+            codegen = codegen if codegen else self.config.codegen
+            if codegen == "table":
+                steps = self.table_steps()
+            elif codegen != "unrolled":
+                raise ValueError("Unknown code generation mode: "
+                                 f"{codegen!r}.")
+            header = pcb.header()
+            setup = pcb.setup(triggered=self.triggered,
+                              parameter=self.parameter)
+        yield header + "\n"
+        if codegen == "table":
+            yield from self._iter_table_code(steps, setup)
+            return
+        yield setup + "\n"
         if not self.events:
-            code += "   ;\n"
+            yield "   ;\n"
+        batch_size = 1024
+        for start in range(0, len(self.events), batch_size):
+            with self.config:
+                codeblocks = [event.codeblock + "\n" for event
+                              in self.events[start:start + batch_size]]
+            yield from codeblocks
+        yield pcb.end()
+
+    def _iter_table_code(self, steps, setup):
+        # The table of steps (a global) comes before the setup.
+        yield pcb.step_table(len(steps)) + "\n"
+        batch_size = 1024
+        for start in range(0, len(steps), batch_size):
+            with self.config:
+                rows = [pcb.step(odsr, iters) + "\n" for odsr, iters
+                        in steps[start:start + batch_size]]
+            yield from rows
+        yield pcb.step_table_end() + "\n"
+        yield setup + "\n"
+        yield pcb.player(len(steps)) + "\n"
+        yield pcb.end()
+
+    def table_steps(self):
+        """The steps of the table-driven player (see `codeblocks.player`):
+        (ODSR value, delay loop iterations after writing it) pairs.
+
+        The edges are played at the times the unrolled code would produce
+        them (see `events.TimingModel`), with the delays planned from
+        the absolute times. Every step takes `table_step_cycles` (see
+        config.ini) besides its delay, so edges closer together than that
+        are timing violations. The counted loops are expanded, and
+        the writes that do not change the state are left out.
+
+        Returns:
+            * list steps: At least one step.
+        """
+        with self.config:
+            edges = list(pev.TimingModel().edges(self.events))
+            # The player starts by writing the first step. If the first
+            # edge is not at the very start, the first step only writes
+            # the initial state (all channels off).
+            if not edges or edges[0][0] > 0:
+                edges.insert(0, (0, 0))
+            times, odsr_values = zip(*edges)
+            planned = pev.TimingModel(codegen="table").plan(times)
+        steps = list(zip(odsr_values, planned[1:] + [0]))
+        if any(iters >= 2**32 for _, iters in steps):
+            raise ValueError("A delay is too long for the table-driven "
+                             "player.")
+        return steps
+
+    def code(self, codegen=None):
+        with pprof.stage("code", items=len(self.events)):
+            return "".join(self.iter_code(codegen))
+
+    def write_code(self, fileobj, chunk_size=65536, codegen=None):
+        """Stream the .ino source code into an open (text) file object.
+
+        The code blocks are collected into chunks of roughly `chunk_size`
+        characters before being written, so that the whole source code
+        never has to be held in memory at once.
+
+        Kwargs:
+            * codegen (str): See `iter_code`.
+
+        Returns:
+            * int written: The number of characters written.
+        """
+        written = 0
+        chunk, chunk_length = [], 0
+        with pprof.stage("write_code", items=len(self.events)):
+            for piece in self.iter_code(codegen):
+                chunk.append(piece)
+                chunk_length += len(piece)
+                if chunk_length >= chunk_size:
+                    fileobj.write("".join(chunk))
+                    written += chunk_length
+                    chunk, chunk_length = [], 0
+            fileobj.write("".join(chunk))
+            written += chunk_length
+        return written
+
+    @classmethod
+    def from_flip_sequence(cls, fs, triggered=False, parameter=None,
+                           backend="loop"):
+        """Compile a `FlipSequence` into low-level delay and state change events.
+
+        Kwargs:
+            * triggered (bool), parameter: See `codeblocks.setup`.
+            * backend (str): The compiler backend to use.
+                - "loop": walk the flips one by one (pure Python).
+                - "numpy": process all flips at once using NumPy arrays.
+                Both backends produce identical sequences.
+                Default: "loop"
+
+        Pulse trains that no other flip interferes with are compiled into
+        counted loops (see `_train_events`). The other ones are expanded
+        into individual flips.
+        """
+        if fs.trains:
+            with pprof.stage("split_trains", items=len(fs.trains)):
+                flips, trains = _split_trains(fs.flips)
+            new_sequence = cls.from_flip_sequence(
+                FlipSequence(flips), triggered=triggered,
+                parameter=parameter, backend=backend)
+            with pprof.stage("insert_trains", items=len(trains)):
+                new_sequence.insert_trains(trains)
+            return new_sequence
+
+        if backend == "numpy":
+            compile_flips = cls._from_flip_sequence_numpy
+        elif backend == "loop":
+            compile_flips = cls._from_flip_sequence_loop
         else:
-            code += "\n".join([event.codeblock for event in self.events] + [""])
-        code += pcb.end()
-        return code
+            raise ValueError(f"Unknown compiler backend: {backend!r}.")
+        with pprof.stage("from_flip_sequence",
+                         items=len(fs.flips.timestamps)):
+            return compile_flips(fs, triggered=triggered, parameter=parameter)
 
     @classmethod
-    def from_flip_sequence(cls, fs, triggered=False, parameter=1000):
-        events = []  # We will store the low-level events here
-        time = 0  # keep track of 'current' time as we go through the flips
+    def _from_flip_sequence_loop(cls, fs, triggered=False, parameter=None):
+        """The pure Python backend of `from_flip_sequence`.
+        """
+        if not fs.flips:
+            return cls([])
+
+        # Sort a copy of the flip table, so that the flip sequence
+        # itself stays untouched.
+        with pprof.stage("sort_flips"):
+            flips = fs.flips.copy()
+            flips.sort()
+
+        # Go through all of the flips (grouped by their timestamps) and
+        # collect the channels flipped at every timestamp into a mask.
+        # Also check that we are not going to flip the same channel
+        # more than once. Raise an error if that is the case.
+        times = []
+        flip_masks = []
+        for timestamp, group in groupby(zip(flips.timestamps, flips.channels),
+                                        key=itemgetter(0)):
+            flip_mask = 0
+            for _, channel in group:
+                if flip_mask >> channel & 1:
+                    raise ValueError("Multiple flips of the same channel " \
+                                     "occuring at the same time are forbidden.")
+                flip_mask |= 1 << channel
+            times.append(timestamp)
+            flip_masks.append(flip_mask)
+        time = times[-1]
+
+        # Every channel starts at 0. The channel states (and the ODSR values)
+        # are converted from the flip masks all at once.
+        states = zip(*pcb.flip_masks_to_odsr(flip_masks))
+
+        # Create the low level `DelayEvent` and `StateChangeEvent` instances.
+        # The delays are planned from the absolute timestamps rather than
+        # from their differences, so that the rounding errors do not
+        # accumulate.
+        with pprof.stage("plan_delays", items=len(times)):
+            planned_iters = pev.TimingModel().plan(times)
+        events = []
         loop_counter = 0
-        channel_states = [0] * pulsebox_pincount  # Every channels starts at 0.
+        for required_iters, (state_mask, odsr) in zip(planned_iters, states):
+            if required_iters > 0:
+                events.append(pev.DelayEvent(iters=required_iters,
+                                             loop_suffix=str(loop_counter)))
+                loop_counter += 1
+            events.append(pev.StateChangeEvent(state_mask, odsr=odsr))
+
+        new_sequence = cls(events, triggered=triggered, parameter=parameter)
+        new_sequence.time = time
+        new_sequence.loop_counter = loop_counter
+
+        return new_sequence
+
+    @classmethod
+    def _from_flip_sequence_numpy(cls, fs, triggered=False, parameter=None):
+        """The array-based counterpart of `from_flip_sequence`.
+
+        Flips are grouped by their timestamps. Every group is turned into
+        an XOR bitmask (both over channels and over `pulsebox_pins`), so that
+        a cumulative XOR over the groups gives us the channel states and
+        the `REG_PIOC_ODSR` values at every timestamp. The delays are the
+        differences between neighbouring timestamps, quantized
+        to delay loop iterations.
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("The numpy backend requires NumPy.")
 
         if not fs.flips:
-            return cls(events)
-
-        # This technique relies on using `pop()`, which eliminates the last
-        # element of an array. So (1) we copy the array of flip events and
-        # (2) we are going to reverse it, so `pop()` effectively eliminates
-        # the first (smallest-timestamp) element.
-        flips = deepcopy(fs.flips)
-        flips.sort(key=attrgetter("timestamp"), reverse=True)
-
-        # Go through all of the flips and create low level
-        # `DelayEvent` and `StateChangeEvent` instances as needed.
-        flip = flips.pop()
-        out_of_flips = False
-        while True:
-            # Check the timestamp of the flip. Do we need a delay?
-            required_delay = flip.timestamp - time
-            required_iters = pev.time2iters(required_delay)
+            return cls([])
+
+        # The flip table columns are read without copying.
+        channels = np.frombuffer(fs.flips.channels, dtype=np.uint8)
+        channels = channels.astype(np.int64)
+        timestamps = np.frombuffer(fs.flips.timestamps, dtype=np.int64)
+
+        # Sort by timestamp, then by channel. This way, multiple flips
+        # of the same channel at the same time end up next to each other.
+        order = np.lexsort((channels, timestamps))
+        channels = channels[order]
+        timestamps = timestamps[order]
+
+        same_time = timestamps[1:] == timestamps[:-1]
+        if np.any(same_time & (channels[1:] == channels[:-1])):
+            raise ValueError("Multiple flips of the same channel " \
+                             "occuring at the same time are forbidden.")
+
+        # Indices of the first flip of every timestamp group
+        group_starts = np.flatnonzero(np.concatenate(([True], ~same_time)))
+        group_times = timestamps[group_starts]
+
+        cfg = pcfg.current()
+        pin_masks = np.array(cfg.pin_masks, dtype=np.int64)
+        state_masks = np.bitwise_xor.accumulate(
+            np.bitwise_xor.reduceat(np.left_shift(1, channels), group_starts))
+        odsr_values = np.bitwise_xor.accumulate(
+            np.bitwise_xor.reduceat(pin_masks[channels], group_starts))
+
+        # Quantize the absolute timestamps (just like `time2iters` does,
+        # rounding half to even), then take the differences. With
+        # the per-block overheads of the timing model, the delays
+        # are planned one by one.
+        if group_times[0] < 0:
+            raise ValueError("Negative time is not allowed.")
+        timing = pev.TimingModel()
+        if timing.ideal:
+            calibration_ticks = timing.calibration_ticks
+            quotients, remainders = np.divmod(group_times, calibration_ticks)
+            quotients += (2 * remainders > calibration_ticks) \
+                         | ((2 * remainders == calibration_ticks)
+                            & (quotients % 2 == 1))
+            iters = np.diff(quotients, prepend=0)
+        else:
+            iters = np.array(timing.plan(group_times.tolist()))
+
+        events = []
+        loop_counter = 0
+        for required_iters, state_mask, odsr in zip(iters.tolist(),
+                                                    state_masks.tolist(),
+                                                    odsr_values.tolist()):
             if required_iters > 0:
                 events.append(pev.DelayEvent(iters=required_iters,
                                              loop_suffix=str(loop_counter)))
                 loop_counter += 1
-            time += required_delay  # advance time
-
-            # Change the channel state for all channels where a flip
-            # is occuring right at this time.
-            # Also check that we are not going to flip the same channel
-            # more than once. Raise an error if that is the case.
-            flipped_channels = []
-            while flip.timestamp == time:
-                if flip.channel in flipped_channels:
-                    raise ValueError("Multiple flips of the same channel " \
-                                     "occuring at the same time are forbidden.")
-                channel_states[flip.channel] += 1
-                channel_states[flip.channel] %= 2
-                flipped_channels.append(flip.channel)
-                if flips:
-                    flip = flips.pop()
-                else:
-                    out_of_flips = True
-                    break
-
-            # Funny thing: If you create a StateChangeEvent with given
-            # channel_states and then change this variable later on, the
-            # event changes as well. Using deepcopy to prevent this.
-            events.append(pev.StateChangeEvent(deepcopy(channel_states)))
-
-            if out_of_flips:
-                break
+            events.append(pev.StateChangeEvent(state_mask, odsr=odsr))
 
         new_sequence = cls(events, triggered=triggered, parameter=parameter)
-        new_sequence.time = time
+        new_sequence.time = group_times[-1].item()
         new_sequence.loop_counter = loop_counter
 
         return new_sequence
 
+    def insert_trains(self, trains):
+        """Insert the events of (compact) pulse trains into the sequence.
+
+        No flips of the sequence may lie within the time span of a train,
+        so every train fits into a single delay of the sequence (or after
+        its end). That delay is split around the events of the train.
+        """
+        trains = sorted(trains, key=attrgetter("timestamp"))
+        events = []
+        channel_mask = 0
+        timing = pev.TimingModel(self.config)  # keeps track of the time
+        k = 0  # the next train to insert
+
+        def insert(until=None):
+            # Insert the trains starting before the time `until` (in ticks).
+            nonlocal k
+            while k < len(trains) and (until is None
+                                       or timing.delay_iters(trains[k].timestamp)
+                                       < timing.delay_iters(until)):
+                lead_iters = timing.delay_iters(trains[k].timestamp)
+                if lead_iters > 0:
+                    events.append(pev.DelayEvent(
+                        iters=lead_iters, loop_suffix=str(self.loop_counter)))
+                    self.loop_counter += 1
+                    timing.delay(lead_iters)
+                train_events, self.loop_counter, self.repeat_counter = \
+                    _train_events(trains[k], channel_mask, timing,
+                                  self.loop_counter, self.repeat_counter)
+                events.extend(train_events)
+                k += 1
+
+        for event in self.events:
+            if isinstance(event, pev.DelayEvent):
+                # The time at which the following state change should end
+                until = timing.time + timing.loop_ticks \
+                        + event.iters * timing.calibration_ticks \
+                        + timing.write_ticks
+                insert(until)
+                iters = timing.delay_iters(until)
+                if iters > 0:
+                    events.append(pev.DelayEvent(
+                        iters=iters, loop_suffix=event.loop_suffix))
+                    timing.delay(iters)
+            else:
+                if isinstance(event, pev.StateChangeEvent):
+                    channel_mask = event.channel_mask
+                timing.run([event])
+                events.append(event)
+        insert()
+
+        self.events = events
+        if trains:
+            self.time = max(self.time, max(train.end for train in trains))
+
+    def timing_report(self, fs):
+        """Compare the expected time of every edge (see
+        `events.TimingModel`) with its requested time, channel by channel
+        (like `simulator.compare`).
+
+        Args:
+            * fs (FlipSequence): The flip sequence the sequence
+                was compiled from.
+
+        Returns:
+            * list report: (channel, requested, expected) triples, one
+                for every edge, in the order of the times (in ticks).
+                The edges of a channel are paired in their order. If the
+                numbers of edges of a channel differ, the expected time
+                of a missing edge is `None`, and so is the requested time
+                of an extra one.
+        """
+        requested = {}
+        flips = fs.flips.expanded()
+        for channel, timestamp in zip(flips.channels, flips.timestamps):
+            requested.setdefault(channel, []).append(timestamp)
+        expected = {}
+        pin_channels = self.config.pin_channels
+        odsr = 0
+        for time, value in pev.TimingModel(self.config).edges(self.events):
+            changed, odsr = odsr ^ value, value
+            while changed:
+                bit = changed & -changed
+                changed ^= bit
+                channel = pin_channels.get(bit.bit_length() - 1)
+                if channel is not None:
+                    expected.setdefault(channel, []).append(time)
+        report = []
+        for channel in sorted(set(requested) | set(expected)):
+            report.extend((channel, wanted, got) for wanted, got in
+                          zip_longest(sorted(requested.get(channel, [])),
+                                      expected.get(channel, [])))
+        report.sort(key=lambda edge: (edge[2] if edge[1] is None
+                                      else edge[1], edge[0]))
+        return report
+
+    def estimated_flash_bytes(self, codegen=None):
+        """Estimate the size (in bytes) of the compiled sketch.
+
+        The estimate is the sum of the per-block costs given in the `Flash`
+        section of config.ini, so it is available long before the actual
+        (slow) compilation.
+
+        Kwargs:
+            * codegen (str): See `iter_code`. The table-driven code takes
+                `TABLE_STEP_BYTES` for every state change (the counted loops
+                expanded) and one more, plus the player.
+        """
+        codegen = codegen if codegen else self.config.codegen
+        if codegen == "table":
+            return self.config.flash_base_bytes \
+                   + self.config.flash_table_player_bytes \
+                   + TABLE_STEP_BYTES * (_count_state_changes(self.events)
+                                         + 1)
+        return self.config.flash_base_bytes \
+               + sum(event.flash_bytes for event in self.events)
+
+    def check_flash_budget(self, budget=None):
+        """Raise a `ValueError` if the sketch would not fit into flash.
+
+        Kwargs:
+            * budget (int): The flash budget (in bytes).
+                Default: See `budget` in the `Flash` section of config.ini.
+        """
+        budget = budget if budget else self.config.flash_budget
+        estimate = self.estimated_flash_bytes()
+        if estimate > budget:
+            raise ValueError(f"The sequence does not fit into flash memory " \
+                             f"(estimated {estimate} B, budget {budget} B).")
+
+    def fit_flash_budget(self, budget=None):
+        """Make sure the sequence fits into flash, compressing it if needed.
+
+        Returns:
+            * Sequence fitting: This sequence, or its compressed version.
+
+        Raises a `ValueError` if even the compressed sequence does not fit.
+        The table-driven code (see `iter_code`) cannot be compressed.
+        The optimizer passes (see `optimize`) are not run, they are left
+        to the caller.
+        """
+        if self.config.codegen == "table":
+            self.check_flash_budget(budget)
+            return self
+        try:
+            self.check_flash_budget(budget)
+            return self
+        except ValueError:
+            compressed = self.compress()
+            compressed.check_flash_budget(budget)
+            return compressed
+
+    def optimize(self, passes=None):
+        """Run optimizer passes over the events (see `passes.PassManager`).
+
+        Kwargs:
+            * passes (list): The passes to run.
+                Default: `passes.DEFAULT_PASSES`
+
+        Returns:
+            * Sequence optimized: A new, optimized sequence.
+            * list results: What every pass saved (`passes.PassResult`).
+        """
+        with self.config, pprof.stage("optimize", items=len(self.events)):
+            events, results = ppass.PassManager(passes).run(self.events)
+            optimized = type(self)(events, triggered=self.triggered,
+                                   parameter=self.parameter)
+        optimized.time = self.time
+        suffixes = _loop_suffixes(events)
+        optimized.loop_counter = max(suffixes["loop"], default=-1) + 1
+        optimized.repeat_counter = max(suffixes["repeat"], default=-1) + 1
+        return optimized, results
+
+    def compress(self, max_period=256, min_saved_events=4):
+        """Find repeated runs of events and put them inside counted loops.
+
+        See `compress_events` for details.
+
+        Returns:
+            * Sequence compressed: A new, compressed sequence.
+        """
+        with self.config, pprof.stage("compress", items=len(self.events)):
+            events, repeat_counter = compress_events(
+                self.events, max_period=max_period,
+                min_saved_events=min_saved_events,
+                repeat_counter=self.repeat_counter)
+            compressed = type(self)(events, triggered=self.triggered,
+                                    parameter=self.parameter)
+        compressed.time = self.time
+        compressed.loop_counter = self.loop_counter
+        compressed.repeat_counter = repeat_counter
+        return compressed
+
     def __repr__(self):
-        msg = f"Sequence - duration: {self.time} s, loops: {self.loop_counter}\n"
+        msg = f"Sequence - duration: {pev.ticks2seconds(self.time)} s, " \
+              f"loops: {self.loop_counter}\n"
         # msg += "\t* " + str(self.events[:10]).strip("[]").replace(", ",
                                                                     # "\n\t* ")
         if self.time > 0:
@@ -113,3 +540,770 @@ class Sequence():
         # if len(self.events) > 10:
         #     msg += "\n\t* ..."
         return msg
+
+
+def _event_token(event):
+    """A hashable description of what a low-level event does.
+    Loop suffixes are ignored, so that repetitions compare as equal.
+    """
+    if isinstance(event, pev.DelayEvent):
+        return ("d", event.iters)
+    if isinstance(event, pev.StateChangeEvent):
+        return ("s", event.odsr)
+    return ("r", event.count, tuple(map(_event_token, event.events)))
+
+def _code_length(events):
+    """The number of delays and state changes in the code of a list of
+    low-level events (the counted loops not expanded).
+    """
+    return sum(_code_length(event.events)
+               if isinstance(event, pev.RepeatEvent) else 1
+               for event in events)
+
+def _repeat_events(body, count, offset, timing, limit, repeat_counter,
+                   body_errors=None, max_levels=32):
+    """Put `count` repetitions of a block of events into counted loops,
+    compensating the counted loop overhead.
+
+    The overhead (`repeat_overhead_cycles` in config.ini) is not a whole
+    number of delay loop iterations, so shortening the first delay of the
+    block only compensates it up to a fraction of an iteration (the drift),
+    which would accumulate over the repetitions. Instead, the loops are
+    nested. Every level is a single copy of a lower level, correcting
+    the error, followed by a counted loop of the level below it, so that
+    the drift of a level is the remainder of the drifts of the two levels
+    below (as in the Euclidean algorithm). The drifts alternate in sign
+    and shrink, down to zero, while the errors within a level stay within
+    about one delay loop iteration. The levels are combined greedily
+    (with single copies of the block in between), so that every edge
+    stays within `limit` of its time in the reference timing.
+
+    Args:
+        * body (list): The events of the block, starting with
+            a `DelayEvent`.
+        * count (int): The number of repetitions.
+        * offset (int): The error at the start (ticks, how late the first
+            repetition starts, relative to the reference timing).
+        * timing (TimingModel): The costs of the generated code.
+        * limit (int): The largest allowed error of an edge (ticks).
+        * repeat_counter (int): The loop suffix of the first new counted
+            loop.
+
+    Kwargs:
+        * body_errors (list): The errors of a single copy of the block,
+            relative to its start: a (start, lowest, highest) tuple for
+            every event (the error at its start and the extreme errors
+            of its edges), and one for the end of the block.
+            Default: `None` (the block is the reference)
+        * max_levels (int): The maximum depth of the counted loops.
+            Default: 32
+
+    Returns:
+        * list events: The events, or `None` if the first delay
+            of the block is too short to be adjusted.
+        * list errors: The (start, lowest, highest) errors of the events.
+        * int offset: The error at the end (ticks).
+        * int repeat_counter: The loop suffix of the next counted loop.
+    """
+    repeat_ticks = timing.repeat_ticks
+    calibration_ticks = timing.calibration_ticks
+    if body_errors is None:
+        body_errors = [(0, 0, 0)] * (len(body) + 1)
+    block_error = body_errors[-1][0]
+    first_lowest = min(lowest for _, lowest, _ in body_errors)
+    first_highest = max(highest for _, _, highest in body_errors)
+    delay = body[0]
+    too_short = False
+
+    def adjusted(iters):
+        # A copy of the block, its first delay adjusted by `iters`.
+        nonlocal too_short
+        too_short = too_short or delay.iters + iters < 1
+        return [pev.DelayEvent(iters=max(delay.iters + iters, 1),
+                               loop_suffix=delay.loop_suffix)] + body[1:]
+
+    # The levels, as tuples (the lower level copied, the adjustment
+    # of its first delay, the repetitions of the level below, blocks,
+    # lowest and highest error of the edges, drift), the errors relative
+    # to the start of a repetition in a counted loop. The first level
+    # is the block, its first delay compensating the overhead (up to the
+    # drift).
+    adjust = -round((repeat_ticks + block_error) / calibration_ticks)
+    start = repeat_ticks + adjust * calibration_ticks
+    drift = start + block_error
+    levels = [(None, adjust, 0, 1, start + first_lowest,
+               start + first_highest, drift)]
+    # The level before the first one is the block, its first delay
+    # adjusted the other way.
+    lower, lower_adjust = 0, -1 if drift > 0 else 1
+    while drift and len(levels) < max_levels:
+        _, _, _, blocks, lowest, highest, drift = levels[-1]
+        _, _, _, x_blocks, x_lowest, x_highest, x_drift = levels[lower]
+        shift = lower_adjust * calibration_ticks
+        n = abs(x_drift + shift) // abs(drift)
+        if x_blocks + n * blocks > count:
+            break
+        levels.append((lower, lower_adjust, n, x_blocks + n * blocks,
+                       min(x_lowest + shift, x_drift + shift + lowest
+                           + min(0, (n - 1) * drift)),
+                       max(x_highest + shift, x_drift + shift + highest
+                           + max(0, (n - 1) * drift)),
+                       x_drift + shift + n * drift))
+        lower, lower_adjust = len(levels) - 2, 0
+        drift = levels[-1][6]
+
+    def instance(depth, iters=0):
+        # The events of a repetition of a level (with new loop suffixes).
+        nonlocal repeat_counter
+        lower, adjust, n = levels[depth][:3]
+        if lower is None:
+            return adjusted(adjust + iters)
+        events = instance(lower, adjust + iters)
+        events.append(pev.RepeatEvent(instance(depth - 1), n,
+                                      loop_suffix=str(repeat_counter)))
+        repeat_counter += 1
+        return events
+
+    def loops(offset, remaining):
+        # The level and the number of its repetitions covering the most
+        # blocks, without exceeding the limit.
+        best = (None, 0, 0)
+        for depth, (_, _, _, blocks, lowest, highest,
+                    drift) in enumerate(levels):
+            if blocks > remaining or offset + lowest < -limit \
+                    or offset + highest > limit:
+                continue
+            # The end of the loop (the error of an edge right after it)
+            # is within the limit as well.
+            m = remaining // blocks
+            if drift > 0:
+                m = min(m, (limit - offset - highest) // drift + 1,
+                        (limit - offset) // drift)
+            elif drift < 0:
+                m = min(m, (offset + lowest + limit) // -drift + 1,
+                        (offset + limit) // -drift)
+            if m * blocks > best[2]:
+                best = (depth, m, m * blocks)
+        return best
+
+    def merit(iters):
+        # Whether a single copy of the block, its first delay adjusted
+        # by `iters`, stays within the limit, and the blocks covered
+        # by the loops following it.
+        start = offset + iters * calibration_ticks
+        return (-limit <= min(start + first_lowest, start + block_error)
+                and max(start + first_highest, start + block_error) <= limit,
+                loops(start + block_error, remaining - 1)[2])
+
+    events, errors = [], []
+    remaining = count
+    while remaining:
+        depth, m, blocks = loops(offset, remaining)
+        if blocks < 2:
+            # A single copy of the block, its first delay correcting
+            # the error, so that the loops to follow fit in the limit.
+            nearest = -round(offset / calibration_ticks)
+            iters = max((nearest, nearest - 1, nearest + 1), key=merit)
+            start = offset + iters * calibration_ticks
+            events.extend(adjusted(iters))
+            errors.append((offset, start, start))
+            errors.extend((start + first, start + lowest, start + highest)
+                          for first, lowest, highest in body_errors[1:-1])
+            offset = start + block_error
+            remaining -= 1
+            continue
+        _, _, _, _, lowest, highest, drift = levels[depth]
+        events.append(pev.RepeatEvent(instance(depth), m,
+                                      loop_suffix=str(repeat_counter)))
+        errors.append((offset, offset + lowest + min(0, (m - 1) * drift),
+                       offset + highest + max(0, (m - 1) * drift)))
+        repeat_counter += 1
+        offset += m * drift
+        remaining -= blocks
+    if too_short:
+        return None, None, offset, repeat_counter
+    return events, errors, offset, repeat_counter
+
+def _compress_once(events, errors, max_period, min_saved_events, timing,
+                   repeat_counter, gram_length=4, max_candidates=4):
+    """A single pass of `compress_events`.
+
+    `errors` are the (start, lowest, highest) errors of the events
+    (see `_repeat_events`), relative to the uncompressed events, and
+    of their end, or `None` for the uncompressed events themselves.
+
+    Returns the new list of events and their errors (or `None`s,
+    if nothing was compressed) and the new repeat counter.
+    """
+    calibration_ticks = timing.calibration_ticks
+    overhead_iters = pev.time2iters(timing.repeat_ticks, calibration_ticks)
+    # Blocks shorter than a gram are found through their repetitions.
+    gram_length = min(gram_length, max_period)
+    # Intern the event tokens as small ints.
+    token_ids = {}
+    tokens = [token_ids.setdefault(_event_token(event), len(token_ids))
+              for event in events]
+    n = len(tokens)
+
+    # Polynomial rolling hash over the tokens. The hash of any window
+    # can be calculated from the prefix hashes in constant time.
+    modulus, base = (1 << 61) - 1, 1000003
+    prefix = [0] * (n + 1)
+    for i, token in enumerate(tokens):
+        prefix[i + 1] = (prefix[i] * base + token + 1) % modulus
+    powers = [1] * (max_period + 1)
+    for p in range(1, max_period + 1):
+        powers[p] = powers[p - 1] * base % modulus
+
+    def window_hash(start, length):
+        return (prefix[start + length] - prefix[start] * powers[length]) \
+               % modulus
+
+    # For every position, find the next position where the same
+    # `gram_length` tokens start. These are our candidate periods.
+    next_gram = [-1] * n
+    last_seen = {}
+    for i in range(n - gram_length, -1, -1):
+        gram = window_hash(i, gram_length)
+        next_gram[i] = last_seen.get(gram, -1)
+        last_seen[gram] = i
+
+    # The lowest and the highest error of the events from every position
+    # up to the next delay (where the error can be corrected again).
+    limit = calibration_ticks
+    segments = [(0, 0)] * (n + 1)
+    if errors is not None:
+        segments[n] = errors[n][:2]
+        for i in range(n - 1, -1, -1):
+            if isinstance(events[i], pev.DelayEvent):
+                segments[i] = (errors[i][0], errors[i][0])
+            else:
+                segments[i] = (min(errors[i][1], segments[i + 1][0]),
+                               max(errors[i][2], segments[i + 1][1]))
+
+    def excess(position, shift):
+        # By how much the events from `position` up to the next delay
+        # exceed the limit, shifted by `shift`.
+        lowest, highest = segments[position]
+        return max(0, highest + shift - limit, -limit - lowest - shift)
+
+    # The shifts (modulo an iteration) for which the events after every
+    # position can be kept within the limit, correcting the delays
+    # by whole iterations, as [lower, upper] intervals (`None` for any).
+    feasible = [None] * (n + 1)
+    if errors is not None:
+        for i in range(n - 1, -1, -1):
+            feasible[i] = feasible[i + 1]
+            if not isinstance(events[i], pev.DelayEvent):
+                continue
+            lowest, highest = segments[i + 1]
+            width = 2 * limit - (highest - lowest)
+            if width >= calibration_ticks:
+                continue
+            lower = (-limit - lowest) % calibration_ticks
+            intervals = [(lower, lower + width)]
+            if lower + width >= calibration_ticks:
+                intervals = [(lower, calibration_ticks - 1),
+                             (0, lower + width - calibration_ticks)]
+            if feasible[i] is not None:
+                intervals = [(max(a, c), min(b, d))
+                             for a, b in intervals for c, d in feasible[i]
+                             if max(a, c) <= min(b, d)]
+            feasible[i] = intervals
+
+    def correctable(position, shift):
+        # Whether the events from `position` on can be kept within
+        # the limit after a counted loop leaving `shift`.
+        if excess(position, shift):
+            return False
+        shift %= calibration_ticks
+        return feasible[position] is None \
+            or any(a <= shift <= b for a, b in feasible[position])
+
+    def block_errors(start, period):
+        # The errors of a block, relative to its start.
+        first = errors[start][0]
+        return [(error - first, lowest - first, highest - first)
+                for error, lowest, highest
+                in errors[start:start + period + 1]]
+
+    new_events, new_errors = [], []
+    changed = False
+    shift = 0  # the error of the new events, minus that of the old ones
+    i = 0
+    while i < n:
+        event = events[i]
+        best_period, best_count, best_saved = 0, 0, min_saved_events - 1
+        # The loop overhead is compensated by shortening the delay
+        # at the beginning of the repeated block (see `_repeat_events`).
+        if isinstance(event, pev.DelayEvent) and event.iters > overhead_iters:
+            j, candidates = next_gram[i], 0
+            while j != -1 and j - i <= max_period \
+                    and candidates < max_candidates:
+                period = j - i
+                block_hash = window_hash(i, period)
+                count = 1
+                while i + (count + 1) * period <= n \
+                        and window_hash(i + count * period,
+                                        period) == block_hash:
+                    count += 1
+                saved = (count - 1) * period
+                if saved > best_saved:
+                    best_period, best_count, best_saved = period, count, saved
+                j, candidates = next_gram[j], candidates + 1
+
+        # Verify the winning candidate (guarding against hash collisions).
+        # The repetitions also have to have the same errors (if any).
+        if best_count > 1:
+            block = tokens[i:i + best_period]
+            body_errors = None
+            if errors is not None:
+                body_errors = block_errors(i, best_period)
+            best_count = 1
+            while tokens[i + best_count * best_period:
+                         i + (best_count + 1) * best_period] == block \
+                    and (body_errors is None
+                         or block_errors(i + best_count * best_period,
+                                         best_period) == body_errors):
+                best_count += 1
+
+        repeated = None
+        if best_count > 1 and (best_count - 1) * best_period \
+                >= min_saved_events:
+            body = events[i:i + best_period]
+            start = shift + (errors[i][0] if errors is not None else 0)
+            repeated, repeated_errors, end, end_counter = _repeat_events(
+                body, best_count, start, timing, limit, repeat_counter,
+                body_errors)
+            stop = i + best_count * best_period
+            if errors is not None:
+                end -= errors[stop][0]
+            if repeated is not None and (
+                    best_count * _code_length(body)
+                    - _code_length(repeated) < min_saved_events
+                    or not correctable(stop, end)):
+                repeated = None
+        if repeated is not None:
+            new_events.extend(repeated)
+            new_errors.extend(repeated_errors)
+            repeat_counter = end_counter
+            changed = True
+            i, shift = stop, end
+            continue
+
+        error, lowest, highest = errors[i] if errors is not None \
+                                 else (0, 0, 0)
+        # The error left by the counted loops is corrected by the next
+        # delay (once the error after it exceeds half an iteration,
+        # or the events up to the next delay exceed the limit).
+        iters = 0
+        if isinstance(event, pev.DelayEvent):
+            after = shift + (errors[i + 1][0] if errors is not None else 0)
+            nearest = -round(after / calibration_ticks)
+            iters = min((adjust for adjust in (0, nearest, nearest - 1,
+                                               nearest + 1)
+                         if event.iters + adjust >= 1),
+                        key=lambda adjust: (
+                            excess(i + 1, shift + adjust * calibration_ticks),
+                            abs(after + adjust * calibration_ticks)))
+        if iters:
+            event = pev.DelayEvent(iters=event.iters + iters,
+                                   loop_suffix=event.loop_suffix)
+            new_errors.append((error + shift, error + shift, error + shift))
+            shift += iters * calibration_ticks
+        else:
+            new_errors.append((error + shift, lowest + shift,
+                               highest + shift))
+        new_events.append(event)
+        i += 1
+
+    if not changed:
+        return None, None, repeat_counter
+    end = shift + (errors[n][0] if errors is not None else 0)
+    new_errors.append((end, end, end))
+    return new_events, new_errors, repeat_counter
+
+def _count_state_changes(events):
+    """The number of `StateChangeEvent`s, with the counted loops expanded.
+    """
+    count = 0
+    for event in events:
+        if isinstance(event, pev.StateChangeEvent):
+            count += 1
+        elif isinstance(event, pev.RepeatEvent):
+            count += event.count * _count_state_changes(event.events)
+    return count
+
+def _loop_suffixes(events, suffixes=None):
+    """Collect the (int) loop suffixes of the delay loops and of the counted
+    loops, as {"loop": [...], "repeat": [...]}.
+    """
+    if suffixes is None:
+        suffixes = {"loop": [], "repeat": []}
+    for event in events:
+        if isinstance(event, pev.DelayEvent):
+            suffixes["loop"].append(int(event.loop_suffix))
+        elif isinstance(event, pev.RepeatEvent):
+            suffixes["repeat"].append(int(event.loop_suffix))
+            _loop_suffixes(event.events, suffixes)
+    return suffixes
+
+def format_timing_report(report):
+    """Format a timing report (see `Sequence.timing_report`) as a table,
+    the times being in nanoseconds. The missing and extra edges are marked
+    in the error column.
+    """
+    lines = [f"{'channel':>7} {'requested':>14} {'expected':>14} "
+             f"{'error':>10}"]
+    for channel, requested, expected in report:
+        if requested is None:
+            lines.append(f"{channel:>7} {'-':>14} {expected / 1000:14.3f} "
+                         f"{'extra':>10}")
+        elif expected is None:
+            lines.append(f"{channel:>7} {requested / 1000:14.3f} {'-':>14} "
+                         f"{'missing':>10}")
+        else:
+            lines.append(f"{channel:>7} {requested / 1000:14.3f} "
+                         f"{expected / 1000:14.3f} "
+                         f"{(expected - requested) / 1000:10.3f}")
+    return "\n".join(lines)
+
+def compress_events(events, max_period=256, min_saved_events=4,
+                    repeat_counter=0):
+    """Find repeated runs of events and put them inside counted loops.
+
+    Runs of consecutive, identical blocks of events (same ODSR values,
+    same delays) are detected using a rolling hash and replaced by
+    a single `RepeatEvent`. The pass is repeated on its own output,
+    so that repeated blocks of repeated blocks become nested loops.
+
+    Only blocks starting with a delay are compressed. This delay is
+    shortened by the counted loop overhead (`repeat_overhead_cycles`
+    in config.ini). The overhead is usually not a whole number of delay
+    loop iterations, so the rounding error is compensated by adjusting
+    the delay of some repetitions by an iteration (nesting the loops,
+    see `_repeat_events`). Every edge stays within one delay loop
+    iteration of the uncompressed timing, however many repetitions.
+
+    The overheads of the writes and of the delay loops (see
+    `state_change_cycles` in config.ini) are not whole numbers
+    of iterations either, so the planned delays of evenly spaced pulses
+    given one by one differ by an iteration here and there, and only
+    the runs in between are compressed. Pulse trains are planned as
+    repeated blocks (see `Sequence.insert_trains`) and compress anyway.
+
+    Args:
+        * events (list): The low-level events of a `Sequence`.
+
+    Kwargs:
+        * max_period (int): The maximum length of a repeated block (events),
+            at least 1.
+            Default: 256
+        * min_saved_events (int): Only compress a run of repetitions if at
+            least this many events are saved.
+            Default: 4
+        * repeat_counter (int): The number of counted loops already present
+            in `events`, so that the new loop suffixes are unique.
+            Default: 0
+
+    Returns:
+        * list compressed: The compressed list of events.
+        * int repeat_counter: The number of counted loops (in total).
+
+    Raises:
+        * ValueError: If `max_period` is less than 1.
+    """
+    if max_period < 1:
+        raise ValueError(f"Invalid max_period: {max_period}.")
+    timing = pev.TimingModel()
+    errors = None
+    while True:
+        compressed, errors, repeat_counter = _compress_once(
+            events, errors, max_period, min_saved_events, timing,
+            repeat_counter)
+        if compressed is None:
+            return events, repeat_counter
+        events = compressed
+
+
+def _train_block_length(train):
+    """The number of pulses after which the quantized timing of a pulse
+    train repeats itself exactly.
+
+    This is the smallest number of periods that is an even number of delay
+    loop iterations. (Odd would not do, because `time2iters` rounds half
+    to even.)
+    """
+    calibration_ticks = pev.calibration_ticks
+    length = calibration_ticks // gcd(train.period, calibration_ticks)
+    if length * train.period // calibration_ticks % 2:
+        length *= 2
+    return length
+
+def _split_trains(flips, max_block_length=64):
+    """Decide which pulse trains of a `FlipTable` get compiled into counted
+    loops.
+
+    A train is only compiled into a counted loop if no other flip (of any
+    channel, quantized to delay loop iterations) and no other train lies
+    within its time span, and if its timing repeats often enough (see
+    `_train_block_length`). The remaining trains are expanded into flips.
+
+    Returns:
+        * FlipTable flips: The flips, including the expanded trains.
+        * list trains: The trains to compile into counted loops.
+    """
+    overhead_iters = pev.repeat_overhead_iters() + pev.TimingModel().edge_iters
+    calibration_ticks = pev.calibration_ticks
+    flip_iters = sorted(pev.time2iters(timestamp, calibration_ticks)
+                        for timestamp in flips.timestamps)
+    spans = sorted((pev.time2iters(train.timestamp),
+                    pev.time2iters(train.end), n)
+                   for n, train in enumerate(flips.trains))
+
+    compact = [False] * len(spans)
+    previous_last = -1  # the end of the spans so far
+    for m, (first, last, n) in enumerate(spans):
+        train = flips.trains[n]
+        block_length = _train_block_length(train)
+        # The first delay of the repeated block is shortened by the counted
+        # loop overhead (and the edge cost), so it has to be long enough.
+        first_delay = pev.time2iters(train.timestamp + train.period) \
+                      - pev.time2iters(train.timestamp + train.width)
+        overlaps = previous_last >= first \
+                   or (m + 1 < len(spans) and spans[m + 1][0] <= last)
+        previous_last = max(previous_last, last)
+        position = bisect_left(flip_iters, first)
+        interfered = position < len(flip_iters) \
+                     and flip_iters[position] <= last
+        compact[n] = not overlaps and not interfered \
+                     and block_length <= max_block_length \
+                     and (train.count - 1) // block_length >= 2 \
+                     and first_delay > overhead_iters
+
+    expanded = pev.FlipTable(flips.channels, flips.timestamps)
+    trains = []
+    for train, is_compact in zip(flips.trains, compact):
+        if is_compact:
+            trains.append(train)
+        else:
+            expanded.extend(train.flips)
+    return expanded, trains
+
+def _train_events(train, channel_mask, timing, loop_counter, repeat_counter):
+    """Compile a pulse train into low-level events, using counted loops.
+
+    The train starts at the current time of `timing` (there is no leading
+    delay), which is advanced past its end. The first pulse comes first,
+    then counted loops repeating blocks of `_train_block_length` pulses
+    (see `_repeat_events`), then the remaining pulses. Every edge is
+    planned from its requested time (see `events.TimingModel`), so
+    neither the edge costs nor the counted loop overhead accumulate.
+
+    Returns:
+        * list events: The low-level events.
+        * int loop_counter, int repeat_counter: The updated counters.
+    """
+    on_mask = channel_mask ^ (1 << train.channel)
+    off_mask = channel_mask
+    on_odsr, off_odsr = pcb.channel_masks_to_odsr([on_mask, off_mask])
+
+    def pulses(model, origin, first, stop, errors=None):
+        # Events of the pulses `first` ... `stop - 1`, planned with `model`
+        # (its time origin at the time `origin` of the train), starting
+        # at the falling edge of the previous pulse (or at the rising edge
+        # of the first pulse of the train). The errors of the events
+        # (see `_repeat_events`) are appended to `errors`.
+        nonlocal loop_counter
+        events = []
+        error = 0
+        for n in range(first, stop):
+            rising = train.timestamp + n * train.period - origin
+            for mask, odsr, timestamp in ((on_mask, on_odsr, rising),
+                                          (off_mask, off_odsr,
+                                           rising + train.width)):
+                iters = model.delay_iters(timestamp)
+                if iters > 0:
+                    events.append(pev.DelayEvent(
+                        iters=iters, loop_suffix=str(loop_counter)))
+                    loop_counter += 1
+                    model.delay(iters)
+                    if errors is not None:
+                        errors.append((error, error, error))
+                model.write()
+                events.append(pev.StateChangeEvent(mask, odsr=odsr))
+                error = model.time - timestamp
+                if errors is not None:
+                    errors.append((error, error, error))
+        return events
+
+    # Every edge stays within half an iteration (the quantization) and one
+    # more iteration (the compensation of the overhead) of its time.
+    limit = 3 * timing.calibration_ticks // 2
+    block_length = _train_block_length(train)
+    count = (train.count - 1) // block_length
+    events = pulses(timing, 0, 0, 1)
+    # The block is planned on its own, from the falling edge of the pulse
+    # before it (the end of its write).
+    origin = train.timestamp + train.width
+    block = pev.TimingModel()
+    block.overhead = 0
+    body_errors = []
+    body = pulses(block, origin, 1, 1 + block_length, body_errors)
+    body_errors.append(body_errors[-1])
+    repeated, _, _, end_counter = _repeat_events(
+        body, count, timing.time - origin, timing, limit,
+        repeat_counter, body_errors)
+    if repeated is None:
+        # The first delay of the block is too short to be adjusted.
+        repeated = pulses(timing, 0, 1, 1 + count * block_length)
+    else:
+        timing.run(repeated)
+        repeat_counter = end_counter
+    events.extend(repeated)
+    events.extend(pulses(timing, 0, 1 + count * block_length, train.count))
+    return events, loop_counter, repeat_counter
+
+class CompileCache():
+    """A cache of compiled sequences.
+
+    Sequences are stored under a key derived from the normalized input
+    (see `key`). The most recently used sequences are kept in memory,
+    optionally backed by a directory of pickled sequences on disk.
+
+    The cached sequences are shared, so treat them as read-only.
+    (All the `Sequence` methods transforming a sequence return a new one.)
+
+    Kwargs:
+        * max_entries (int): The number of sequences kept in memory.
+            Default: 32
+        * directory (str): The directory of the on-disk tier.
+            Default: `None` (no on-disk tier)
+    """
+    # Bump this whenever the compiled output changes for the same input,
+    # so that stale sequences in the on-disk tier are not used.
+    version = 3
+
+    def __init__(self, max_entries=32, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def key(cls, channel_texts, triggered=False, parameter=None):
+        """A canonical hash of everything the compiled sequence depends on.
+
+        The event strings are normalized (extra whitespace is dropped,
+        channels are sorted, empty channels are left out), so equivalent
+        inputs share a key. The (current) configuration, including
+        the calibration, the clock frequency and the pin map, and the mode
+        (`triggered`, `parameter`) are included as well.
+        """
+        # The caches are not needed for a quick headless compilation,
+        # so the modules they use are imported only here (and below).
+        import hashlib
+        import json
+
+        channels = sorted((channel, " ".join(text.split()))
+                          for channel, text in channel_texts if text.split())
+        description = [cls.version, channels, pcfg.current().signature,
+                       triggered, parameter]
+        return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, key):
+        """Return the cached sequence, or `None` on a cache miss.
+        """
+        seq = self.entries.get(key)
+        if seq is not None:
+            self.entries.move_to_end(key)
+        elif self.directory:
+            import pickle
+            try:
+                with open(self.path(key), "rb") as f:
+                    seq = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                seq = None
+            if seq is not None:
+                self._remember(key, seq)
+
+        if seq is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return seq
+
+    def put(self, key, seq):
+        self._remember(key, seq)
+        if self.directory:
+            import pickle
+            import tempfile
+            os.makedirs(self.directory, exist_ok=True)
+            # Write into a temporary file first and rename it afterwards,
+            # so that an interrupted write never looks like a valid entry.
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(seq, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, self.path(key))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    def _remember(self, key, seq):
+        self.entries[key] = seq
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Forget the sequences kept in memory.
+        """
+        self.entries.clear()
+
+
+def compile_sequence(channel_texts, triggered=False, parameter=None,
+                     cache=None, backend="loop", config=None):
+    """Parse and compile per-channel event strings into a `Sequence`.
+
+    Args:
+        * channel_texts (iterable): (channel, event string) pairs.
+
+    Kwargs:
+        * triggered (bool), parameter: See `codeblocks.setup`.
+        * cache (CompileCache): Look the sequence up in (and store it in)
+            this cache. Default: `None` (no caching)
+        * backend (str): See `Sequence.from_flip_sequence`.
+        * config (config.Config): The configuration to use.
+            Default: The current configuration, see `config.current`.
+
+    Returns:
+        * Sequence seq: The compiled sequence.
+    """
+    with config if config else pcfg.current():
+        return _compile_sequence(list(channel_texts), triggered, parameter,
+                                 cache, backend)
+
+def _compile_sequence(channel_texts, triggered, parameter, cache, backend):
+    if cache is not None:
+        key = cache.key(channel_texts, triggered=triggered,
+                        parameter=parameter)
+        seq = cache.get(key)
+        if seq is not None:
+            return seq
+
+    flips = pev.FlipTable()
+    for channel, text in channel_texts:
+        flips.extend(pev.parse_events(text, channel))
+    seq = Sequence.from_flip_sequence(FlipSequence(flips),
+                                      triggered=triggered,
+                                      parameter=parameter, backend=backend)
+
+    if cache is not None:
+        cache.put(key, seq)
+    return seq
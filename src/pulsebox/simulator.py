@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""simulator.py
+Simulating the output of compiled sequences of the Arduino Due pulsebox,
+without the board (and without a scope).
+
+    waveform = simulator.simulate(seq)
+    diff = simulator.compare(waveform, fs)
+    print(diff.summary())
+
+The low-level events (delays, `REG_PIOC_ODSR` writes, counted loops) are
+expanded into arrays of write times with the costs of the timing model
+(see `events.TimingModel`): the delay loop iterations and the fixed
+number of clock cycles of every block. The counted loops are expanded
+by broadcasting their (simulated once) bodies, so even million-event
+sequences simulate in seconds. The table-driven code (see
+`Sequence.table_steps`) is simulated step by step, the same way.
+
+Comparing the simulated edges of every channel with the flips they were
+compiled from (see `compare`, `check`) makes a regression check
+of the compiler and its optimizations.
+
+Requires NumPy.
+
+Radim Hošák <hosak(at)optics.upol.cz>
+2021 Quantum Optics Lab Olomouc
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError("The simulator requires NumPy.")
+
+import pulsebox.events as pev
+from pulsebox import profiling as pprof
+
+
+class Waveform():
+    """The simulated output of a compiled sequence.
+
+    * edges (dict): {channel: int64 array of the edge times (in ticks)}.
+        Every channel starts low, so the even edges rise and the odd
+        ones fall.
+    * times (array): The times of the state changing `REG_PIOC_ODSR`
+        writes (ticks, as in `events.TimingModel`).
+    * odsr_values (array): The values written.
+    * duration (int): The end of the sequence (ticks).
+    * clock_frequency (int): The MCU clock frequency (Hz).
+    """
+    def __init__(self, edges, times, odsr_values, duration, clock_frequency):
+        self.edges = edges
+        self.times = times
+        self.odsr_values = odsr_values
+        self.duration = duration
+        self.clock_frequency = clock_frequency
+
+    def cycles(self, channel):
+        """The edge times of a channel in MCU clock cycles (floats)."""
+        return self.edges[channel] * (self.clock_frequency
+                                      / pev.TICKS_PER_SECOND)
+
+    def __repr__(self):
+        return f"Waveform({len(self.times)} writes, " \
+               f"{sum(map(len, self.edges.values()))} edges, " \
+               f"{pev.ticks2seconds(self.duration)} s)"
+
+
+def _simulate_block(events, timing):
+    # The end times of the `REG_PIOC_ODSR` writes of a list of events
+    # (relative to its start), the values written, and its duration.
+    calibration_ticks = timing.calibration_ticks
+    parts = []  # (times, odsr values) of the flat runs and counted loops
+    durations = []  # of the events of the current flat run
+    writes = []  # the indices of the writes in `durations`
+    odsr_values = []
+    offset = 0
+
+    def flush():
+        nonlocal offset, durations, writes, odsr_values
+        if durations:
+            ends = offset + np.cumsum(np.array(durations, dtype=np.int64))
+            parts.append((ends[writes], np.array(odsr_values,
+                                                 dtype=np.int64)))
+            offset = int(ends[-1])
+        durations, writes, odsr_values = [], [], []
+
+    for event in events:
+        if isinstance(event, pev.StateChangeEvent):
+            writes.append(len(durations))
+            durations.append(timing.write_ticks)
+            odsr_values.append(event.odsr)
+        elif isinstance(event, pev.DelayEvent):
+            durations.append(timing.loop_ticks
+                             + event.iters * calibration_ticks)
+        elif isinstance(event, pev.RepeatEvent):
+            flush()
+            times, values, duration = _simulate_block(event.events, timing)
+            period = timing.repeat_ticks + duration
+            starts = offset + timing.repeat_ticks \
+                     + period * np.arange(event.count, dtype=np.int64)
+            parts.append(((starts[:, None] + times).ravel(),
+                          np.tile(values, event.count)))
+            offset += event.count * period
+        else:
+            raise ValueError(f"Cannot simulate {type(event).__name__}.")
+    flush()
+    if not parts:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, offset
+    return np.concatenate([times for times, _ in parts]), \
+           np.concatenate([values for _, values in parts]), offset
+
+def simulate(seq, codegen=None):
+    """Simulate the output of a compiled sequence.
+
+    Args:
+        * seq (Sequence)
+
+    Kwargs:
+        * codegen (str): "unrolled" or "table" (see `Sequence.iter_code`).
+            Default: See `codegen` in config.ini.
+
+    Returns:
+        * Waveform waveform
+    """
+    cfg = seq.config
+    codegen = codegen if codegen else cfg.codegen
+    with cfg, pprof.stage("simulate", items=len(seq.events)):
+        timing = pev.TimingModel(cfg, codegen=codegen)
+        if codegen == "table":
+            steps = np.array(seq.table_steps(), dtype=np.int64)
+            odsr_values, iters = steps[:, 0], steps[:, 1]
+            # Every step ends with its write, after the delay of the step
+            # before.
+            step_ticks = timing.write_ticks \
+                         + np.concatenate(([0], iters[:-1])) \
+                         * timing.calibration_ticks
+            step_ticks[0] = 0
+            times = np.cumsum(step_ticks)
+            duration = int(times[-1] + iters[-1] * timing.calibration_ticks)
+        else:
+            times, odsr_values, duration = _simulate_block(seq.events,
+                                                           timing)
+            # The time origin is the end of the first write.
+            times -= timing.write_ticks
+            duration -= timing.write_ticks
+
+        # Only the writes changing the state are edges.
+        changed = odsr_values != np.concatenate(([0], odsr_values))[:-1]
+        times, odsr_values = times[changed], odsr_values[changed]
+        edges = {}
+        for channel, pin_mask in enumerate(cfg.pin_masks):
+            levels = (odsr_values & pin_mask) != 0
+            flipped = levels != np.concatenate(([False], levels))[:-1]
+            edges[channel] = times[flipped]
+        return Waveform(edges, times, odsr_values, duration,
+                        cfg.clock_frequency)
+
+
+def requested_edges(fs):
+    """The requested edge times of every channel of a `FlipSequence`
+    (the pulse trains expanded).
+
+    Returns:
+        * dict edges: {channel: sorted int64 array of times (ticks)}
+    """
+    flips = fs.flips.expanded()
+    channels = np.frombuffer(flips.channels, dtype=np.uint8)
+    timestamps = np.frombuffer(flips.timestamps, dtype=np.int64)
+    order = np.lexsort((timestamps, channels))
+    channels, timestamps = channels[order], timestamps[order]
+    bounds = np.flatnonzero(np.diff(channels)) + 1
+    return {int(group[0]): times
+            for group, times in zip(np.split(channels, bounds),
+                                    np.split(timestamps, bounds))
+            if len(group)}
+
+
+class EdgeDiff():
+    """The simulated edges compared with the requested ones, edge by edge
+    (in the order of the requested times).
+
+    * channels (array): The channel of every edge.
+    * requested (array): The requested times (ticks).
+    * simulated (array): The simulated times (ticks).
+    * errors (array): simulated - requested (ticks).
+    * mismatched (dict): {channel: (requested edges, simulated edges)}
+        for the channels whose numbers of edges differ. Their edges are
+        compared up to the shorter count.
+    """
+    def __init__(self, channels, requested, simulated, mismatched):
+        order = np.lexsort((channels, requested))
+        self.channels = channels[order]
+        self.requested = requested[order]
+        self.simulated = simulated[order]
+        self.errors = self.simulated - self.requested
+        self.mismatched = mismatched
+
+    def __len__(self):
+        return len(self.errors)
+
+    @property
+    def max_error(self):
+        """The largest absolute error (ticks)."""
+        return int(np.abs(self.errors).max()) if len(self.errors) else 0
+
+    def exceeding(self, tolerance):
+        """The indices of the edges off by more than `tolerance` (ticks)."""
+        return np.flatnonzero(np.abs(self.errors) > tolerance)
+
+    def summary(self):
+        """A one-paragraph description of the errors (in nanoseconds)."""
+        lines = [f"Edges: {len(self)}"]
+        if len(self):
+            errors = self.errors / 1000
+            lines.append(f"Timing error: mean {errors.mean():.3f} ns, "
+                         f"RMS {np.sqrt(np.mean(errors**2)):.3f} ns, "
+                         f"max {self.max_error / 1000:.3f} ns")
+        for channel, (requested, simulated) in sorted(
+                self.mismatched.items()):
+            lines.append(f"Channel {channel}: {requested} edges requested, "
+                         f"{simulated} simulated")
+        return "\n".join(lines)
+
+
+def compare(waveform, fs):
+    """Compare a simulated `Waveform` with the `FlipSequence` it was
+    compiled from.
+
+    Returns:
+        * EdgeDiff diff
+    """
+    with pprof.stage("compare") as st:
+        requested = requested_edges(fs)
+        channels, requested_times, simulated_times = [], [], []
+        mismatched = {}
+        for channel in sorted(set(requested) | set(waveform.edges)):
+            wanted = requested.get(channel, np.zeros(0, dtype=np.int64))
+            got = waveform.edges.get(channel, np.zeros(0, dtype=np.int64))
+            if len(wanted) != len(got):
+                mismatched[channel] = (len(wanted), len(got))
+            count = min(len(wanted), len(got))
+            channels.append(np.full(count, channel, dtype=np.int64))
+            requested_times.append(wanted[:count])
+            simulated_times.append(got[:count])
+        empty = [np.zeros(0, dtype=np.int64)]
+        diff = EdgeDiff(np.concatenate(channels + empty),
+                        np.concatenate(requested_times + empty),
+                        np.concatenate(simulated_times + empty), mismatched)
+        st.items = len(diff)
+    return diff
+
+def check(seq, fs, tolerance=None, codegen=None):
+    """Simulate a compiled sequence and raise a `ValueError` if any of
+    its edges is missing, or off its requested time by more than
+    `tolerance`.
+
+    Kwargs:
+        * tolerance (int): The largest allowed error (ticks).
+            Default: One delay loop iteration (see `calibration`
+            in config.ini), the precision of the counted loops
+            (see `Sequence.compress`).
+        * codegen (str): See `simulate`.
+
+    Returns:
+        * EdgeDiff diff
+    """
+    diff = compare(simulate(seq, codegen), fs)
+    if tolerance is None:
+        with seq.config:
+            tolerance = pev.calibration_ticks
+    if diff.mismatched:
+        channel, (requested, simulated) = min(diff.mismatched.items())
+        raise ValueError(f"Channel {channel} has {simulated} edges instead "
+                         f"of {requested}.")
+    exceeding = diff.exceeding(tolerance)
+    if len(exceeding):
+        worst = exceeding[np.argmax(np.abs(diff.errors[exceeding]))]
+        raise ValueError(f"{len(exceeding)} edges are off by more than "
+                         f"{tolerance} ticks, e.g. channel "
+                         f"{diff.channels[worst]} at "
+                         f"{diff.requested[worst]} ticks by "
+                         f"{diff.errors[worst]} ticks.")
+    return diff
+
+def format_edge_diff(diff, limit=None):
+    """Format the edges of an `EdgeDiff` as a table (the times
+    in nanoseconds), like `sequences.format_timing_report`.
+
+    Kwargs:
+        * limit (int): Only the first `limit` edges.
+    """
+    lines = [f"{'channel':>7} {'requested':>14} {'simulated':>14} "
+             f"{'error':>10}"]
+    for channel, requested, simulated, error in zip(
+            diff.channels[:limit].tolist(), diff.requested[:limit].tolist(),
+            diff.simulated[:limit].tolist(), diff.errors[:limit].tolist()):
+        lines.append(f"{channel:>7} {requested / 1000:14.3f} "
+                     f"{simulated / 1000:14.3f} {error / 1000:10.3f}")
+    return "\n".join(lines)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from concurrent.futures import CancelledError
+
+import pulsebox.arduino as pard
+import pulsebox.events as pev
+import pulsebox.sequences as pseq
+
+# A stand-in for arduino-cli, which logs its invocations.
+FAKE_CLI = f"""#!{sys.executable}
+import os, sys
+args = sys.argv[1:]
+with open(os.path.join(os.path.dirname(__file__), "calls.log"), "a") as f:
+    f.write(" ".join(args[:1]) + "\\n")
+if args[0] == "version":
+    print("arduino-cli Version: fake")
+elif args[0] == "compile":
+    out = args[args.index("--output-dir") + 1]
+    with open(os.path.join(out, "sketch.ino.bin"), "wb") as f:
+        f.write(b"\\0" * 1000)
+"""
+
+
+def make_sequence(text):
+    flips = pev.parse_events(text, 0)
+    return pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips))
+
+
+class BuildCacheTest(unittest.TestCase):
+    """Tests for the firmware build cache
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cli = os.path.join(self.tmp.name, "arduino-cli")
+        with open(self.cli, "w") as f:
+            f.write(FAKE_CLI)
+        os.chmod(self.cli, os.stat(self.cli).st_mode | stat.S_IEXEC)
+        self.cache = pard.BuildCache(os.path.join(self.tmp.name, "cache"),
+                                     max_bytes=10**6)
+        self.sketch_dir = os.path.join(self.tmp.name, "tmp_ino")
+        self.runner = pard.CommandRunner(self.cli)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def calls(self):
+        with open(os.path.join(self.tmp.name, "calls.log")) as f:
+            return f.read().split()
+
+    def upload(self, seq):
+        return pard.build_and_upload(seq, sketch_dir=self.sketch_dir,
+                                     port="/dev/null", runner=self.runner,
+                                     cache=self.cache)
+
+    def test_cache_hit_skips_compilation(self):
+        seq = make_sequence("p1u3u p5u2u")
+        self.assertFalse(self.upload(seq))
+        self.assertTrue(self.upload(seq))
+        self.assertEqual(self.calls().count("compile"), 1)
+        self.assertEqual(self.calls().count("upload"), 2)
+        self.assertTrue(os.path.isfile(os.path.join(self.sketch_dir,
+                                                    "tmp_ino.ino")))
+
+    def test_different_code_misses(self):
+        self.upload(make_sequence("p1u3u"))
+        self.assertFalse(self.upload(make_sequence("p1u4u")))
+        self.assertEqual(self.calls().count("compile"), 2)
+
+    def test_lru_eviction(self):
+        self.cache.max_bytes = 2500  # room for two builds
+        first, second, third = [make_sequence(f"p1u{n}u") for n in (1, 2, 3)]
+        self.upload(first)
+        self.upload(second)
+        self.assertTrue(self.upload(first))  # `second` is now the oldest
+        self.upload(third)
+        self.assertEqual(len(self.cache.entries()), 2)
+        self.assertTrue(self.upload(first))
+        self.assertFalse(self.upload(second))
+
+    def test_no_cache(self):
+        seq = make_sequence("p1u3u")
+        for _ in range(2):
+            self.assertFalse(pard.build_and_upload(
+                seq, sketch_dir=self.sketch_dir, port="/dev/null",
+                runner=self.runner, cache=False))
+        self.assertEqual(self.calls().count("compile"), 2)
+
+    def test_toolchain_version(self):
+        version = pard.toolchain_version(self.runner)
+        self.assertIn("Version: fake", version)
+        self.assertEqual(pard.toolchain_version(self.runner), version)
+        self.assertEqual(self.calls().count("version"), 1)
+        # An updated executable is asked again.
+        with open(self.cli, "a") as f:
+            f.write("print('updated')\n")
+        mtime = os.stat(self.cli).st_mtime_ns + 10**9
+        os.utime(self.cli, ns=(mtime, mtime))
+        self.assertNotEqual(pard.toolchain_version(self.runner), version)
+        self.assertEqual(self.calls().count("version"), 2)
+        pard.toolchain_version(self.runner)
+        self.assertEqual(self.calls().count("version"), 2)
+        pard.clear_toolchain_versions()
+        pard.toolchain_version(self.runner)
+        self.assertEqual(self.calls().count("version"), 3)
+
+
+class CommandRunnerTest(unittest.TestCase):
+    """Tests for the arduino-cli command runner
+    """
+
+    def test_failing_command(self):
+        runner = pard.CommandRunner("false")
+        with self.assertRaises(subprocess.CalledProcessError):
+            runner.run("version")
+
+    def test_cancelled(self):
+        runner = pard.CommandRunner("true")
+        runner.cancel()
+        with self.assertRaises(CancelledError):
+            runner.run("version")
+
+    def test_cancel_running_command(self):
+        runner = pard.CommandRunner("sleep")
+        threading.Timer(0.1, runner.cancel).start()
+        with self.assertRaises(CancelledError):
+            runner.run("10")
+
+    def test_cancel_starting_command(self):
+        # Cancelling around the start of the command never leaves it
+        # running.
+        start = time.monotonic()
+        for delay in [0, 0.0002, 0.0005, 0.001, 0.002, 0.005]:
+            runner = pard.CommandRunner("sleep")
+            threading.Timer(delay, runner.cancel).start()
+            with self.assertRaises(CancelledError):
+                runner.run("10")
+        self.assertLess(time.monotonic() - start, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
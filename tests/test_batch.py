@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+import pulsebox.batch as pbatch
+import pulsebox.config as pcfg
+import pulsebox.io as pio
+import pulsebox.sequences as pseq
+
+CHANNEL_TEXTS = [(0, "p1u3u p5u2u"), (1, "p2u1u t20u1u3ux30")]
+
+
+class BatchTest(unittest.TestCase):
+    """Tests for the parallel batch compilation
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.filenames = []
+        for name in ["a", "b", "c"]:
+            filename = os.path.join(self.tmp.name, name + ".csv")
+            pio.save_channel_texts(filename, CHANNEL_TEXTS)
+            self.filenames.append(filename)
+
+    def test_find_files(self):
+        a, b, c = self.filenames
+        self.assertEqual(pbatch.find_files([self.tmp.name]), [a, b, c])
+        self.assertEqual(pbatch.find_files(
+            [c, os.path.join(self.tmp.name, "[ab].csv")]), [c, a, b])
+        self.assertEqual(pbatch.dest_filename(a, "out"),
+                         os.path.join("out", "a.ino"))
+
+    def test_compile_files(self):
+        bad = os.path.join(self.tmp.name, "bad.csv")
+        pio.save_channel_texts(bad, [(0, "p1u3u pXu")])
+        output_dir = os.path.join(self.tmp.name, "ino")
+        config = pcfg.Config(overrides={"Timing":
+                                        {"state_change_cycles": "8"}})
+        progress = []
+        results = pbatch.compile_files(self.filenames + [bad],
+                                       output_dir=output_dir, workers=2,
+                                       config=config,
+                                       progress=progress.append)
+        self.assertEqual(len(progress), 4)
+        self.assertEqual([result.filename for result in results],
+                         self.filenames + [bad])
+        self.assertEqual([result.ok for result in results],
+                         [True, True, True, False])
+        self.assertIn("pXu", results[-1].error)
+
+        with config:
+            expected = pseq.compile_sequence(CHANNEL_TEXTS) \
+                           .fit_flash_budget().code()
+        with open(results[0].dest_file) as f:
+            self.assertEqual(f.read(), expected)
+        self.assertFalse(os.path.exists(os.path.join(output_dir, "bad.ino")))
+
+    def test_modes(self):
+        output_dir = os.path.join(self.tmp.name, "ino")
+        triggered = pbatch.compile_files(self.filenames[:1],
+                                         output_dir=output_dir, workers=1,
+                                         triggered=True, parameter=22)
+        with open(triggered[0].dest_file) as f:
+            code = f.read()
+        self.assertIn("attachInterrupt(22, sequence, RISING);", code)
+        self.assertNotIn("while(1)", code)
+
+        continuous = pbatch.compile_files(self.filenames[:1],
+                                          output_dir=output_dir, workers=1,
+                                          parameter=25)
+        with open(continuous[0].dest_file) as f:
+            code = f.read()
+        self.assertIn("delay(25);", code)
+        self.assertNotIn("attachInterrupt", code)
+
+    def test_same_dest_file(self):
+        other = os.path.join(self.tmp.name, "other")
+        os.mkdir(other)
+        pio.save_channel_texts(os.path.join(other, "a.csv"), CHANNEL_TEXTS)
+        with self.assertRaises(ValueError):
+            pbatch.compile_files([self.filenames[0],
+                                  os.path.join(other, "a.csv")],
+                                 output_dir=self.tmp.name)
+
+
+if __name__ == "__main__":
+    unittest.main()
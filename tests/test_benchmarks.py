@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import pulsebox.events as pev
+
+from benchmarks import suite
+from benchmarks.generators import GENERATORS
+
+
+class GeneratorTest(unittest.TestCase):
+    """Tests for the synthetic sequence generators
+    """
+
+    def test_flip_counts(self):
+        for name, generator in GENERATORS.items():
+            flips = sum(len(pev.parse_events(text, channel))
+                        for channel, text in generator(1000))
+            self.assertGreater(flips, 900, name)
+            self.assertLessEqual(flips, 1000, name)
+
+
+class SuiteTest(unittest.TestCase):
+    """Tests for running and comparing the benchmarks
+    """
+
+    def test_run(self):
+        results = suite.run(sizes=[10, 100], generators=["dense"], repeat=1)
+        self.assertEqual(len(results["results"]), 2 * len(suite.STAGES))
+        self.assertTrue(all(result["peak_bytes"] > 0
+                            for result in results["results"]))
+        self.assertEqual(len(suite.scaling(results)), len(suite.STAGES))
+        with self.assertRaises(ValueError):
+            suite.run(stages=["teleport"])
+
+    def test_compare(self):
+        result = {"generator": "dense", "stage": "code", "flips": 100,
+                  "seconds": 1.0, "peak_bytes": 1000}
+        baseline = {"results": [result]}
+        for changes, regressed in [({}, False),
+                                   ({"seconds": 1.05}, False),
+                                   ({"seconds": 1.5}, True),
+                                   ({"peak_bytes": 2000}, True),
+                                   ({"seconds": 1e-4}, False)]:
+            current = {"results": [dict(result, **changes)]}
+            rows = suite.compare(baseline, current, threshold=0.1)
+            self.assertEqual(rows[0][-1], regressed, changes)
+
+
+if __name__ == "__main__":
+    unittest.main()
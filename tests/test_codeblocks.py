@@ -200,6 +200,47 @@ class StateChangeTest(unittest.TestCase):
                              "Incorrect REG_PIOC_ODSR for single channel.")
 
 
+class OdsrTest(unittest.TestCase):
+    """Tests for the channel mask to REG_PIOC_ODSR conversions
+    """
+
+    def test_single_masks(self):
+        for channel, pin in enumerate(config.pulsebox_pins):
+            self.assertEqual(codeblocks.channel_mask_to_odsr(1 << channel),
+                             1 << pin)
+
+    def test_states_roundtrip(self):
+        states = [channel % 3 == 0 for channel
+                  in range(config.pulsebox_pincount)]
+        states = [int(state) for state in states]
+        mask = codeblocks.channel_states_to_mask(states)
+        self.assertEqual(codeblocks.mask_to_channel_states(mask), states)
+
+    def test_batch(self):
+        masks = [0, 1, 6, 2**config.pulsebox_pincount - 1]
+        self.assertEqual(codeblocks.channel_masks_to_odsr(masks),
+                         [codeblocks.channel_mask_to_odsr(mask)
+                          for mask in masks])
+        self.assertEqual(codeblocks.channel_masks_to_odsr(masks)[-1],
+                         config.all_pins_mask)
+
+    def test_flip_masks(self):
+        masks, odsr_values = codeblocks.flip_masks_to_odsr([1, 2, 1, 2])
+        self.assertEqual(masks, [1, 3, 2, 0])
+        self.assertEqual(odsr_values,
+                         codeblocks.channel_masks_to_odsr(masks))
+
+    def test_format(self):
+        self.assertEqual(codeblocks.format_odsr(10, "bin"), "0b1010")
+        self.assertEqual(codeblocks.format_odsr(10, "hex"), "0xa")
+        with self.assertRaises(ValueError):
+            codeblocks.format_odsr(10, "oct")
+        cfg = config.Config(overrides={"CodeBlocks": {"odsr_format": "hex"}})
+        with cfg:
+            self.assertEqual(codeblocks.state_change(odsr_value=10),
+                             "   REG_PIOC_ODSR = 0xa;")
+
+
 class LoopTest(unittest.TestCase):
     """Tests for the loop code block
     """
@@ -228,11 +269,12 @@ class LoopTest(unittest.TestCase):
         correct = "   asm volatile (\n" \
                   '      "MOVW R1, #0x4\\n"\n' \
                   '      "MOVT R1, #0x0\\n"\n' \
-                  '      "LOOP0:\\n\\t"\n' \
+                  '      "1:\\n\\t"\n' \
                   '      "NOP\\n\\t"\n' \
                   '      "SUB R1, #1\\n\\t"\n' \
                   '      "CMP R1, #0\\n\\t"\n' \
-                  '      "BNE LOOP0\\n"\n' \
+                  '      "BNE 1b\\n"\n' \
+                  '      ::: "r1", "cc"\n' \
                   "   );"
         self.assertEqual(codeblocks.loop(4.0), correct,
                          "Conversion of integer-like float 4.0 to int failed.")
@@ -243,11 +285,12 @@ class LoopTest(unittest.TestCase):
         correct = "   asm volatile (\n" \
                   '      "MOVW R1, #0x64\\n"\n' \
                   '      "MOVT R1, #0x0\\n"\n' \
-                  '      "LOOP0:\\n\\t"\n' \
+                  '      "1:\\n\\t"\n' \
                   '      "NOP\\n\\t"\n' \
                   '      "SUB R1, #1\\n\\t"\n' \
                   '      "CMP R1, #0\\n\\t"\n' \
-                  '      "BNE LOOP0\\n"\n' \
+                  '      "BNE 1b\\n"\n' \
+                  '      ::: "r1", "cc"\n' \
                   "   );"
         self.assertEqual(codeblocks.loop(1e2), correct,
                          "Conversion of integer-like float 1e2 to int failed.")
@@ -256,11 +299,12 @@ class LoopTest(unittest.TestCase):
         correct = "   asm volatile (\n" \
                   '      "MOVW R1, #0x1\\n"\n' \
                   '      "MOVT R1, #0x0\\n"\n' \
-                  '      "LOOP0:\\n\\t"\n' \
+                  '      "1:\\n\\t"\n' \
                   '      "NOP\\n\\t"\n' \
                   '      "SUB R1, #1\\n\\t"\n' \
                   '      "CMP R1, #0\\n\\t"\n' \
-                  '      "BNE LOOP0\\n"\n' \
+                  '      "BNE 1b\\n"\n' \
+                  '      ::: "r1", "cc"\n' \
                   "   );"
         self.assertEqual(codeblocks.loop(1), correct,
                          "One-iteration delay produces wrong code.")
@@ -271,11 +315,12 @@ class LoopTest(unittest.TestCase):
         correct = "   asm volatile (\n" \
                   '      "MOVW R1, #0xffff\\n"\n' \
                   '      "MOVT R1, #0x0\\n"\n' \
-                  '      "LOOP0:\\n\\t"\n' \
+                  '      "1:\\n\\t"\n' \
                   '      "NOP\\n\\t"\n' \
                   '      "SUB R1, #1\\n\\t"\n' \
                   '      "CMP R1, #0\\n\\t"\n' \
-                  '      "BNE LOOP0\\n"\n' \
+                  '      "BNE 1b\\n"\n' \
+                  '      ::: "r1", "cc"\n' \
                   "   );"
         self.assertEqual(codeblocks.loop(65535), correct,
                          "Max-16-bit-iter loop delay produces wrong code.")
@@ -286,11 +331,12 @@ class LoopTest(unittest.TestCase):
         correct = "   asm volatile (\n" \
                   '      "MOVW R1, #0x0\\n"\n' \
                   '      "MOVT R1, #0xffff\\n"\n' \
-                  '      "LOOP0:\\n\\t"\n' \
+                  '      "1:\\n\\t"\n' \
                   '      "NOP\\n\\t"\n' \
                   '      "SUB R1, #1\\n\\t"\n' \
                   '      "CMP R1, #0\\n\\t"\n' \
-                  '      "BNE LOOP0\\n"\n' \
+                  '      "BNE 1b\\n"\n' \
+                  '      ::: "r1", "cc"\n' \
                   "   );"
         self.assertEqual(codeblocks.loop(4294901760), correct,
                          "0xffff0000 loop delay produces wrong code.")
@@ -301,16 +347,61 @@ class LoopTest(unittest.TestCase):
         correct = "   asm volatile (\n" \
                   '      "MOVW R1, #0xffff\\n"\n' \
                   '      "MOVT R1, #0xffff\\n"\n' \
-                  '      "LOOP0:\\n\\t"\n' \
+                  '      "1:\\n\\t"\n' \
                   '      "NOP\\n\\t"\n' \
                   '      "SUB R1, #1\\n\\t"\n' \
                   '      "CMP R1, #0\\n\\t"\n' \
-                  '      "BNE LOOP0\\n"\n' \
+                  '      "BNE 1b\\n"\n' \
+                  '      ::: "r1", "cc"\n' \
                   "   );"
         self.assertEqual(codeblocks.loop(4294967295), correct,
                          "Max-iter loop delay produces wrong code.")
 
 
+class RepeatTest(unittest.TestCase):
+    """Tests for the repeat code block
+    """
+
+    def test_repeat(self):
+        correct = "   for (uint32_t REP3 = 0; REP3 < 10; REP3++) {\n" \
+                  "      REG_PIOC_ODSR = 0b0;\n" \
+                  "   }"
+        self.assertEqual(codeblocks.repeat(10, "   REG_PIOC_ODSR = 0b0;", "3"),
+                         correct, "Counted loop produces wrong code.")
+
+    def test_invalid_count(self):
+        with self.assertRaises(TypeError):
+            codeblocks.repeat(2.5, "")
+        with self.assertRaises(ValueError):
+            codeblocks.repeat(0, "")
+        with self.assertRaises(ValueError):
+            codeblocks.repeat(2**32, "")
+
+
+class StepTableTest(unittest.TestCase):
+    """Tests for the code blocks of the table-driven player
+    """
+
+    def test_table(self):
+        self.assertEqual(codeblocks.step_table(2),
+                         "const uint32_t SEQUENCE_STEPS[2][2] = {")
+        self.assertEqual(codeblocks.step(5, 3), "   {0b101, 3},")
+        self.assertEqual(codeblocks.step("0x5", 0), "   {0x5, 0},")
+        self.assertEqual(codeblocks.step_table_end(), "};\n")
+        with self.assertRaises(ValueError):
+            codeblocks.step_table(0)
+        with self.assertRaises(ValueError):
+            codeblocks.step(5, 2**32)
+
+    def test_player(self):
+        player = codeblocks.player(7)
+        self.assertIn("SEQUENCE_STEPS[7];", player)
+        # The delay loop is the same as the one of `loop`.
+        self.assertIn('"NOP\\n\\t"\n'
+                      '      "SUB R2, #1\\n\\t"\n'
+                      '      "CMP R2, #0\\n\\t"\n', player)
+
+
 class EndTest(unittest.TestCase):
     """Tests for the end code block
     """
@@ -3,6 +3,9 @@
 
 import unittest
 import os
+import pickle
+import tempfile
+import threading
 
 from pulsebox import config
 
@@ -18,6 +21,14 @@ class ConfigFileTest(unittest.TestCase):
         self.assertTrue(config.parser.has_section("Pulsebox"),
                         "Pulsebox section missing in the config file.")
 
+    def test_timing_section(self):
+        self.assertTrue(config.parser.has_section("Timing"),
+                        "Timing section missing in the config file.")
+
+    def test_flash_section(self):
+        self.assertTrue(config.parser.has_section("Flash"),
+                        "Flash section missing in the config file.")
+
     def test_codeblocks_section(self):
         self.assertTrue(config.parser.has_section("CodeBlocks"),
                         "CodeBlocks section missing in the config file.")
@@ -146,6 +157,20 @@ class CalibrationTest(unittest.TestCase):
         self.assertNotEqual(calibration, "", "Calibration is an empty string.")
 
 
+class ClockFrequencyTest(unittest.TestCase):
+    """Tests for the `clock_frequency` option in the `Pulsebox` section
+    """
+    
+    def test_specified(self):
+        self.assertTrue(config.parser.has_option("Pulsebox",
+                                                 "clock_frequency"),
+                        "Clock frequency was not specified.")
+
+    def test_positive(self):
+        self.assertTrue(config.clock_frequency > 0,
+                        "Clock frequency is not positive.")
+
+
 class HeaderTest(unittest.TestCase):
     """Tests for the `header` option in the `CodeBlocks` section
     """
@@ -180,5 +205,113 @@ class ByIdStringTest(unittest.TestCase):
 
         
 
+class ConfigObjectTest(unittest.TestCase):
+    """Tests for the lazy, reloadable `Config` object
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "config.ini")
+        self.write_calibration(1e-7)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_calibration(self, calibration):
+        with open(self.filename, "w") as f:
+            f.write(f"[Pulsebox]\ncalibration = {calibration}\n")
+
+    def test_lazy_loading(self):
+        cfg = config.Config([self.filename])
+        self.assertNotIn("calibration", vars(cfg))
+        self.assertEqual(cfg.calibration, 1e-7)
+        self.assertEqual(cfg.filename, self.filename)
+        with self.assertRaises(AttributeError):
+            cfg.no_such_option
+
+    def test_derived_values(self):
+        cfg = config.Config([self.filename])
+        self.assertEqual(cfg.pulsebox_pincount, len(cfg.pulsebox_pins))
+        self.assertEqual(bin(cfg.all_pins_mask), cfg.all_pins_enabled)
+        for channel, pin in enumerate(cfg.pulsebox_pins):
+            self.assertEqual(cfg.pin_masks[channel], 1 << pin)
+            self.assertEqual(cfg.pin_channels[pin], channel)
+
+    def test_reload(self):
+        import pulsebox.events as pev
+        cfg = config.Config([self.filename])
+        with cfg:
+            self.assertEqual(pev.read_time("1i"), 100000)
+            self.write_calibration(2e-7)
+            self.assertEqual(pev.read_time("1i"), 100000)
+            cfg.reload()
+            self.assertEqual(cfg.calibration, 2e-7)
+            self.assertEqual(pev.read_time("1i"), 200000)
+            self.assertEqual(pev.calibration_ticks, 200000)
+
+    def test_reload_while_loading(self):
+        # A reload while the files are being read in another thread
+        # is not lost.
+        reading, reloading = threading.Event(), threading.Event()
+        filename = self.filename
+
+        class SlowFilenames():
+            def __iter__(self):
+                yield filename
+                reading.set()
+                reloading.wait(1)
+
+        cfg = config.Config(SlowFilenames())
+        loader = threading.Thread(target=cfg.load)
+        loader.start()
+        reading.wait(1)
+        self.write_calibration(2e-7)
+        reloader = threading.Thread(target=cfg.reload)
+        reloader.start()
+        reloader.join(0.05)  # waits for the load to finish
+        reloading.set()
+        loader.join()
+        reloader.join()
+        self.assertEqual(cfg.generation, 1)
+        self.assertEqual(cfg.calibration, 2e-7)
+
+    def test_context(self):
+        cfg = config.Config(overrides={"Pulsebox": {"calibration": "1e-7"}})
+        self.assertIs(config.current(), config.default)
+        with cfg:
+            self.assertIs(config.current(), cfg)
+            self.assertEqual(config.calibration, 1e-7)
+            with config.default:
+                self.assertIs(config.current(), config.default)
+            self.assertIs(config.current(), cfg)
+        self.assertIs(config.current(), config.default)
+        self.assertEqual(config.calibration, config.default.calibration)
+
+    def test_context_is_per_thread(self):
+        cfg = config.Config(overrides={"Pulsebox": {"calibration": "1e-7"}})
+        seen = []
+        with cfg:
+            thread = threading.Thread(
+                target=lambda: seen.append(config.current()))
+            thread.start()
+            thread.join()
+        self.assertIs(seen[0], config.default)
+
+    def test_explicit(self):
+        import pulsebox.sequences as pseq
+        cfg = config.Config(overrides={"Pulsebox": {"calibration": "1e-7"}})
+        seq = pseq.compile_sequence([(0, "p1u1u")], config=cfg)
+        self.assertIs(seq.config, cfg)
+        self.assertEqual(seq.events[0].iters, 10)
+        self.assertEqual(pseq.compile_sequence([(0, "p1u1u")]).events[0].iters,
+                         15)
+
+    def test_pickle(self):
+        cfg = config.Config([self.filename])
+        cfg.load()
+        copy = pickle.loads(pickle.dumps(cfg))
+        self.assertEqual(copy.calibration, cfg.calibration)
+
+
 if __name__ == "__main__":
     unittest.main()
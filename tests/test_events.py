@@ -3,6 +3,11 @@
 
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import pulsebox.events as pev
 
 
@@ -22,3 +27,220 @@ class ReadTimeTest(unittest.TestCase):
     def test_negative_time(self):
         with self.assertRaises(ValueError):
             pev.read_time("-100u")
+
+    def test_units(self):
+        self.assertEqual(pev.read_time("1s"), pev.TICKS_PER_SECOND)
+        self.assertEqual(pev.read_time("1m"), pev.TICKS_PER_SECOND // 10**3)
+        self.assertEqual(pev.read_time("1u"), pev.TICKS_PER_SECOND // 10**6)
+        self.assertEqual(pev.read_time("1n"), pev.TICKS_PER_SECOND // 10**9)
+        self.assertEqual(pev.read_time("3i"), 3 * pev.calibration_ticks)
+        self.assertEqual(pev.read_time("84000000c"), pev.TICKS_PER_SECOND)
+
+    def test_exact_decimal(self):
+        """Test that decimal fractions do not suffer from float rounding.
+        """
+        self.assertEqual(pev.read_time("0.1u") + pev.read_time("0.2u"),
+                         pev.read_time("0.3u"))
+        self.assertEqual(pev.read_time("1.5e2n"), pev.read_time("150n"))
+
+    def test_non_finite_time(self):
+        with self.assertRaises(ValueError):
+            pev.read_time("infu")
+        with self.assertRaises(ValueError):
+            pev.read_time("nanu")
+
+    def test_format_time(self):
+        for ticks in [0, 1, 500, 1000, 1500, 10**6, 200000500, 3 * 10**12]:
+            self.assertEqual(pev.read_time(pev.format_time(ticks)), ticks)
+        self.assertEqual(pev.format_time(1500000), "1.5u")
+        self.assertEqual(pev.format_time(250), "0.25n")
+
+
+class Time2ItersTest(unittest.TestCase):
+    """Tests for the `time2iters` function
+    """
+    def test_round_half_to_even(self):
+        half = pev.calibration_ticks // 2
+        self.assertEqual(pev.time2iters(half), 0)
+        self.assertEqual(pev.time2iters(pev.calibration_ticks + half), 2)
+        self.assertEqual(pev.time2iters(half + 1), 1)
+
+    def test_negative_time(self):
+        with self.assertRaises(ValueError):
+            pev.time2iters(-1)
+
+
+class ParseEventsTest(unittest.TestCase):
+    """Tests for the `parse_events` function
+    """
+    def test_matches_read_time(self):
+        times = ["1u", "0.5u", "3.u", ".25m", "7c", "2.5i", "1.123456789n"]
+        event_string = " ".join(f"p{start}{duration}" for start, duration
+                                in zip(times, reversed(times)))
+        flips = pev.parse_events(event_string, 0)
+        expected = []
+        for start, duration in zip(times, reversed(times)):
+            start = pev.read_time(start)
+            expected += [start, start + pev.read_time(duration)]
+        self.assertEqual([*flips.timestamps], expected)
+
+    def test_whitespace(self):
+        self.assertEqual(pev.parse_events("  p1u3u \t\n p5u2u ", 1),
+                         pev.parse_events("p1u3u p5u2u", 1))
+        self.assertEqual(len(pev.parse_events("", 1)), 0)
+        self.assertEqual(len(pev.parse_events("   ", 1)), 0)
+
+    def test_channel(self):
+        for channel in [None, "1", 1.0, True, -1, 16, 256]:
+            with self.assertRaises(ValueError):
+                pev.parse_events("p1u3u", channel)
+        with self.assertRaises(TypeError):
+            pev.parse_events("p1u3u")
+
+    def test_exponent(self):
+        self.assertEqual(pev.parse_events("P2.5E3n1u", 0),
+                         pev.parse_events("p2.5u1u", 0))
+
+    def test_all_errors_reported(self):
+        with self.assertRaises(pev.EventParseError) as cm:
+            pev.parse_events("p1u3u x5u p1x2u p5u2u p1u", 3)
+        self.assertIsInstance(cm.exception, ValueError)
+        self.assertEqual(cm.exception.channel, 3)
+        self.assertEqual([(column, event) for column, event, _
+                          in cm.exception.errors],
+                         [(7, "x5u"), (11, "p1x2u"), (23, "p1u")])
+
+    def test_out_of_range(self):
+        # The times are 64-bit ticks, about 9223372 s at most.
+        for event_string, column in [("p99999999999s1s", 1),
+                                     ("p1u3u p9223372s1s", 7),
+                                     ("p1e20s1s", 1),
+                                     ("t1s1s2sx9999999", 1)]:
+            with self.assertRaises(pev.EventParseError) as cm:
+                pev.parse_events(event_string, 0)
+            self.assertEqual([column for column, _, _
+                              in cm.exception.errors], [column])
+        self.assertEqual(pev.parse_events("p9223371s1s", 0).timestamps[-1],
+                         pev.read_time("9223372s"))
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed.")
+    def test_out_of_range_numpy(self):
+        event_string = "p1u1u " * 2000 + "p99999999999s1s"
+        self.assertGreater(len(event_string), pev._NUMPY_MIN_LENGTH)
+        self.assertIsNone(pev._read_plain_pulses_numpy(
+            event_string, pev._time_factors()))
+        with self.assertRaises(pev.EventParseError) as cm:
+            pev.parse_events(event_string, 0)
+        self.assertEqual(cm.exception.errors[0][:2],
+                         (12001, "p99999999999s1s"))
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed.")
+    def test_numpy(self):
+        # Long strings of plain pulses are read in bulk, with the same
+        # result. Anything else is left to the general path.
+        times = ["1u", "0.5u", "3.u", ".25m", "7c", "2.5i", "1.123456789n",
+                 "007s"]
+        event_string = "\x1f\n".join(f"P{start}{duration}"
+                                      for start, duration
+                                      in zip(times, reversed(times)))
+        flips = pev.parse_events(event_string, 0)
+        self.assertEqual([*pev._read_plain_pulses_numpy(
+                             event_string, pev._time_factors())],
+                         [*flips.timestamps])
+        long_string = " ".join([event_string] * 2000)
+        self.assertGreater(len(long_string), pev._NUMPY_MIN_LENGTH)
+        self.assertEqual([*pev.parse_events(long_string, 0).timestamps],
+                         [*flips.timestamps] * 2000)
+        for other in ["p1u", "p1u3u x5u", "p1.2.3u1u", "p1u1uu", "pp1u1u",
+                      "p1U1u", "P2.5E3n1u", "t1u1u2ux3", "p1µ1u",
+                      "p619.31254c1u"]:  # the last one might overflow
+            self.assertIsNone(pev._read_plain_pulses_numpy(
+                other, pev._time_factors()))
+
+    def test_million_pulses(self):
+        event_string = " ".join(f"p{3 * n + 1}u1u" for n in range(10**6))
+        flips = pev.parse_events(event_string, 5)
+        self.assertEqual(len(flips), 2 * 10**6)
+        self.assertEqual(flips.timestamps[-1], pev.read_time("2999999u"))
+
+
+class PulseTrainTest(unittest.TestCase):
+    """Tests for the `PulseTrain` class
+    """
+    def test_parse_train(self):
+        flips = pev.parse_events("p1u1u t10u2u5ux3", 4)
+        self.assertEqual(len(flips), 2)
+        self.assertEqual(flips.trains, [pev.PulseTrain(4, pev.read_time("10u"),
+                                                       pev.read_time("2u"),
+                                                       pev.read_time("5u"),
+                                                       3)])
+        self.assertEqual(flips.trains[0].end, pev.read_time("22u"))
+
+    def test_expanded(self):
+        flips = pev.parse_events("t10u2u5ux3", 4).expanded()
+        self.assertEqual(flips, pev.parse_events("p10u2u p15u2u p20u2u", 4))
+        self.assertEqual(flips.trains, [])
+
+    def test_invalid_train(self):
+        with self.assertRaises(pev.EventParseError) as cm:
+            pev.parse_events("t1u5u5ux3 t1u1u5u t1u1u5ux0", 0)
+        self.assertEqual([column for column, _, _ in cm.exception.errors],
+                         [1, 11, 19])
+
+
+class FlipEventTest(unittest.TestCase):
+    """Tests for the `FlipEvent` class
+    """
+    def test_zero_timestamp(self):
+        self.assertEqual(pev.FlipEvent(0, timestamp=0).timestamp, 0)
+
+
+class FlipTableTest(unittest.TestCase):
+    """Tests for the `FlipTable` class
+    """
+    def test_parse_events(self):
+        flips = pev.parse_events("p1u3u p5u2u", 2)
+        self.assertIsInstance(flips, pev.FlipTable)
+        self.assertEqual([*flips.channels], [2] * 4)
+        self.assertEqual([*flips.timestamps],
+                         [*map(pev.read_time, ["1u", "4u", "5u", "7u"])])
+
+    def test_flip_event_view(self):
+        flips = pev.parse_events("p1u3u", 5)
+        flip = flips[1]
+        self.assertIsInstance(flip, pev.FlipEvent)
+        self.assertEqual((flip.channel, flip.timestamp),
+                         (5, pev.read_time("4u")))
+        self.assertEqual([flip.timestamp for flip in flips],
+                         [*flips.timestamps])
+
+    def test_from_flips(self):
+        flips = [pev.FlipEvent(1, timestamp=10), pev.FlipEvent(0, timestamp=5)]
+        table = pev.FlipTable.from_flips(flips)
+        self.assertEqual(table, pev.FlipTable([1, 0], [10, 5]))
+        self.assertEqual(flips + table, pev.FlipTable([1, 0, 1, 0],
+                                                      [10, 5, 10, 5]))
+
+    def test_sort_is_stable(self):
+        table = pev.FlipTable([0, 1, 2, 3], [30, 10, 30, 10])
+        table.sort()
+        self.assertEqual(table, pev.FlipTable([1, 3, 0, 2], [10, 10, 30, 30]))
+
+    def test_slicing(self):
+        table = pev.FlipTable([0, 1, 2, 3], [0, 10, 20, 30])
+        self.assertEqual(table[1:3], pev.FlipTable([1, 2], [10, 20]))
+
+    def test_column_length_mismatch(self):
+        with self.assertRaises(ValueError):
+            pev.FlipTable([0, 1], [0])
+
+    def test_memoryview_columns(self):
+        table = pev.FlipTable([0, 1, 2], [30, 10, 20])
+        view = pev.FlipTable()
+        view.channels = memoryview(table.channels)
+        view.timestamps = memoryview(table.timestamps)
+        self.assertEqual(view, table)
+        self.assertEqual(view[1:], table[1:])
+        copy = view.copy()
+        copy.sort()
+        self.assertEqual(copy, pev.FlipTable([1, 2, 0], [10, 20, 30]))
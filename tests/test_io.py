@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import tempfile
+import unittest
+
+import pulsebox.events as pev
+import pulsebox.io as pio
+
+CHANNEL_TEXTS = [(0, "p1u3u p5u2u p10u1u"), (12, "t20u1u3ux30 p1.5u1n"),
+                 (3, " ".join(f"p{10 * n}u1u" for n in range(1, 100)))]
+
+
+def parse(channel_texts):
+    flips = pev.FlipTable()
+    for channel, text in channel_texts:
+        flips.extend(pev.parse_events(text, channel))
+    return flips
+
+
+class ChannelTextsTest(unittest.TestCase):
+    """Tests for reading and writing sequence files
+    """
+
+    def test_round_trip(self):
+        channel_texts = [(0, "p1u3u p5u2u"), (3, "t20u1u3ux30")]
+        f = io.StringIO()
+        pio.write_channel_texts(f, channel_texts)
+        self.assertEqual(f.getvalue(), "0,p1u3u,p5u2u\r\n3,t20u1u3ux30\r\n")
+        f.seek(0)
+        self.assertEqual(pio.read_channel_texts(f), channel_texts)
+
+    def test_read(self):
+        f = io.StringIO("0,p1u3u,p5u2u\n\n1,p2u1u\n")
+        self.assertEqual(pio.read_channel_texts(f),
+                         [(0, "p1u3u p5u2u"), (1, "p2u1u")])
+        with self.assertRaises(ValueError):
+            pio.read_channel_texts(io.StringIO("x,p1u3u\n"))
+
+    def test_generator(self):
+        f = io.StringIO()
+        pio.write_channel_texts(f, iter(CHANNEL_TEXTS))
+        f.seek(0)
+        rows = pio.iter_channel_texts(f)
+        self.assertEqual(next(rows), CHANNEL_TEXTS[0])
+        self.assertEqual(list(rows), CHANNEL_TEXTS[1:])
+
+    def test_compressed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "seq.csv.gz")
+            pio.save_channel_texts(filename, CHANNEL_TEXTS)
+            with open(filename, "rb") as f:
+                self.assertEqual(f.read(2), b"\x1f\x8b")
+            self.assertEqual(pio.load_channel_texts(filename), CHANNEL_TEXTS)
+            self.assertEqual(pio.load_flips(filename), parse(CHANNEL_TEXTS))
+        with self.assertRaises(ValueError):
+            pio.open_sequence_file("seq.csv", "x")
+
+
+class ReadFlipsTest(unittest.TestCase):
+    """Tests for reading sequence files in chunks
+    """
+
+    def test_chunk_sizes(self):
+        f = io.StringIO()
+        pio.write_channel_texts(f, CHANNEL_TEXTS)
+        expected = parse(CHANNEL_TEXTS)
+        for chunk_size in [1, 2, 3, 7, 64, 1000, pio.CHUNK_SIZE]:
+            f.seek(0)
+            self.assertEqual(pio.read_flips(f, chunk_size), expected)
+
+    def test_chunks(self):
+        f = io.StringIO('0,"p1u3u p2u1u",p9u1u\r\n\r\n1,p3u1u')
+        self.assertEqual(list(pio.iter_channel_chunks(f, 8)),
+                         [(0, "p1u3u p2u1u"), (0, "p9u1u"), (1, "p3u1u")])
+        with self.assertRaises(ValueError):
+            pio.read_flips(io.StringIO("x,p1u3u\n"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import contextlib
+import importlib.util
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import pulsebox.__main__ as pmain
+import pulsebox.io as pio
+
+
+class CommandLineTest(unittest.TestCase):
+    """Tests for the headless command line interface
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.filename = os.path.join(self.directory.name, "seq.csv")
+        pio.save_channel_texts(self.filename, [(0, "p1u3u p5u2u"),
+                                               (1, "p2u1u t20u1u3ux30")])
+
+    def run_main(self, *argv):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(stderr):
+            status = pmain.main(list(argv))
+        return status, stdout.getvalue(), stderr.getvalue()
+
+    def test_compile(self):
+        output = os.path.join(self.directory.name, "seq.ino")
+        status, _, _ = self.run_main("compile", self.filename, "-o", output)
+        self.assertEqual(status, 0)
+        with open(output) as f:
+            code = f.read()
+        status, stdout, _ = self.run_main("compile", self.filename)
+        self.assertEqual(status, 0)
+        self.assertEqual(stdout, code)
+        self.assertIn("void loop()", code)
+
+    def test_compile_modes(self):
+        for codegen in ("unrolled", "table"):
+            status, stdout, _ = self.run_main("compile", self.filename,
+                                              "--codegen", codegen,
+                                              "--triggered",
+                                              "--parameter", "22")
+            self.assertEqual(status, 0)
+            self.assertIn("attachInterrupt(22, sequence, RISING);", stdout)
+            self.assertNotIn("while(1)", stdout)
+            status, stdout, _ = self.run_main("compile", self.filename,
+                                              "--codegen", codegen,
+                                              "--parameter", "25")
+            self.assertEqual(status, 0)
+            self.assertIn("delay(25);", stdout)
+            self.assertNotIn("attachInterrupt", stdout)
+
+    def test_inspect(self):
+        status, stdout, stderr = self.run_main("inspect", self.filename,
+                                               "--events", "2", "--timing",
+                                               "--profile")
+        self.assertEqual(status, 0)
+        self.assertIn("Flips: 6", stdout)
+        self.assertIn("Pulse trains: 1", stdout)
+        self.assertIn("parse_events", stderr)
+
+    @unittest.skipIf(importlib.util.find_spec("numpy") is None,
+                     "NumPy is not installed.")
+    def test_simulate(self):
+        status, stdout, _ = self.run_main("inspect", self.filename,
+                                          "--simulate")
+        self.assertEqual(status, 0)
+        self.assertIn("Edges: 66", stdout)
+
+    def test_errors(self):
+        missing = os.path.join(self.directory.name, "missing.csv")
+        status, _, stderr = self.run_main("compile", missing)
+        self.assertEqual(status, 1)
+        self.assertIn("pulsebox: error:", stderr)
+        with self.assertRaises(SystemExit), \
+                contextlib.redirect_stderr(io.StringIO()):
+            pmain.main(["compile", self.filename, "--config", missing])
+
+    def test_player_and_push(self):
+        import pulsebox.emulator as pemu
+
+        status, stdout, _ = self.run_main("player", "--parameter", "10")
+        self.assertEqual(status, 0)
+        self.assertIn("#define DELAY_MS 10", stdout)
+        with pemu.PlayerEmulator() as device:
+            status, _, stderr = self.run_main("push", self.filename,
+                                              "--port", device.port,
+                                              "--codegen", "table")
+            self.assertEqual(device.generation, 1)
+        self.assertEqual(status, 0)
+        self.assertIn("steps pushed", stderr)
+
+    def test_no_gui(self):
+        code = "import sys, pulsebox.__main__ as m; " \
+               f"m.main(['compile', {self.filename!r}, '-o', os.devnull]); " \
+               "print('gi' in sys.modules, 'numpy' in sys.modules)"
+        result = subprocess.run([sys.executable, "-c", "import os; " + code],
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.split(), ["False", "False"])
+
+
+if __name__ == "__main__":
+    unittest.main()
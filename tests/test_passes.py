@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import pulsebox.events as pev
+import pulsebox.passes as ppass
+import pulsebox.sequences as pseq
+from pulsebox import config
+
+if numpy is not None:
+    import pulsebox.simulator as psim
+
+# The ideal timing model, in which only the delay loop iterations take
+# time (see `state_change_cycles` in config.ini).
+IDEAL = {"Timing": {"state_change_cycles": "0", "loop_overhead_cycles": "0"}}
+
+
+def delay(iters, suffix):
+    return pev.DelayEvent(iters=iters, loop_suffix=str(suffix))
+
+def state(mask):
+    return pev.StateChangeEvent(mask)
+
+def tokens(events):
+    return [pseq._event_token(event) for event in events]
+
+
+class PassTest(unittest.TestCase):
+    """Tests for the individual optimizer passes
+    """
+
+    def setUp(self):
+        self.ideal = config.Config(overrides=IDEAL)
+
+    def test_merge_writes(self):
+        events = [delay(5, 0), state(1), state(0), state(3), delay(2, 1),
+                  state(2)]
+        with self.ideal:
+            merged = ppass.merge_writes(events)
+        self.assertEqual(tokens(merged),
+                         tokens([events[0], events[3], events[4],
+                                 events[5]]))
+        # The writes take time by default, they are a write apart.
+        self.assertEqual(tokens(ppass.merge_writes(events)), tokens(events))
+
+    def test_drop_noop_writes(self):
+        events = [state(0), delay(5, 0), state(1), delay(5, 1), state(1),
+                  delay(5, 2), state(0)]
+        with self.ideal:
+            kept = ppass.drop_noop_writes(events)
+        self.assertEqual(tokens(kept),
+                         tokens([events[1], events[2], events[3], events[5],
+                                 events[6]]))
+
+    def test_noop_after_repeat(self):
+        body = [delay(5, 0), state(1), delay(5, 1), state(0)]
+        events = [pev.RepeatEvent(body, 3), state(0), delay(5, 2), state(1)]
+        with self.ideal:
+            kept = ppass.drop_noop_writes(events)
+        self.assertEqual(tokens(kept),
+                         tokens([events[0], events[2], events[3]]))
+
+    def test_coalesce_delays(self):
+        events = [delay(5, 0), delay(7, 1), state(1),
+                  delay(ppass.MAX_LOOP_ITERS, 2), delay(1, 3)]
+        with self.ideal:
+            coalesced = ppass.coalesce_delays(events)
+        self.assertEqual(tokens(coalesced),
+                         tokens([delay(12, 0), events[2], events[3],
+                                 events[4]]))
+        self.assertEqual(coalesced[0].loop_suffix, "0")
+
+    def test_costs_compensated(self):
+        # The removed writes and delay loop setups take time by default,
+        # the delays after them make up for it.
+        body = [delay(20, 5), state(0), delay(20, 6), state(1)]
+        events = [delay(30, 0), state(1), state(1), state(1), delay(30, 1),
+                  state(0), delay(10, 2), delay(10, 3), state(1),
+                  delay(5, 7), state(1), pev.RepeatEvent(body, 3),
+                  delay(30, 4), state(0)]
+        optimized, _ = pseq.Sequence(events).optimize()
+        edges = list(pev.TimingModel().edges(events))
+        optimized_edges = list(pev.TimingModel().edges(optimized.events))
+        self.assertEqual(len(optimized.events), 10)
+        self.assertEqual([odsr for _, odsr in optimized_edges],
+                         [odsr for _, odsr in edges])
+        for (time, _), (reference, _) in zip(optimized_edges, edges):
+            self.assertLessEqual(2 * abs(time - reference),
+                                 pev.calibration_ticks)
+
+    def test_renumber_loops(self):
+        body = [delay(5, 7), state(1), delay(5, 3), state(0)]
+        events = [delay(4, 9), pev.RepeatEvent(body, 3, loop_suffix="5"),
+                  delay(2, 1), state(1)]
+        renumbered = ppass.renumber_loops(events)
+        self.assertEqual(tokens(renumbered), tokens(events))
+        self.assertEqual([renumbered[0].loop_suffix,
+                          renumbered[1].events[0].loop_suffix,
+                          renumbered[1].events[2].loop_suffix,
+                          renumbered[2].loop_suffix], ["0", "1", "2", "3"])
+        self.assertEqual(renumbered[1].loop_suffix, "0")
+        self.assertEqual(events[0].loop_suffix, "9")  # left untouched
+
+
+class PassManagerTest(unittest.TestCase):
+    """Tests for the optimizer pass manager
+    """
+
+    def setUp(self):
+        # The 1 ns pulses round to zero delay loop iterations.
+        flips = pev.parse_events("p1u1n p1.002u1u p5u2u", 0) \
+                + pev.parse_events("p0.5u1n", 1)
+        with config.Config(overrides=IDEAL):
+            self.seq = pseq.Sequence.from_flip_sequence(
+                pseq.FlipSequence(flips))
+
+    def test_report(self):
+        optimized, results = self.seq.optimize()
+        self.assertEqual([result.name for result in results],
+                         ppass.DEFAULT_PASSES)
+        self.assertEqual(sum(result.events_saved for result in results),
+                         len(self.seq.events) - len(optimized.events))
+        self.assertEqual(sum(result.flash_bytes_saved for result in results),
+                         self.seq.estimated_flash_bytes()
+                         - optimized.estimated_flash_bytes())
+        self.assertEqual(len(optimized.events), 8)
+
+    def test_timing_preserved(self):
+        optimized, _ = self.seq.optimize()
+        iters = lambda seq: sum(event.iters for event in seq.events
+                                if isinstance(event, pev.DelayEvent))
+        self.assertEqual(iters(optimized), iters(self.seq))
+        self.assertEqual(optimized.loop_counter, 4)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed.")
+    def test_default_timing(self):
+        # Edges on two channels, closer than a delay loop iteration.
+        texts = [(0, " ".join(f"p{k * 10}u1u" for k in range(1, 50))),
+                 (1, " ".join(f"p{k * 10}.03u1u" for k in range(1, 50)))]
+        fs = pseq.FlipSequence(pev.FlipTable())
+        for channel, text in texts:
+            fs.flips.extend(pev.parse_events(text, channel))
+        with self.assertWarns(pev.TimingWarning):
+            seq = pseq.compile_sequence(texts)
+        diff = psim.check(seq, fs)
+        optimized, _ = seq.optimize()
+        self.assertEqual(psim.check(optimized, fs).max_error, diff.max_error)
+
+    def test_custom_passes(self):
+        def drop_everything(events):
+            return []
+        optimized, results = self.seq.optimize(["merge_writes",
+                                                drop_everything])
+        self.assertEqual(optimized.events, [])
+        self.assertEqual(results[1].name, "drop_everything")
+        with self.assertRaises(ValueError):
+            self.seq.optimize(["make_it_fast"])
+
+
+if __name__ == "__main__":
+    unittest.main()
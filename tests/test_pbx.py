@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+import pulsebox.config as pcfg
+import pulsebox.events as pev
+import pulsebox.io as pio
+import pulsebox.pbx as ppbx
+import pulsebox.sequences as pseq
+
+
+def example_flips():
+    flips = pev.parse_events("p1u3u p5u2u t20u1u3ux30 p200.0005u1u", 0)
+    flips.extend(pev.parse_events("p2u1u", 3))
+    return flips
+
+
+class PbxTest(unittest.TestCase):
+    """Tests for the binary .pbx sequence format
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.filename = os.path.join(self.tmp.name, "seq.pbx")
+
+    def test_flips(self):
+        flips = example_flips()
+        ppbx.save(self.filename, flips=flips)
+        with ppbx.PbxFile(self.filename) as f:
+            self.assertTrue(f.has_flips)
+            self.assertFalse(f.has_sequence)
+            self.assertIsInstance(f.flips.timestamps, memoryview)
+            self.assertEqual(f.flips, flips)
+            expected = pseq.Sequence.from_flip_sequence(
+                pseq.FlipSequence(flips))
+            for backend in ["loop", "numpy"]:
+                seq = pseq.Sequence.from_flip_sequence(
+                    pseq.FlipSequence(f.flips), backend=backend)
+                self.assertEqual(seq.code(), expected.code())
+            with self.assertRaises(ValueError):
+                f.sequence()
+
+    def test_sequence(self):
+        flips = example_flips()
+        seq = pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips),
+                                               triggered=True, parameter=52)
+        seq = seq.compress()
+        ppbx.save(self.filename, seq=seq)
+        with ppbx.PbxFile(self.filename) as f:
+            self.assertFalse(f.has_flips)
+            loaded = f.sequence()
+            self.assertEqual(loaded.code(), seq.code())
+            self.assertEqual(loaded.repeat_counter, seq.repeat_counter)
+            self.assertEqual(loaded.time, seq.time)
+            with pcfg.Config(overrides={"Pulsebox":
+                                        {"calibration": "6.5e-8"}}):
+                with self.assertRaises(ValueError):
+                    f.sequence()
+
+    def test_not_pbx(self):
+        with open(self.filename, "w") as f:
+            f.write("0,p1u3u\n")
+        with self.assertRaises(ValueError):
+            ppbx.PbxFile(self.filename)
+        open(self.filename, "w").close()
+        with self.assertRaises(ValueError):
+            ppbx.PbxFile(self.filename)
+
+    def test_csv_conversion(self):
+        csv_filename = os.path.join(self.tmp.name, "seq.csv")
+        pio.save_channel_texts(csv_filename, [(0, "p1u3u p5u2u"),
+                                              (1, "t20u1u3ux30 p1.5u1u")])
+        ppbx.csv_to_pbx(csv_filename, self.filename, compile=True)
+        back = os.path.join(self.tmp.name, "back.csv")
+        ppbx.pbx_to_csv(self.filename, back)
+        self.assertEqual(pio.load_channel_texts(back),
+                         [(0, "p1u3u p5u2u"), (1, "p1.5u1u t20u1u3ux30")])
+        with ppbx.PbxFile(self.filename) as f:
+            self.assertEqual(f.sequence().code(),
+                             pseq.compile_sequence(
+                                 pio.load_channel_texts(csv_filename)).code())
+
+    def test_odd_flips(self):
+        with self.assertRaises(ValueError):
+            ppbx.flips_to_channel_texts(pev.FlipTable([0], [10]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+
+from concurrent.futures import CancelledError
+
+import pulsebox.arduino as pard
+import pulsebox.pipeline as ppl
+import pulsebox.sequences as pseq
+
+# A stand-in for arduino-cli. Compiling takes as long as the `FAKE_DELAY`
+# environment variable says.
+FAKE_CLI = f"""#!{sys.executable}
+import os, sys, time
+args = sys.argv[1:]
+if args[0] == "compile":
+    time.sleep(float(os.environ.get("FAKE_DELAY", "0")))
+    out = args[args.index("--output-dir") + 1]
+    with open(os.path.join(out, "sketch.ino.bin"), "wb") as f:
+        f.write(b"firmware")
+"""
+
+CHANNEL_TEXTS = [(0, "p1u3u p5u2u"), (1, "p2u1u")]
+
+
+class PipelineTest(unittest.TestCase):
+    """Tests for the background pipeline
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cli = os.path.join(self.tmp.name, "arduino-cli")
+        with open(self.cli, "w") as f:
+            f.write(FAKE_CLI)
+        os.chmod(self.cli, os.stat(self.cli).st_mode | stat.S_IEXEC)
+        self.cache = pard.BuildCache(os.path.join(self.tmp.name, "cache"))
+
+        self.pipeline = ppl.Pipeline()
+        self.stages, self.results, self.errors = [], [], []
+
+    def tearDown(self):
+        self.pipeline.shutdown()
+        self.tmp.cleanup()
+        os.environ.pop("FAKE_DELAY", None)
+
+    def submit(self, job):
+        future = self.pipeline.submit(job, on_stage=self.stages.append,
+                                      on_done=self.results.append,
+                                      on_error=self.errors.append)
+        future.exception()  # wait for the job to finish
+        return future
+
+    def make_job(self, action, **kwargs):
+        return ppl.PipelineJob(CHANNEL_TEXTS, action=action,
+                               runner=pard.CommandRunner(self.cli),
+                               cache=self.cache, **kwargs)
+
+    def test_parse(self):
+        self.submit(self.make_job("parse"))
+        self.assertEqual(self.stages,
+                         ["Parsing", "Compiling", "Generating code"])
+        self.assertEqual(self.results[0].code, self.results[0].seq.code())
+        self.assertFalse(self.pipeline.busy)
+
+    def test_make_ino(self):
+        dest_file = os.path.join(self.tmp.name, "seq.ino")
+        self.submit(self.make_job("make_ino", dest_file=dest_file))
+        with open(dest_file) as f:
+            self.assertEqual(f.read(), self.results[0].seq.code())
+
+    def test_upload(self):
+        self.submit(self.make_job("upload",
+                                  sketch_dir=os.path.join(self.tmp.name,
+                                                          "tmp_ino")))
+        self.assertEqual(self.errors, [])
+        self.assertFalse(self.results[0].cache_hit)
+        self.assertEqual(self.stages[-1], "Building and uploading firmware")
+
+    def test_cancel(self):
+        os.environ["FAKE_DELAY"] = "10"
+        job = self.make_job("upload", sketch_dir=os.path.join(self.tmp.name,
+                                                              "tmp_ino"))
+        future = self.pipeline.submit(job, on_error=self.errors.append)
+        threading.Timer(0.5, self.pipeline.cancel).start()
+        self.assertIsInstance(future.exception(timeout=5), CancelledError)
+        self.assertIsInstance(self.errors[0], CancelledError)
+
+    def test_error(self):
+        job = ppl.PipelineJob([(0, "p1u1u p2u1u")])  # coinciding flips
+        self.submit(job)
+        self.assertIsInstance(self.errors[0], ValueError)
+
+    def test_compile_cache(self):
+        cache = pseq.CompileCache()
+        self.submit(self.make_job("parse", compile_cache=cache))
+        self.stages.clear()
+        self.submit(self.make_job("parse", compile_cache=cache))
+        self.assertEqual(self.stages, ["Generating code"])
+        self.assertIs(self.results[1].seq, self.results[0].seq)
+
+    def test_invalid_job(self):
+        with self.assertRaises(ValueError):
+            ppl.PipelineJob(CHANNEL_TEXTS, action="explode")
+        with self.assertRaises(ValueError):
+            ppl.PipelineJob(CHANNEL_TEXTS, action="make_ino")
+
+
+class FlipCacheTest(unittest.TestCase):
+    """Tests for the per-channel flip cache
+    """
+
+    def test_unchanged_channel_reused(self):
+        cache = ppl.FlipCache()
+        flips = cache.get(0, "p1u3u")
+        self.assertIs(cache.get(0, "p1u3u"), flips)
+        self.assertIsNot(cache.get(0, "p1u4u"), flips)
+
+    def test_preview_job(self):
+        cache = ppl.FlipCache()
+        ppl.PipelineJob(CHANNEL_TEXTS, action="preview",
+                        flip_cache=cache).run()
+        unchanged = cache.get(*CHANNEL_TEXTS[1])
+        texts = [(0, "p1u3u p5u3u"), CHANNEL_TEXTS[1]]
+        result = ppl.PipelineJob(texts, action="preview",
+                                 flip_cache=cache).run()
+        self.assertIs(cache.get(*CHANNEL_TEXTS[1]), unchanged)
+        self.assertIsNone(result.code)
+        self.assertEqual(result.seq.code(),
+                         ppl.PipelineJob(texts).run().code)
+
+
+if __name__ == "__main__":
+    unittest.main()
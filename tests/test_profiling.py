@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import pulsebox.events as pev
+import pulsebox.pipeline as ppl
+import pulsebox.profiling as pprof
+import pulsebox.sequences as pseq
+
+
+def compile_and_code():
+    flips = pev.parse_events("p1u3u p5u2u t20u1u3ux30", 0)
+    seq = pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips))
+    return seq.code()
+
+
+class ProfilerTest(unittest.TestCase):
+    """Tests for the per-stage profiler
+    """
+
+    def test_disabled(self):
+        self.assertIsNone(pprof.active())
+        with pprof.stage("anything") as stage:
+            stage.items = 5
+        self.assertIsNone(stage.items)
+
+    def test_stages(self):
+        with pprof.Profiler() as profiler:
+            self.assertIs(pprof.active(), profiler)
+            code = compile_and_code()
+        self.assertIsNone(pprof.active())
+        self.assertEqual(code, compile_and_code())
+        summary = profiler.summary()
+        self.assertEqual(list(summary)[0], "parse_events")
+        self.assertEqual(summary["parse_events"]["items"], 4)
+        self.assertEqual(summary["code"]["calls"], 1)
+        self.assertIn("insert_trains", summary)
+        self.assertIsNone(summary["code"]["allocated"])
+        nested = [record for record in profiler.records
+                  if record.name == "sort_flips"]
+        self.assertEqual(nested[0].depth, 1)
+        self.assertNotIn("sort_flips", profiler.status())
+        self.assertIn("code", profiler.format())
+
+    def test_memory(self):
+        with pprof.Profiler(memory=True) as profiler:
+            with pprof.stage("outer"):
+                with pprof.stage("inner"):
+                    data = [0] * 100000
+                del data
+        inner, outer = profiler.records
+        self.assertGreaterEqual(inner.allocated, 800000)
+        self.assertGreaterEqual(outer.allocated, inner.allocated)
+
+    def test_pipeline_job(self):
+        job = ppl.PipelineJob([(0, "p1u3u p5u2u")], profiler=pprof.Profiler())
+        result = job.run()
+        self.assertIs(result.profiler, job.profiler)
+        self.assertIn("code", result.profiler.summary())
+        self.assertIsNone(ppl.PipelineJob([(0, "p1u3u")]).run().profiler)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import socket
+import struct
+import time
+import unittest
+import zlib
+
+import pulsebox.emulator as pemu
+import pulsebox.protocol as pproto
+import pulsebox.sequences as pseq
+
+
+class FrameTest(unittest.TestCase):
+    """Tests for the framing of the serial protocol
+    """
+
+    def test_round_trip(self):
+        frames = pproto.encode_frame(pproto.INFO, 7) \
+                 + pproto.encode_frame(pproto.DATA, 300, b"\x01" * 1000)
+        decoder = pproto.FrameDecoder()
+        received = []
+        # Byte by byte, after some noise.
+        for byte in b"\x00\xa5\x11" + frames:
+            received += decoder.feed(bytes([byte]))
+        self.assertEqual([(f.kind, f.seq, f.payload, f.valid)
+                          for f in received],
+                         [(pproto.INFO, 7, b"", True),
+                          (pproto.DATA, 44, b"\x01" * 1000, True)])
+
+    def test_corrupted(self):
+        frame = bytearray(pproto.encode_frame(pproto.STATUS, 1, b"abc"))
+        frame[7] ^= 0xff
+        good = pproto.encode_frame(pproto.STATUS, 2)
+        received = pproto.FrameDecoder().feed(bytes(frame) + good)
+        self.assertEqual([(f.seq, f.valid) for f in received],
+                         [(1, False), (2, True)])
+        with self.assertRaises(ValueError):
+            pproto.encode_frame(pproto.DATA, 0, bytes(pproto.MAX_PAYLOAD + 1))
+
+    def test_pack_steps(self):
+        data = pproto.pack_steps([(0b10, 5), (2**32 - 1, 0)])
+        self.assertEqual(struct.unpack("<4I", data), (2, 5, 2**32 - 1, 0))
+
+
+class EmulatorTest(unittest.TestCase):
+    """Tests for the resident player emulator and the client
+    """
+
+    def setUp(self):
+        self.seq = pseq.compile_sequence([(0, "p1u3u p5u2u"),
+                                          (1, "p2u1u t200u0.5u1.3ux200")])
+
+    def request(self, device, kind, payload=b"", seq=0):
+        frames = pproto.FrameDecoder().feed(
+            device.feed(pproto.encode_frame(kind, seq, payload)))
+        self.assertEqual(len(frames), 1)
+        return frames[0]
+
+    def test_errors(self):
+        device = pemu.PlayerEmulator(max_steps=10)
+        reply = self.request(device, pproto.DATA, bytes(12))
+        self.assertEqual((reply.kind, reply.payload),
+                         (pproto.NAK, bytes([pproto.ERR_STATE])))
+        reply = self.request(device, pproto.BEGIN, struct.pack("<II", 11, 0))
+        self.assertEqual(reply.payload, bytes([pproto.ERR_RANGE]))
+        data = pproto.pack_steps([(1, 2), (3, 4)])
+        self.request(device, pproto.BEGIN,
+                     struct.pack("<II", 2, zlib.crc32(data)))
+        for offset in [1, 3, 2**32 - 1]:
+            reply = self.request(device, pproto.DATA,
+                                 struct.pack("<I", offset) + data)
+            self.assertEqual(reply.payload, bytes([pproto.ERR_RANGE]))
+        self.request(device, pproto.DATA, struct.pack("<I", 0) + data[:8])
+        reply = self.request(device, pproto.COMMIT)
+        self.assertEqual(reply.payload, bytes([pproto.ERR_TABLE_CRC]))
+        self.request(device, pproto.DATA, struct.pack("<I", 1) + data[8:])
+        reply = self.request(device, pproto.COMMIT, seq=9)
+        self.assertEqual((reply.kind, reply.seq, reply.payload),
+                         (pproto.COMMIT | pproto.REPLY, 9,
+                          struct.pack("<I", 1)))
+        self.assertEqual(device.tables[device.active], [(1, 2), (3, 4)])
+        reply = self.request(device, 0x42)
+        self.assertEqual(reply.payload, bytes([pproto.ERR_KIND]))
+
+    def test_push(self):
+        steps = self.seq.table_steps()
+        with pemu.PlayerEmulator() as device, \
+                pproto.PlayerClient(device.port, timeout=0.5) as client:
+            self.assertEqual(client.info()["max_steps"], pproto.MAX_STEPS)
+            self.assertEqual(client.push(self.seq), 1)
+            self.assertEqual(device.tables[device.active], steps)
+            # Double buffering: the first table stays in the other buffer.
+            self.assertEqual(client.upload([(0, 5)]), 2)
+            self.assertEqual(device.tables[1 - device.active], steps)
+            time.sleep(0.02)
+            status = client.status()
+            self.assertEqual(status["steps"], 1)
+            self.assertGreater(status["repetitions"], 0)
+            self.assertFalse(status["loading"])
+
+    def test_gating(self):
+        # No frames are handled while playing.
+        with pemu.PlayerEmulator(repetition_seconds=0.3) as device, \
+                pproto.PlayerClient(device.port, timeout=1) as client:
+            client.upload([(0, 5)])
+            while not device.playing:
+                time.sleep(0.001)
+            repetitions, frames = device.repetitions, device.frames
+            self.assertEqual(client.status()["repetitions"],
+                             repetitions + 1)
+            self.assertEqual(device.frames, frames + 1)
+
+    def test_recovery(self):
+        # Every third frame arrives corrupted and is resent.
+        steps = [(i, i) for i in range(1000)]
+        with pemu.PlayerEmulator(corrupt_every=3) as device, \
+                pproto.PlayerClient(device.port, timeout=0.5) as client:
+            self.assertEqual(client.upload(steps), 1)
+            self.assertEqual(device.tables[device.active], steps)
+
+    def test_lost_commit_reply(self):
+        # The resent COMMIT is refused, but the table was committed.
+        with pemu.PlayerEmulator(drop_replies=[pproto.COMMIT]) as device, \
+                pproto.PlayerClient(device.port, timeout=0.1) as client:
+            self.assertEqual(client.upload([(0, 5)]), 1)
+            self.assertEqual(device.tables[device.active], [(0, 5)])
+            self.assertEqual(client.upload([(0, 6)]), 2)
+
+    def test_refused(self):
+        with pemu.PlayerEmulator(max_steps=10) as device, \
+                pproto.PlayerClient(device.port, timeout=0.5) as client:
+            with self.assertRaises(pproto.ProtocolError):
+                client.upload([(0, 1)] * 11)
+            self.assertEqual(device.generation, 0)
+
+    def test_no_answer(self):
+        device, host = socket.socketpair()
+        self.addCleanup(device.close)
+        self.addCleanup(host.close)
+        client = pproto.PlayerClient(host.fileno(), timeout=0.01, retries=1)
+        with self.assertRaises(pproto.ProtocolError):
+            client.info()
+        # The frame was sent twice.
+        frames = pproto.FrameDecoder().feed(device.recv(1024))
+        self.assertEqual([frame.kind for frame in frames], [pproto.INFO] * 2)
+
+
+class FirmwareTest(unittest.TestCase):
+    """Tests for the resident player firmware
+    """
+
+    def test_firmware(self):
+        code = pproto.firmware(max_steps=100, parameter=5)
+        self.assertIn("#define MAX_STEPS 100", code)
+        self.assertIn("#define DELAY_MS 5", code)
+        self.assertIn("TABLES[active][LENGTHS[active]]", code)
+        # The range check of `DATA` cannot overflow.
+        self.assertIn("read_u32(payload) > loading_length\n"
+                      "                 || (length - 4) / 8 > loading_length"
+                      " - read_u32(payload)", code)
+        self.assertEqual(code.count("{"), code.count("}"))
+        triggered = pproto.firmware(triggered=True, parameter=52)
+        self.assertIn("#define TRIGGER_PIN 52", triggered)
+        with self.assertRaises(ValueError):
+            pproto.firmware(triggered=True, parameter=1)  # a pulsebox pin
+
+    def test_crc_table(self):
+        # The firmware computes the CRC-32 of `zlib.crc32`.
+        table = pproto._crc_table()
+        crc = 0xffffffff
+        for byte in b"pulsebox":
+            crc = table[(crc ^ byte) & 0xff] ^ (crc >> 8)
+        self.assertEqual(crc ^ 0xffffffff, zlib.crc32(b"pulsebox"))
+
+
+if __name__ == "__main__":
+    unittest.main()
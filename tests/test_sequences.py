@@ -1,6 +1,540 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import io
+import os
+import tempfile
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import pulsebox.events as pev
 import pulsebox.sequences as pseq
+from pulsebox import config
+
+# The ideal timing model, in which only the delay loop iterations take
+# time (see `state_change_cycles` in config.ini). The planned delays
+# of evenly spaced pulses then repeat exactly.
+IDEAL = {"Timing": {"state_change_cycles": "0", "loop_overhead_cycles": "0"}}
+
+
+def event_fingerprint(event):
+    """Collect the attributes of a low-level event for comparison.
+    """
+    return (type(event).__name__, getattr(event, "iters", None),
+            getattr(event, "loop_suffix", None),
+            getattr(event, "channel_states", None),
+            getattr(event, "odsr", None), event.codeblock)
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed.")
+class NumpyBackendTest(unittest.TestCase):
+    """Tests for the NumPy compiler backend of `from_flip_sequence`
+    """
+
+    def assertSameSequence(self, fs):
+        loop_seq = pseq.Sequence.from_flip_sequence(fs)
+        numpy_seq = pseq.Sequence.from_flip_sequence(fs, backend="numpy")
+        self.assertEqual([*map(event_fingerprint, loop_seq.events)],
+                         [*map(event_fingerprint, numpy_seq.events)],
+                         "The backends produced different events.")
+        self.assertEqual(loop_seq.time, numpy_seq.time)
+        self.assertEqual(loop_seq.loop_counter, numpy_seq.loop_counter)
+
+    def test_single_channel(self):
+        flips = pev.parse_events("p1u3u p5u2u p8u1u", 0)
+        self.assertSameSequence(pseq.FlipSequence(flips))
+
+    def test_multiple_channels(self):
+        flips = pev.parse_events("p1u3u p5u2u p8u1u", 0) \
+                + pev.parse_events("p2u2u p5u2u", 1) \
+                + pev.parse_events("p0.5u100n p8u1u", 15)
+        self.assertSameSequence(pseq.FlipSequence(flips))
+
+    def test_empty(self):
+        seq = pseq.Sequence.from_flip_sequence(pseq.FlipSequence([]),
+                                               backend="numpy")
+        self.assertEqual(seq.events, [])
+
+    def test_simultaneous_flips_forbidden(self):
+        flips = pev.parse_events("p1u1u p2u1u", 0)
+        with self.assertRaises(ValueError):
+            pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips),
+                                             backend="numpy")
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            pseq.Sequence.from_flip_sequence(pseq.FlipSequence([]),
+                                             backend="fortran")
+
+
+class FromFlipSequenceTest(unittest.TestCase):
+    """Tests for `Sequence.from_flip_sequence`
+    """
+
+    def test_no_drift(self):
+        """The delays must add up to the quantized end of the sequence.
+        """
+        flips = pev.parse_events("p1u3u p5u2u p8u1u p10.3u0.1u", 0)
+        with config.Config(overrides=IDEAL):
+            seq = pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips))
+        total_iters = sum(event.iters for event in seq.events
+                          if isinstance(event, pev.DelayEvent))
+        self.assertEqual(seq.time, pev.read_time("10.4u"))
+        self.assertEqual(total_iters, pev.time2iters(seq.time))
+
+    def test_coinciding_flips(self):
+        """Flips that coincide exactly end up in a single state change.
+        """
+        flips = pev.parse_events("p0.1u0.2u", 0) \
+                + pev.parse_events("p0.3u1u", 1)
+        seq = pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips))
+        state_changes = [event for event in seq.events
+                         if isinstance(event, pev.StateChangeEvent)]
+        self.assertEqual(len(state_changes), 3)
+
+
+class TimingModelTest(unittest.TestCase):
+    """Tests for the cycle-accurate timing model
+    """
+
+    def setUp(self):
+        self.cfg = config.Config(overrides={"Timing": {
+            "state_change_cycles": "8", "loop_overhead_cycles": "5"}})
+        self.fs = pseq.FlipSequence(
+            pev.parse_events("p1u3u p5u2u p8u1u p10.3u0.1u", 0)
+            + pev.parse_events("p0.5u0.2u t20u1u3ux30", 1))
+
+    def max_error(self, seq):
+        return max(abs(expected - requested)
+                   for _, requested, expected in seq.timing_report(self.fs))
+
+    def test_defaults(self):
+        self.assertFalse(pev.TimingModel().ideal)
+        with config.Config(overrides=IDEAL) as cfg:
+            self.assertTrue(pev.TimingModel().ideal)
+        for cfg in [config.default, cfg]:
+            with cfg:
+                seq = pseq.Sequence.from_flip_sequence(self.fs)
+            self.assertLessEqual(self.max_error(seq),
+                                 pev.calibration_ticks / 2)
+
+    def test_overheads_compensated(self):
+        ideal = pseq.Sequence.from_flip_sequence(self.fs)
+        with self.cfg:  # the ideal sequence, run on the modelled hardware
+            ideal = pseq.Sequence(ideal.events)
+        self.assertGreater(self.max_error(ideal), pev.calibration_ticks)
+        with self.cfg:
+            seq = pseq.Sequence.from_flip_sequence(self.fs)
+        self.assertEqual(len(seq.timing_report(self.fs)), 70)
+        self.assertLessEqual(self.max_error(seq), pev.calibration_ticks / 2)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed.")
+    def test_backends(self):
+        with self.cfg:
+            seqs = [pseq.Sequence.from_flip_sequence(self.fs, backend=backend)
+                    for backend in ["loop", "numpy"]]
+        self.assertEqual(*[[event_fingerprint(event) for event in seq.events]
+                           for seq in seqs])
+
+    def test_violations(self):
+        flips = pseq.FlipSequence(pev.parse_events("p1u10n", 0))
+        with self.cfg, self.assertWarns(pev.TimingWarning):
+            pseq.Sequence.from_flip_sequence(flips)
+        cfg = config.Config(overrides={"Timing": {
+            "state_change_cycles": "8", "timing_violations": "error"}})
+        with cfg, self.assertRaises(ValueError):
+            pseq.Sequence.from_flip_sequence(flips)
+
+    def test_report_channels(self):
+        # The edges are paired channel by channel, so the missing
+        # and the extra ones do not shift the others.
+        seq = pseq.Sequence.from_flip_sequence(self.fs)
+        fs = pseq.FlipSequence(self.fs.flips
+                               + pev.parse_events("p30u1u", 2))
+        report = seq.timing_report(fs)
+        self.assertEqual(len(report), 72)
+        self.assertEqual([edge for edge in report if edge[2] is None],
+                         [(2, pev.read_time("30u"), None),
+                          (2, pev.read_time("31u"), None)])
+        self.assertEqual(report, sorted(report, key=lambda edge: edge[1]))
+        self.assertLessEqual(max(abs(expected - requested)
+                                 for _, requested, expected in report
+                                 if expected is not None),
+                             pev.calibration_ticks / 2)
+        extra = pseq.Sequence.from_flip_sequence(fs).timing_report(self.fs)
+        self.assertEqual([channel for channel, requested, _ in extra
+                          if requested is None], [2, 2])
+
+    def test_format_report(self):
+        seq = pseq.Sequence.from_flip_sequence(self.fs)
+        lines = pseq.format_timing_report(seq.timing_report(self.fs))
+        self.assertEqual(len(lines.splitlines()), 71)
+        fs = pseq.FlipSequence(self.fs.flips
+                               + pev.parse_events("p30u1u", 2))
+        lines = pseq.format_timing_report(seq.timing_report(fs))
+        self.assertEqual(lines.count("missing"), 2)
+
+
+class CodeTest(unittest.TestCase):
+    """Tests for the code generation of `Sequence`
+    """
+
+    def setUp(self):
+        flips = pev.parse_events("p1u3u p5u2u p8u1u", 0) \
+                + pev.parse_events("p2u2u p5u2u", 1)
+        self.seq = pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips))
+
+    def test_iter_code(self):
+        self.assertEqual("".join(self.seq.iter_code()), self.seq.code())
+
+    def test_write_code(self):
+        for chunk_size in [1, 100, 65536]:
+            f = io.StringIO()
+            written = self.seq.write_code(f, chunk_size=chunk_size)
+            self.assertEqual(f.getvalue(), self.seq.code())
+            self.assertEqual(written, len(self.seq.code()))
+
+    def test_empty_sequence(self):
+        code = pseq.Sequence([]).code()
+        self.assertIn("void sequence() {\n   ;\n}", code)
+
+    def test_odsr_format(self):
+        cfg = config.Config(overrides={"CodeBlocks": {"odsr_format": "hex"}})
+        with cfg:
+            seq = pseq.Sequence(self.seq.events)
+        odsr_values = lambda code: [int(line.split()[-1].rstrip(";"), 0)
+                                    for line in code.splitlines()
+                                    if "REG_PIOC_ODSR =" in line]
+        self.assertIn("REG_PIOC_ODSR = 0x", seq.code())
+        self.assertNotIn("REG_PIOC_ODSR = 0b", seq.code())
+        self.assertEqual(odsr_values(seq.code()),
+                         odsr_values(self.seq.code()))
+
+
+def edge_errors(seq, compressed):
+    """The differences of the edge times (ticks, in the timing model)
+    of a compressed sequence and of the uncompressed one.
+    """
+    with seq.config:
+        edges = list(pev.TimingModel().edges(seq.events))
+        compressed_edges = list(pev.TimingModel().edges(compressed.events))
+    assert [odsr for _, odsr in edges] \
+        == [odsr for _, odsr in compressed_edges]
+    return [time - reference for (time, _), (reference, _)
+            in zip(compressed_edges, edges)]
+
+
+class CompressTest(unittest.TestCase):
+    """Tests for the compression of repeated patterns in `Sequence`
+    """
+
+    def setUp(self):
+        pulses = []
+        timestamp = 10
+        for block in range(20):
+            for pulse in range(10):
+                pulses.append(f"p{timestamp}i16i")
+                timestamp += 32
+            timestamp += 160
+        flips = pev.parse_events(" ".join(pulses), 0) \
+                + pev.parse_events("p5i3000i", 1)
+        with config.Config(overrides=IDEAL):
+            self.seq = pseq.Sequence.from_flip_sequence(
+                pseq.FlipSequence(flips))
+
+    def test_compresses(self):
+        compressed = self.seq.compress()
+        self.assertLess(len(compressed.events), len(self.seq.events) // 10)
+        self.assertTrue(any(isinstance(event, pev.RepeatEvent)
+                            for event in compressed.events))
+
+    def test_timing_preserved(self):
+        # The counted loop overhead is a fraction of an iteration here
+        # (see `repeat_overhead_cycles` in config.ini), but it does not
+        # accumulate over the repetitions.
+        overrides = {"Timing": {"state_change_cycles": "3",
+                                "loop_overhead_cycles": "3",
+                                "repeat_overhead_cycles": "6"}}
+        for cfg in [config.Config(overrides=IDEAL),
+                    config.Config(overrides=overrides)]:
+            with cfg:
+                seq = pseq.Sequence(self.seq.events)
+                calibration_ticks = pev.calibration_ticks
+            errors = edge_errors(seq, seq.compress())
+            self.assertLessEqual(max(map(abs, errors)), calibration_ticks)
+
+    def test_long_run(self):
+        flips = pev.parse_events(" ".join(f"p{10 + 32 * n}i16i"
+                                          for n in range(20000)), 0)
+        with config.Config(overrides=IDEAL):
+            seq = pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips))
+        compressed = seq.compress()
+        self.assertLess(len(compressed.events), 100)
+        errors = edge_errors(seq, compressed)
+        self.assertLessEqual(max(map(abs, errors)), pev.calibration_ticks)
+        self.assertLessEqual(abs(errors[-1]), pev.calibration_ticks)
+
+    def test_local_labels(self):
+        # The delay loops in the counted loops stay valid even if
+        # the compiler unrolls the counted loops.
+        code = self.seq.compress().code()
+        self.assertNotIn('"LOOP', code)
+        self.assertEqual(code.count('"1:'), code.count('"BNE 1b'))
+        self.assertEqual(code.count('"1:'), code.count('"r1", "cc"'))
+
+    def test_short_periods(self):
+        # The blocks here are 4 events long (two delays, two writes).
+        for max_period in [1, 2, 3]:
+            self.assertEqual(
+                len(self.seq.compress(max_period=max_period).events),
+                len(self.seq.events))
+        self.assertLess(len(self.seq.compress(max_period=4).events),
+                        len(self.seq.events) // 5)
+        with self.assertRaises(ValueError):
+            self.seq.compress(max_period=0)
+
+    def test_nothing_to_compress(self):
+        flips = pev.parse_events("p1u3u p5u2u p8u1u", 0)
+        seq = pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips))
+        self.assertEqual(seq.compress().code(), seq.code())
+
+
+class FlashEstimateTest(unittest.TestCase):
+    """Tests for the flash footprint estimate of `Sequence`
+    """
+
+    def test_empty_sequence(self):
+        self.assertEqual(pseq.Sequence([]).estimated_flash_bytes(),
+                         config.flash_base_bytes)
+
+    def test_block_costs(self):
+        flips = pev.parse_events("p1u3u p5u2u", 0)
+        seq = pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips))
+        self.assertEqual(seq.estimated_flash_bytes(),
+                         config.flash_base_bytes
+                         + 4 * config.flash_loop_bytes
+                         + 4 * config.flash_state_change_bytes)
+
+    def test_budget(self):
+        flips = pev.parse_events(" ".join(f"p{10 + 32 * n}i16i"
+                                          for n in range(100)), 0)
+        with config.Config(overrides=IDEAL):
+            seq = pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips))
+        budget = config.flash_base_bytes + 400
+        with self.assertRaises(ValueError):
+            seq.check_flash_budget(budget)
+        fitting = seq.fit_flash_budget(budget)
+        self.assertLessEqual(fitting.estimated_flash_bytes(), budget)
+        # Compressed only, the optimizer passes are left to the caller.
+        self.assertEqual([*map(event_fingerprint, fitting.events)],
+                         [*map(event_fingerprint, seq.compress().events)])
+        with self.assertRaises(ValueError):
+            seq.fit_flash_budget(config.flash_base_bytes + 1)
+
+
+class TableCodeTest(unittest.TestCase):
+    """Tests for the table-driven code of `Sequence`
+    """
+
+    texts = [(0, "p1u3u p5u2u"), (1, "p2u1u t20u1u3ux30"),
+             (2, "t200u0.5u1.3ux200")]
+
+    def played_edges(self, steps, first_edge):
+        # The times of the steps of the player, as in `events.TimingModel`.
+        timing = pev.TimingModel(codegen="table")
+        time, edges = 0, []
+        for n, (odsr, iters) in enumerate(steps):
+            if n > 0:
+                time += timing.write_ticks
+            edges.append((time, odsr))
+            time += iters * timing.calibration_ticks
+        return edges if first_edge == 0 else edges[1:]
+
+    def test_steps(self):
+        overrides = {"Timing": {"state_change_cycles": "3",
+                                "loop_overhead_cycles": "4",
+                                "table_step_cycles": "5"}}
+        for cfg in [config.Config(), config.Config(overrides=overrides)]:
+            with cfg:
+                seq = pseq.compile_sequence(self.texts).compress()
+                edges = list(pev.TimingModel().edges(seq.events))
+                played = self.played_edges(seq.table_steps(), edges[0][0])
+            self.assertEqual([odsr for _, odsr in played],
+                             [odsr for _, odsr in edges])
+            calibration_ticks = pev.TimingModel(cfg).calibration_ticks
+            for (played_time, _), (time, _) in zip(played, edges):
+                self.assertLessEqual(2 * abs(played_time - time),
+                                     calibration_ticks)
+
+    def test_first_step(self):
+        seq = pseq.compile_sequence([(0, "p0u1u")])
+        self.assertEqual(seq.table_steps()[0][0], config.pin_masks[0])
+        seq = pseq.compile_sequence([(0, "p1u1u")])
+        self.assertEqual(seq.table_steps()[0][0], 0)
+        self.assertEqual(pseq.Sequence([]).table_steps(), [(0, 0)])
+
+    def test_code(self):
+        seq = pseq.compile_sequence(self.texts)
+        steps = seq.table_steps()
+        code = seq.code(codegen="table")
+        self.assertIn(f"SEQUENCE_STEPS[{len(steps)}][2] = {{", code)
+        self.assertEqual(code.count("\n   {0b"), len(steps))
+        self.assertNotIn("LOOP", code)
+        with config.Config(overrides={"CodeBlocks": {"codegen": "table"}}):
+            seq = pseq.compile_sequence(self.texts)
+        self.assertEqual(seq.code(), code)
+        f = io.StringIO()
+        seq.write_code(f, chunk_size=100)
+        self.assertEqual(f.getvalue(), code)
+        with self.assertRaises(ValueError):
+            seq.code(codegen="compiled")
+
+    def test_flash(self):
+        seq = pseq.compile_sequence([(0, " ".join(f"p{3 * n + 1}u1u"
+                                                  for n in range(100)))])
+        unrolled = seq.estimated_flash_bytes() - config.flash_base_bytes
+        table = seq.estimated_flash_bytes(codegen="table") \
+                - config.flash_base_bytes
+        self.assertEqual(table, config.flash_table_player_bytes
+                         + pseq.TABLE_STEP_BYTES * 201)
+        self.assertLess(2 * table, unrolled)
+
+
+class PulseTrainTest(unittest.TestCase):
+    """Tests for compiling pulse trains
+    """
+
+    def compile(self, flips, **kwargs):
+        return pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips),
+                                                **kwargs)
+
+    def assertSameTiming(self, flips):
+        # The edges of the expanded trains, every one within an iteration
+        # and a half of its requested time (see `_train_events`).
+        seq = self.compile(flips)
+        expanded = self.compile(flips.expanded())
+        edges = list(pev.TimingModel().edges(seq.events))
+        self.assertEqual([odsr for _, odsr in edges],
+                         [odsr for _, odsr in
+                          pev.TimingModel().edges(expanded.events)])
+        requested = sorted(set(flips.expanded().timestamps))
+        self.assertEqual(len(edges), len(requested))
+        for (time, _), timestamp in zip(edges, requested):
+            self.assertLessEqual(2 * abs(time - timestamp),
+                                 3 * pev.calibration_ticks)
+        self.assertEqual(seq.time, expanded.time)
+        return seq
+
+    def test_isolated_train_is_a_loop(self):
+        flips = pev.parse_events("t1u0.5u2ux100000", 0) \
+                + pev.parse_events("p0.1u0.2u p1s1u", 1)
+        seq = self.compile(flips)
+        self.assertLess(len(seq.events), 50)
+        self.assertTrue(any(isinstance(event, pev.RepeatEvent)
+                            for event in seq.events))
+        self.assertSameTiming(pev.parse_events("t1u0.5u2ux1000", 0)
+                              + pev.parse_events("p1s1u", 1))
+
+    def test_interfering_train_is_expanded(self):
+        flips = pev.parse_events("t1u0.5u2ux100", 0) \
+                + pev.parse_events("p51u1u", 1)
+        seq = self.assertSameTiming(flips)
+        self.assertFalse(any(isinstance(event, pev.RepeatEvent)
+                             for event in seq.events))
+
+    def test_overlapping_trains(self):
+        flips = pev.parse_events("t10i3i8ix50 t300i3i8ix50", 0) \
+                + pev.parse_events("t5i1i2ix1000 t5000i1i4ix100", 1)
+        # The pulses of a single iteration are shorter than the default
+        # overheads of a write and a delay loop.
+        with config.Config(overrides=IDEAL):
+            seq = self.assertSameTiming(flips)
+        self.assertEqual(sum(isinstance(event, pev.RepeatEvent)
+                             for event in seq.events), 1)
+
+    def test_long_trains(self):
+        # The counted loop overhead is not a whole number of iterations,
+        # but it does not accumulate over the repetitions.
+        overrides = {"Timing": {"state_change_cycles": "3",
+                                "loop_overhead_cycles": "3",
+                                "repeat_overhead_cycles": "6"}}
+        for cfg in [config.Config(), config.Config(overrides=overrides)]:
+            for text in ["t20u1u3ux30000", "t20u1u4ux30000"]:
+                flips = pev.parse_events(text, 0)
+                with cfg:
+                    seq = self.compile(flips)
+                    calibration_ticks = pev.calibration_ticks
+                    last = list(pev.TimingModel().edge_times(seq.events))[-1]
+                self.assertLess(len(seq.events), 200)
+                self.assertLessEqual(2 * abs(last - flips.trains[0].end),
+                                     3 * calibration_ticks)
+
+    def test_backends(self):
+        flips = pev.parse_events("t1u0.3u5ux31 p500u1u", 0) \
+                + pev.parse_events("t3u1u64ix35", 1)
+        # Some edges of the two trains are closer than a write takes.
+        with self.assertWarns(pev.TimingWarning):
+            self.assertSameTiming(flips)
+        if numpy is not None:
+            with self.assertWarns(pev.TimingWarning):
+                self.assertEqual(self.compile(flips,
+                                              backend="numpy").code(),
+                                 self.compile(flips).code())
+
+    def test_compress_keeps_loop_suffixes_unique(self):
+        flips = pev.parse_events("t10i3i8ix50", 0) \
+                + pev.parse_events(" ".join(f"p{1000 + 32 * n}i16i"
+                                            for n in range(20)), 1)
+        seq = self.compile(flips).compress()
+        suffixes = pseq._loop_suffixes(seq.events)["repeat"]
+        self.assertGreater(len(suffixes), 1)
+        self.assertEqual(sorted(suffixes), list(range(seq.repeat_counter)))
+        self.assertEqual(seq.code().count("for (uint32_t REP1 "), 1)
+
+
+class CompileCacheTest(unittest.TestCase):
+    """Tests for the compile cache
+    """
+
+    texts = [(0, "p1u3u p5u2u"), (1, "p2u1u")]
+
+    def test_equivalent_inputs_share_key(self):
+        key = pseq.CompileCache.key(self.texts)
+        self.assertEqual(pseq.CompileCache.key([(1, " p2u1u "), (2, ""),
+                                                (0, "p1u3u   p5u2u")]), key)
+        self.assertNotEqual(pseq.CompileCache.key([(0, "p1u3u p5u2u"),
+                                                   (2, "p2u1u")]), key)
+        self.assertNotEqual(pseq.CompileCache.key(self.texts,
+                                                  triggered=True), key)
+
+    def test_memory_tier(self):
+        cache = pseq.CompileCache(max_entries=1)
+        seq = pseq.compile_sequence(self.texts, cache=cache)
+        self.assertIs(pseq.compile_sequence(self.texts, cache=cache), seq)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        pseq.compile_sequence([(0, "p1u1u")], cache=cache)
+        self.assertIsNot(pseq.compile_sequence(self.texts, cache=cache), seq)
+
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = pseq.CompileCache(directory=tmp)
+            seq = pseq.compile_sequence(self.texts, cache=cache)
+            self.assertEqual(len(os.listdir(tmp)), 1)
+            cached = pseq.CompileCache(directory=tmp).get(
+                cache.key(self.texts))
+            self.assertEqual(cached.code(), seq.code())
+
+    def test_uncached(self):
+        flips = pev.FlipTable()
+        for channel, text in self.texts:
+            flips.extend(pev.parse_events(text, channel))
+        seq = pseq.Sequence.from_flip_sequence(pseq.FlipSequence(flips))
+        self.assertEqual(pseq.compile_sequence(self.texts).code(), seq.code())
+
+
+if __name__ == "__main__":
+    unittest.main()
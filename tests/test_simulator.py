@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import pulsebox.events as pev
+import pulsebox.sequences as pseq
+from pulsebox import config
+
+if numpy is not None:
+    import pulsebox.simulator as psim
+
+
+def flip_sequence(texts):
+    fs = pseq.FlipSequence(pev.FlipTable())
+    for channel, text in texts:
+        fs.flips.extend(pev.parse_events(text, channel))
+    return fs
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed.")
+class SimulatorTest(unittest.TestCase):
+    """Tests for the waveform simulator
+    """
+
+    texts = [(0, "p1u3u p5u2u"), (1, "p2u1u t20u1u3ux30"),
+             (2, "t200u0.5u1.3ux200")]
+    overrides = {"Timing": {"state_change_cycles": "3",
+                            "loop_overhead_cycles": "4",
+                            "repeat_overhead_cycles": "6",
+                            "table_step_cycles": "5"}}
+
+    def configs(self):
+        return [config.Config(), config.Config(overrides=self.overrides)]
+
+    def test_timing_model(self):
+        # The simulated writes are the edges of the timing model, also
+        # with (nested) counted loops.
+        for cfg in self.configs():
+            with cfg:
+                seq = pseq.compile_sequence(self.texts)
+                for sequence in [seq, seq.compress(), seq.optimize()[0]]:
+                    waveform = psim.simulate(sequence)
+                    edges = list(pev.TimingModel().edges(sequence.events))
+                    self.assertEqual(waveform.times.tolist(),
+                                     [time for time, _ in edges])
+                    self.assertEqual(waveform.odsr_values.tolist(),
+                                     [odsr for _, odsr in edges])
+
+    def test_channels(self):
+        ideal = config.Config(overrides={"Timing": {
+            "state_change_cycles": "0", "loop_overhead_cycles": "0"}})
+        with ideal:
+            seq = pseq.compile_sequence([(0, "p1u3u p5u2u"), (2, "p2u1u")])
+        waveform = psim.simulate(seq)
+        # With the ideal timing, the times are just quantized to delay
+        # loop iterations.
+        def quantized(*microseconds):
+            return [pev.time2iters(t * 10**6) * pev.calibration_ticks
+                    for t in microseconds]
+        self.assertEqual(waveform.edges[0].tolist(), quantized(1, 4, 5, 7))
+        self.assertEqual(waveform.edges[2].tolist(), quantized(2, 3))
+        self.assertEqual(len(waveform.edges[1]), 0)
+        self.assertEqual(waveform.duration, quantized(7)[0])
+        self.assertAlmostEqual(waveform.cycles(2)[0],
+                               quantized(2)[0] * config.clock_frequency
+                               / pev.TICKS_PER_SECOND)
+        empty = psim.simulate(pseq.Sequence([]))
+        self.assertEqual(len(empty.times), 0)
+
+    def test_table(self):
+        for cfg in self.configs():
+            with cfg:
+                seq = pseq.compile_sequence(self.texts)
+                steps = seq.table_steps()
+                timing = pev.TimingModel(codegen="table")
+                waveform = psim.simulate(seq, codegen="table")
+            time, played = 0, []
+            for n, (odsr, iters) in enumerate(steps):
+                if n > 0:
+                    time += timing.write_ticks
+                if odsr != (played[-1][1] if played else 0):
+                    played.append((time, odsr))
+                time += iters * timing.calibration_ticks
+            self.assertEqual(list(zip(waveform.times.tolist(),
+                                      waveform.odsr_values.tolist())),
+                             played)
+            # The table player plays the edges of the unrolled code,
+            # to within half a delay loop iteration.
+            unrolled = psim.simulate(seq, codegen="unrolled")
+            self.assertEqual(waveform.odsr_values.tolist(),
+                             unrolled.odsr_values.tolist())
+            self.assertLessEqual(
+                2 * abs(waveform.times - unrolled.times).max(),
+                timing.calibration_ticks)
+
+    def test_compare(self):
+        fs = flip_sequence(self.texts)
+        for cfg in self.configs():
+            with cfg:
+                seq = pseq.compile_sequence(self.texts)
+            diff = psim.compare(psim.simulate(seq), fs)
+            self.assertEqual(len(diff), len(fs.flips.expanded()))
+            self.assertEqual(diff.requested.tolist(),
+                             sorted(diff.requested.tolist()))
+            report = seq.timing_report(fs)
+            self.assertEqual(diff.max_error,
+                             max(abs(expected - requested)
+                                 for _, requested, expected in report))
+            self.assertIn("Timing error", diff.summary())
+            self.assertEqual(len(psim.format_edge_diff(
+                diff, limit=3).splitlines()), 4)
+        seq = pseq.compile_sequence(self.texts)
+        self.assertEqual(psim.check(seq, fs).max_error,
+                         psim.compare(psim.simulate(seq), fs).max_error)
+        with self.assertRaises(ValueError):
+            psim.check(seq, fs, tolerance=0)
+
+    def test_mismatched(self):
+        seq = pseq.compile_sequence([(0, "p1u3u"), (1, "p2u1u")])
+        diff = psim.compare(psim.simulate(seq),
+                            flip_sequence([(0, "p1u3u p5u2u")]))
+        self.assertEqual(diff.mismatched, {0: (4, 2), 1: (0, 2)})
+        self.assertEqual(len(diff), 2)
+        self.assertIn("Channel 1: 0 edges requested", diff.summary())
+        with self.assertRaises(ValueError):
+            psim.check(seq, flip_sequence([(0, "p1u3u")]))
+
+
+if __name__ == "__main__":
+    unittest.main()